@@ -0,0 +1,90 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the affinity policies of the process pool (see
+:func:`openquake.commonlib.parallel.get_affinity`) on memory-bound
+tasks. Two kinds of tasks are measured:
+
+- `local`: each task allocates a large array and scans it many times;
+- `broadcast`: the same large array is sent to all the tasks as a
+  Pickled object and each task scans its unpickled copy many times.
+
+On machines with a single NUMA node the policies are expected to give
+similar results; on multi-socket machines the 'core' and 'numa' policies
+keep the workers on the node where their data has been allocated.
+
+Usage::
+
+ $ python benchmarks/affinity_bench.py [results.json]
+ $ python benchmarks/affinity_bench.py compare old.json new.json
+"""
+import sys
+import operator
+
+import numpy
+
+from openquake.commonlib.parallel import (
+    map_reduce, init_executor, get_num_workers, Pickled, AFFINITY_POLICIES,
+    ONE_MB)
+
+import benchlib
+
+ARRAY_MB = 64
+LOOPS = 20
+
+
+def scan(arr, loops):
+    tot = 0.
+    for _ in xrange(loops):
+        tot += arr.sum()
+    return tot
+
+
+def local(size_mb, loops):
+    arr = numpy.ones(size_mb * ONE_MB // 8)  # allocated by the worker
+    return scan(arr, loops)
+
+
+def broadcast(pik, loops):
+    return scan(pik.unpickle(), loops)
+
+
+def run(size_mb=ARRAY_MB, loops=LOOPS):
+    num_workers = get_num_workers()
+    num_tasks = 2 * num_workers
+    pik = Pickled(numpy.ones(size_mb * ONE_MB // 8))
+    res = {}
+    try:
+        for affinity in AFFINITY_POLICIES:
+            init_executor(num_workers, affinity)
+            map_reduce(local, [(1, 1)] * num_workers, operator.add, 0)
+            res[affinity] = dict(
+                local_s=benchlib.timeit(
+                    map_reduce, local, [(size_mb, loops)] * num_tasks,
+                    operator.add, 0),
+                broadcast_s=benchlib.timeit(
+                    map_reduce, broadcast, [(pik, loops)] * num_tasks,
+                    operator.add, 0))
+    finally:
+        init_executor()
+    return res
+
+
+if __name__ == '__main__':
+    benchlib.main('affinity', run, sys.argv[1:])
@@ -0,0 +1,136 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Utilities shared by the benchmark scripts in this directory. Each
+script collects a dictionary of measurements and saves it as a JSON
+file together with some metadata (commit, Python version, number of
+CPUs), so that the results of different commits can be compared with
+
+ $ python <script>.py compare old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+
+import numpy
+
+
+def git_commit():
+    """The current commit of the repository, or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata():
+    """A dictionary describing the environment of the benchmark"""
+    return dict(commit=git_commit(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                numpy=numpy.__version__,
+                platform=platform.platform(),
+                num_cpus=multiprocessing.cpu_count())
+
+
+def timeit(func, *args, **kw):
+    """
+    Call the function `repeat` times (default 3) and return the minimum
+    elapsed time in seconds.
+    """
+    repeat = kw.pop('repeat', 3)
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        func(*args, **kw)
+        times.append(time.time() - t0)
+    return min(times)
+
+
+def save(name, results, fname=None):
+    """
+    Save the results of a benchmark in JSON format; if `fname` is None,
+    print them on stdout.
+    """
+    data = dict(benchmark=name, metadata=metadata(), results=results)
+    out = json.dumps(data, indent=2, sort_keys=True)
+    if fname is None:
+        print out
+    else:
+        with open(fname, 'w') as f:
+            f.write(out)
+
+
+def _flatten(dic, prefix=''):
+    """Flatten a nested dictionary into a dictionary dotted key -> number"""
+    flat = {}
+    for key, val in dic.iteritems():
+        if isinstance(val, dict):
+            flat.update(_flatten(val, prefix + key + '.'))
+        elif isinstance(val, (int, float)):
+            flat[prefix + key] = val
+    return flat
+
+
+def _label(data, default):
+    """A short label for the results of a benchmark"""
+    commit = data['metadata']['commit']
+    return commit[:10] if commit else default
+
+
+def compare(old_fname, new_fname, out=sys.stdout):
+    """
+    Print the ratio new/old of all the numeric results of two
+    benchmark files.
+    """
+    old = json.load(open(old_fname))
+    new = json.load(open(new_fname))
+    assert old['benchmark'] == new['benchmark'], (
+        old['benchmark'], new['benchmark'])
+    old_res = _flatten(old['results'])
+    new_res = _flatten(new['results'])
+    out.write('%-50s %12s %12s %8s\n' % (
+        'measure', _label(old, 'old'), _label(new, 'new'), 'ratio'))
+    for key in sorted(set(old_res) & set(new_res)):
+        o, n = old_res[key], new_res[key]
+        ratio = '%.2f' % (float(n) / o) if o else '-'
+        out.write('%-50s %12.6g %12.6g %8s\n' % (key, o, n, ratio))
+
+
+def main(name, run, argv):
+    """
+    Command-line entry point of the benchmark scripts:
+
+     $ python <script>.py [output.json]
+     $ python <script>.py compare old.json new.json
+
+    :param name: the name of the benchmark
+    :param run: a function returning a dictionary of results
+    :param argv: the command-line arguments
+    """
+    if argv and argv[0] == 'compare':
+        compare(*argv[1:])
+    else:
+        save(name, run(), *argv[:1])
@@ -0,0 +1,97 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the compressed CSV files (see
+:data:`openquake.commonlib.csvmanager.CODECS`) on a directory archive
+with a large GmfData file. For each codec (and for the uncompressed
+file) the time in seconds to write the records with
+:meth:`CSVManager.write`, the time to read them back with
+:meth:`CSVManager.read` and the size of the file in MB are reported;
+the compressed files are written both with one thread and with a
+thread per CPU.
+
+Usage::
+
+ $ python benchmarks/codec_bench.py [results.json]
+ $ python benchmarks/codec_bench.py compare old.json new.json
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+from openquake.commonlib import records
+from openquake.commonlib.csvmanager import (
+    CSVManager, DirArchive, CompressedFile, CODECS)
+from openquake.commonlib.parallel import ONE_MB
+
+import benchlib
+
+NUM_RECORDS = 1000000
+
+
+def gmf_data(n):
+    return [records.GmfData(
+        str(i // 100000 + 1), 'PGA', 'r%d' % (i // 100),
+        '%.2f' % (i % 100 * .01), '%.2f' % (i % 7 * .01),
+        '%.6f' % ((i % 997) * .0001)) for i in xrange(n)]
+
+
+def write(dname, recs, compression):
+    for fname in os.listdir(dname):
+        os.remove(os.path.join(dname, fname))
+    with CSVManager(DirArchive(dname), 'bench', compression=compression) as m:
+        for rec in recs:
+            m.write(rec)
+
+
+def read(dname):
+    with CSVManager(DirArchive(dname), 'bench') as man:
+        for rec in man.read(records.GmfData):
+            pass
+
+
+def run(n=NUM_RECORDS):
+    recs = gmf_data(n)
+    dname = tempfile.mkdtemp()
+    res = {}
+    try:
+        for codec in [None] + sorted(CODECS):
+            name = codec or 'csv'
+            if codec:
+                threads = CompressedFile.threads
+                CompressedFile.threads = 1
+                try:
+                    res[name + '_write_1thread_s'] = benchlib.timeit(
+                        write, dname, recs, codec)
+                finally:
+                    CompressedFile.threads = threads
+            res[name + '_write_s'] = benchlib.timeit(
+                write, dname, recs, codec)
+            res[name + '_read_s'] = benchlib.timeit(read, dname)
+            [fname] = os.listdir(dname)
+            res[name + '_mb'] = os.path.getsize(
+                os.path.join(dname, fname)) / float(ONE_MB)
+    finally:
+        shutil.rmtree(dname)
+    return res
+
+
+if __name__ == '__main__':
+    benchlib.main('codec', run, sys.argv[1:])
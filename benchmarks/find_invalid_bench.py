@@ -0,0 +1,67 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of :meth:`openquake.commonlib.csvmanager.CSVManager.find_invalid`
+on a directory archive with a large CSV file of locations, in the
+sequential and in the parallel mode, both searching for all the invalid
+records and stopping at the first one.
+
+Usage::
+
+ $ python benchmarks/find_invalid_bench.py [results.json]
+ $ python benchmarks/find_invalid_bench.py compare old.json new.json
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+from openquake.commonlib.csvmanager import CSVManager, DirArchive
+
+import benchlib
+
+NUM_RECORDS = 1000000
+
+
+def write_locations(fname, n):
+    """Write n locations, with an invalid longitude every 1000 records"""
+    with open(fname, 'w') as f:
+        f.write('id,lon,lat\n')
+        for i in xrange(1, n + 1):
+            lon = 200 if i % 1000 == 0 else i % 360 - 180
+            f.write('%d,%s,%s\n' % (i, lon, i // 360 * .0001))
+
+
+def run(n=NUM_RECORDS):
+    dname = tempfile.mkdtemp()
+    try:
+        write_locations(os.path.join(dname, 'bench__Location.csv'), n)
+        man = CSVManager(DirArchive(dname))
+        return dict(
+            sequential_s=benchlib.timeit(man.find_invalid),
+            parallel_s=benchlib.timeit(man.find_invalid, parallel=True),
+            sequential_first_s=benchlib.timeit(man.find_invalid, 1),
+            parallel_first_s=benchlib.timeit(
+                man.find_invalid, 1, parallel=True))
+    finally:
+        shutil.rmtree(dname)
+
+
+if __name__ == '__main__':
+    benchlib.main('find_invalid', run, sys.argv[1:])
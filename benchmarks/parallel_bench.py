@@ -0,0 +1,158 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the parallel subsystem in openquake.commonlib.parallel.
+It measures
+
+- the overhead of a task submitted with `map_reduce`, both with a
+  process pool and in process (OQ_NO_DISTRIBUTE=1);
+- the throughput of `Pickled` and `pickle_sequence` as a function of
+  the size of the payload;
+- the scaling efficiency of a CPU-bound job from 1 to N workers;
+- the cost of aggregating NumPy accumulators, both in the parent
+  process and including the transfer of the results from the workers.
+
+Usage::
+
+ $ python benchmarks/parallel_bench.py [results.json]
+ $ python benchmarks/parallel_bench.py compare old.json new.json
+"""
+import os
+import sys
+import operator
+import multiprocessing
+
+import numpy
+
+from openquake.commonlib import parallel
+from openquake.commonlib.parallel import (
+    map_reduce, Pickled, pickle_sequence, init_executor)
+
+import benchlib
+
+NUM_TASKS = 200
+PAYLOAD_SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+ARRAY_SIZES = [1000, 100000, 1000000]
+CPU_WORK = 4000000  # total number of iterations in the scaling benchmark
+
+
+def noop(i):
+    return i
+
+
+def busy(n):
+    tot = 0
+    for i in xrange(n):
+        tot += i
+    return tot
+
+
+def make_array(size):
+    return numpy.ones(size)
+
+
+def iadd(acc, val):
+    acc += val
+    return acc
+
+
+def task_overhead(num_tasks=NUM_TASKS):
+    """Seconds per task for a task doing nothing"""
+    args = [(i,) for i in range(num_tasks)]
+    res = {}
+    dt = benchlib.timeit(map_reduce, noop, args, operator.add, 0)
+    res['pool'] = dt / num_tasks
+    os.environ['OQ_NO_DISTRIBUTE'] = '1'
+    try:
+        dt = benchlib.timeit(map_reduce, noop, args, operator.add, 0)
+    finally:
+        del os.environ['OQ_NO_DISTRIBUTE']
+    res['no_distribute'] = dt / num_tasks
+    return res
+
+
+def serialization(sizes=PAYLOAD_SIZES):
+    """Pickling and unpickling throughput in MB/s for arrays of given size"""
+    res = {}
+    for nbytes in sizes:
+        arr = numpy.zeros(nbytes // 8)
+        pik = Pickled(arr)
+        dumps = benchlib.timeit(Pickled, arr)
+        loads = benchlib.timeit(pik.unpickle)
+        # a sequence with 10 copies of the same object is pickled once
+        seq = benchlib.timeit(pickle_sequence, [arr] * 10)
+        res['%dK' % (nbytes // 1024)] = dict(
+            pickle_MBps=nbytes / dumps / parallel.ONE_MB if dumps else None,
+            unpickle_MBps=nbytes / loads / parallel.ONE_MB if loads else None,
+            pickle_sequence_10_copies_s=seq)
+    return res
+
+
+def scaling(max_workers=None, work=CPU_WORK):
+    """
+    Elapsed time and efficiency t1 / (n * tn) of a CPU-bound job split
+    in 4 * N tasks, for a pool of n = 1 ... N workers.
+    """
+    max_workers = max_workers or multiprocessing.cpu_count()
+    num_tasks = 4 * max_workers
+    args = [(work // num_tasks,)] * num_tasks
+    res = {}
+    t1 = None
+    try:
+        for num_workers in range(1, max_workers + 1):
+            init_executor(num_workers)
+            map_reduce(noop, [(0,)] * num_workers, operator.add, 0)  # warm up
+            dt = benchlib.timeit(map_reduce, busy, args, operator.add, 0)
+            if t1 is None:
+                t1 = dt
+            res['%d_workers' % num_workers] = dict(
+                seconds=dt, efficiency=t1 / (num_workers * dt))
+    finally:
+        init_executor()
+    return res
+
+
+def aggregation(sizes=ARRAY_SIZES, num_tasks=50):
+    """
+    Seconds needed to aggregate `num_tasks` arrays of the given sizes,
+    with a copying and an in-place accumulator; the `map_reduce` timing
+    includes the transfer of the arrays from the workers.
+    """
+    res = {}
+    for size in sizes:
+        arrays = [numpy.ones(size)] * num_tasks
+        copy = benchlib.timeit(reduce, operator.add, arrays, numpy.zeros(size))
+        inplace = benchlib.timeit(
+            lambda: reduce(iadd, arrays, numpy.zeros(size)))
+        mr = benchlib.timeit(map_reduce, make_array, [(size,)] * num_tasks,
+                             iadd, numpy.zeros(size))
+        res['%d' % size] = dict(copy_s=copy, inplace_s=inplace,
+                                map_reduce_s=mr)
+    return res
+
+
+def run():
+    return dict(task_overhead=task_overhead(),
+                serialization=serialization(),
+                scaling=scaling(),
+                aggregation=aggregation())
+
+
+if __name__ == '__main__':
+    benchlib.main('parallel', run, sys.argv[1:])
@@ -0,0 +1,83 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the reading of a large CSV file of ground motion values
+from a directory archive:
+
+- `table_s`: a Table built from the records (one record per row);
+- `columntable_s`: a ColumnTable filled by reading the file in columns
+  (see :meth:`openquake.commonlib.csvmanager.CSVManager.read_columns`);
+- `records_s`: the rows cast one by one, as done by the record path;
+- `find_invalid_s`: the sequential validation of the file.
+
+Usage::
+
+ $ python benchmarks/read_columns_bench.py [results.json]
+ $ python benchmarks/read_columns_bench.py compare old.json new.json
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+from openquake.commonlib import record, records
+from openquake.commonlib.csvmanager import CSVManager, DirArchive
+
+import benchlib
+
+NUM_RECORDS = 1000000
+
+
+def write_gmf_data(fname, n):
+    """Write n ground motion values, 1000 for each rupture"""
+    with open(fname, 'w') as f:
+        f.write('stochasticEventSetId,imtStr,ruptureId,lon,lat,gmv\n')
+        for i in xrange(n):
+            f.write('1,PGA,r%d,%.4f,%.4f,%.6f\n' % (
+                i // 1000, i % 1000 * .01, i // 1000 * .01, i % 97 * .001))
+
+
+def readtable(archive, tabletype):
+    # a new manager for each call, since the readers are not rewound
+    return CSVManager(archive, 'bench').readtable(records.GmfData, tabletype)
+
+
+def cast_records(archive):
+    for rec in CSVManager(archive, 'bench').read(records.GmfData):
+        rec.cast()
+
+
+def run(n=NUM_RECORDS):
+    dname = tempfile.mkdtemp()
+    try:
+        write_gmf_data(os.path.join(dname, 'bench__GmfData.csv'), n)
+        archive = DirArchive(dname)
+        return dict(
+            table_s=benchlib.timeit(readtable, archive, record.Table),
+            columntable_s=benchlib.timeit(
+                readtable, archive, record.ColumnTable),
+            records_s=benchlib.timeit(cast_records, archive),
+            find_invalid_s=benchlib.timeit(
+                CSVManager(archive).find_invalid))
+    finally:
+        shutil.rmtree(dname)
+
+
+if __name__ == '__main__':
+    benchlib.main('read_columns', run, sys.argv[1:])
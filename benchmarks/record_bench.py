@@ -0,0 +1,142 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the per-record cost of the operations in
+openquake.commonlib.record, in microseconds per record:
+
+- the extraction of the keys of the Unique and ForeignKey constraints;
+- the lookup of the descriptors of a record type;
+- the cast of the records and of a column of numbers, value by value
+  and with `Field.cast_column`;
+- the insertion in a Table and in a TableSet, both record by record
+  (checking the foreign keys) and in bulk with `insert_all`;
+- the conversion of a Table and of a ColumnTable into a structured
+  array and back.
+
+Usage::
+
+ $ python benchmarks/record_bench.py [results.json]
+ $ python benchmarks/record_bench.py compare old.json new.json
+"""
+import sys
+
+from openquake.commonlib import record, records, converter
+
+import benchlib
+
+NUM_RECORDS = 100000
+
+
+def locations(n):
+    return [records.Location(str(i), str(i % 360 - 180), str(i // 360 * .01))
+            for i in xrange(n)]
+
+
+def vulnerability(n):
+    """Records for a Vulnerability TableSet, with n data records"""
+    sets = [records.DiscreteVulnerabilitySet('PAGER', 'population',
+                                             'fatalities', 'MMI')]
+    funcs = [records.DiscreteVulnerability('PAGER', str(i), 'LN')
+             for i in xrange(n // 100 + 1)]
+    data = [records.DiscreteVulnerabilityData(
+            'PAGER', str(i // 100), '%.2f' % (i % 100 * .05), '0.1', '0.3')
+            for i in xrange(n)]
+    return sets + funcs + data
+
+
+def per_record(n, func, *args):
+    """Microseconds per record needed to call func(*args)"""
+    return benchlib.timeit(func, *args) / n * 1E6
+
+
+def extract_keys(recs):
+    for rec in recs:
+        rec.pkey
+        rec.unique
+
+
+def get_descriptors(recs):
+    for rec in recs:
+        rec.__class__.get_descriptors(record.ForeignKey)
+
+
+def cast(recs):
+    for rec in recs:
+        rec.cast()
+
+
+def cast_values(field, values):
+    return record._typed_column(map(field.cast, values))
+
+
+def cast_column(field, values):
+    return field.cast_column(values)
+
+
+def table_append(recs):
+    tbl = record.Table(records.Location, [])
+    for rec in recs:
+        tbl.append(rec)
+
+
+def tableset_insert(recs):
+    tset = record.TableSet(converter.Vulnerability)
+    for rec in recs:
+        tset.insert(rec)
+
+
+def tableset_insert_all(recs):
+    record.TableSet(converter.Vulnerability).insert_all(recs)
+
+
+def to_array(tbl):
+    return tbl.to_array()
+
+
+def from_array(tabletype, arr):
+    return tabletype.from_array(records.Location, arr)
+
+
+def run(n=NUM_RECORDS):
+    locs = locations(n)
+    vuln = vulnerability(n)
+    lons = [loc['lon'] for loc in locs]
+    lon = records.GmfData.fields[records.GmfData.get_field_index('lon')]
+    tbl = record.Table(records.Location, locs)
+    ctbl = record.ColumnTable(records.Location, locs)
+    arr = tbl.to_array()
+    return dict(
+        extract_keys_us=per_record(n, extract_keys, locs),
+        get_descriptors_us=per_record(len(vuln), get_descriptors, vuln),
+        cast_us=per_record(n, cast, locs),
+        cast_values_us=per_record(n, cast_values, lon, lons),
+        cast_column_us=per_record(n, cast_column, lon, lons),
+        table_append_us=per_record(n, table_append, locs),
+        tableset_insert_us=per_record(len(vuln), tableset_insert, vuln),
+        tableset_insert_all_us=per_record(
+            len(vuln), tableset_insert_all, vuln),
+        table_to_array_us=per_record(n, to_array, tbl),
+        columntable_to_array_us=per_record(n, to_array, ctbl),
+        table_from_array_us=per_record(n, from_array, record.Table, arr),
+        columntable_from_array_us=per_record(
+            n, from_array, record.ColumnTable, arr))
+
+
+if __name__ == '__main__':
+    benchlib.main('record', run, sys.argv[1:])
@@ -0,0 +1,116 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory benchmark of the record objects. The records of the exposure
+and GMF files bundled with the tests are replicated up to NUM_RECORDS
+records per file and kept in memory; the benchmark reports, for each
+file, the growth of the resident memory and the time needed to build
+the records, per record. The field values are shared between the
+copies, so the figures measure the overhead of the record objects.
+It also reports the same figures for a ColumnTable of NUM_RECORDS
+GmfData rows appended column by column, which measure the cost of
+the columns and of the unique constraints.
+
+Usage::
+
+ $ python benchmarks/record_memory_bench.py [results.json]
+ $ python benchmarks/record_memory_bench.py compare old.json new.json
+"""
+import os
+import sys
+import time
+import itertools
+
+import psutil
+
+from openquake.commonlib import converter, record, records
+
+import benchlib
+
+DATADIR = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                       'openquake', 'commonlib', 'tests', 'data')
+FILES = ['exposure-buildings.xml', 'exposure-population.xml',
+         'gmf-scenario.xml', 'gmf-event-based.xml']
+NUM_RECORDS = 1000000
+
+
+def rss():
+    """Resident memory of the current process in bytes"""
+    return psutil.Process(os.getpid()).get_memory_info().rss
+
+
+def get_rows(fname):
+    """A list of (recordtype, row) pairs extracted from a NRML file"""
+    conv = converter.Converter.from_nrml(os.path.join(DATADIR, fname))
+    tset = conv.tableset
+    return [(tbl.recordtype, tuple(rec)) for tbl in tset for rec in tbl]
+
+
+def measure(rows, num_records):
+    """
+    Build `num_records` records by cycling on the given rows and
+    return the bytes and microseconds per record.
+    """
+    rows = list(itertools.islice(itertools.cycle(rows), num_records))
+    mem0 = rss()
+    t0 = time.time()
+    recs = [rectype(*row) for rectype, row in rows]
+    dt = time.time() - t0
+    mem = rss() - mem0
+    del recs
+    return dict(bytes_per_record=float(mem) / num_records,
+                us_per_record=dt / num_records * 1E6)
+
+
+def gmf_columns(num_records):
+    """Columns of strings for `num_records` distinct GmfData rows"""
+    return [['1'] * num_records,
+            ['PGA'] * num_records,
+            ['r%d' % (i // 1000) for i in xrange(num_records)],
+            ['%.1f' % (i % 1000 * .1) for i in xrange(num_records)],
+            ['0.0'] * num_records,
+            ['0.1'] * num_records]
+
+
+def measure_columntable(num_records):
+    """
+    Build a ColumnTable of `num_records` GmfData rows and return the
+    bytes and microseconds per record.
+    """
+    columns = gmf_columns(num_records)
+    mem0 = rss()
+    t0 = time.time()
+    tbl = record.ColumnTable(records.GmfData, [])
+    tbl.extend_columns(columns)
+    dt = time.time() - t0
+    mem = rss() - mem0
+    del tbl
+    return dict(bytes_per_record=float(mem) / num_records,
+                us_per_record=dt / num_records * 1E6)
+
+
+def run(num_records=NUM_RECORDS):
+    results = dict((fname, measure(get_rows(fname), num_records))
+                   for fname in FILES)
+    results['ColumnTable-GmfData'] = measure_columntable(num_records)
+    return results
+
+
+if __name__ == '__main__':
+    benchlib.main('record_memory', run, sys.argv[1:])
@@ -0,0 +1,83 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the writing of a large GmfData CSV file in a
+:class:`openquake.commonlib.csvmanager.ZipArchive`, with the files
+compressed while written (`streaming`) and with the files written on
+a temporary file and added to the archive when closed (`tempfile`),
+without compression and with the zlib levels 1 and 6. For each case
+the time in seconds and the size of the archive in MB are reported.
+
+Usage::
+
+ $ python benchmarks/zip_bench.py [results.json]
+ $ python benchmarks/zip_bench.py compare old.json new.json
+"""
+import os
+import sys
+import shutil
+import tempfile
+
+from openquake.commonlib.csvmanager import ZipArchive
+from openquake.commonlib.parallel import ONE_MB
+
+import benchlib
+
+NUM_RECORDS = 1000000
+LEVELS = [None, 1, 6]
+
+
+def gmf_lines(n):
+    """The lines of a GmfData CSV file with n data rows"""
+    yield 'stochasticEventSetId,imtStr,ruptureId,lon,lat,gmv\n'
+    for i in xrange(n):
+        yield '%d,PGA,r%d,%.2f,%.2f,%.6f\n' % (
+            i // 100000 + 1, i // 100, i % 100 * .01, i % 7 * .01,
+            (i % 997) * .0001)
+
+
+def write_zip(zipname, lines, compresslevel, streaming):
+    archive = ZipArchive(zipname, 'w', compresslevel, streaming)
+    with archive.open('bench__GmfData.csv', 'w') as f:
+        for line in lines:
+            f.write(line)
+    archive.zip.close()
+
+
+def run(n=NUM_RECORDS):
+    lines = list(gmf_lines(n))
+    dname = tempfile.mkdtemp()
+    res = {}
+    try:
+        zipname = os.path.join(dname, 'bench.zip')
+        for level in LEVELS:
+            name = 'stored' if level is None else 'level%d' % level
+            for streaming in (True, False):
+                mode = 'streaming' if streaming else 'tempfile'
+                res['%s_%s_s' % (mode, name)] = benchlib.timeit(
+                    write_zip, zipname, lines, level, streaming)
+                res['%s_%s_mb' % (mode, name)] = (
+                    os.path.getsize(zipname) / float(ONE_MB))
+    finally:
+        shutil.rmtree(dname)
+    return res
+
+
+if __name__ == '__main__':
+    benchlib.main('zip', run, sys.argv[1:])
@@ -35,23 +35,30 @@ def create(convert, fname):
     return out
 
 
-def print_invalid(man, limit):
-    invalid = man.find_invalid(limit)
+def print_invalid(man, limit, prefixes=None):
+    invalid = man.find_invalid(limit, prefixes=prefixes)
     for inv in invalid:
         print inv
     if invalid:
         sys.exit('Found %d invalid records' % len(invalid))
 
 
-def main(input, output=None, limit=None):
+def main(input, output=None, limit=None, mode=None):
     """
     Converts nrml -> csv if the input file ends with .csv
     and csv -> nrml if the input is a directory or a zip
     archive containing csv files. The csv are validated and
     messages are printed on stdout in case of errors.
+    In the csv -> nrml case, if mode is 'incremental' only the
+    prefixes with csv files changed since the previous conversion
+    are validated and converted; if mode is 'verify' the files are
+    hashed again instead of trusting the manifest of the previous
+    conversion.
     """
     if limit is not None:
         limit = int(limit)  # max number of errors
+    if mode not in (None, 'incremental', 'verify'):
+        sys.exit('Invalid mode %r, expected incremental or verify' % mode)
     if input.endswith('.xml'):
         if not output:
             sys.exit('Please specify an output archive')
@@ -64,9 +71,16 @@ def main(input, output=None, limit=None):
     # csv -> nrml
     inp_archive = mkarchive(input, 'r+')
     man = CSVManager(inp_archive, os.path.basename(input))
-    print_invalid(man, limit)
+    changes = None
+    if mode is None:
+        print_invalid(man, limit)
     out_archive = mkarchive(output, 'a') if output else inp_archive
-    create(lambda n: man.convert_to_nrml(out_archive), os.path.basename(input))
+    if mode is not None:  # the unchanged prefixes were validated already
+        changes = man.find_changed(out_archive, verify=mode == 'verify')
+        print_invalid(man, limit, changes[1])
+    create(lambda n: man.convert_to_nrml(
+        out_archive, incremental=mode is not None, verify=mode == 'verify',
+        changes=changes), os.path.basename(input))
 
 
 if __name__ == '__main__':
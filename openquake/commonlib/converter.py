@@ -26,6 +26,7 @@ This module contains converter classes working on nodes of kind
 - gmfcollection
 """
 import itertools
+from lxml import etree
 from openquake.risklib import scientific
 from openquake.nrmllib.node import Node, node_from_xml
 from openquake.commonlib import record, records
@@ -39,15 +40,97 @@ def groupby(records, keyfields):
     return itertools.groupby(records, lambda r: [r[k] for k in keyfields])
 
 
+def striptag(tag):
+    """
+    Remove the namespace from a tag
+
+    >>> striptag('{http://openquake.org/xmlns/nrml/0.4}gmfSet')
+    'gmfSet'
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def children(node, tag):
+    """
+    Yield the subnodes with the given tag, in order, iterating on the
+    node only once, so that it works also for lazy nodes
+    """
+    for subnode in node:
+        if subnode.tag == tag:
+            yield subnode
+
+
+def _elem_to_node(elem):
+    """Convert a parsed element into a Node, stripping the namespaces"""
+    nodes = [_elem_to_node(e) for e in elem if isinstance(e.tag, basestring)]
+    return Node(striptag(elem.tag), dict(elem.attrib), text=elem.text,
+                nodes=nodes)
+
+
+def _clear(elem):
+    """Remove the content of a processed element and its previous siblings"""
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def _lazy_nodes(events, parent, tags):
+    """
+    Yield the children of the given element as Nodes, by consuming the
+    shared stream of iterparse events. The children with a tag in `tags`
+    are yielded at their start, with their subnodes parsed lazily in
+    the same way; the other children are yielded fully parsed, at their
+    end. The processed elements are removed from the tree.
+    """
+    for event, elem in events:
+        if elem is parent:  # end of the parent
+            return
+        elif elem.getparent() is not parent:  # inside a child
+            continue
+        elif event == 'end':
+            yield _elem_to_node(elem)
+            _clear(elem)
+        elif striptag(elem.tag) in tags:
+            node = Node(striptag(elem.tag), dict(elem.attrib))
+            node.nodes = _lazy_nodes(events, elem, tags)
+            yield node
+            for _ in node.nodes:  # skip the subnodes not consumed
+                pass
+            _clear(elem)
+
+
+def lazy_node_from_nrml(fname):
+    """
+    Parse the NRML file incrementally and return the node of the model,
+    in which the nodes with a tag listed in the `streamed_tags` of the
+    converters have their subnodes parsed lazily, when iterating on them;
+    then the subnodes can be iterated only once and in order, so that a
+    file of any size can be read in constant memory.
+    """
+    tags = set()
+    for convertertype in Converter.__subclasses__():
+        tags.update(convertertype.streamed_tags)
+    events = etree.iterparse(fname, events=('start', 'end'))
+    _event, root = events.next()
+    return _lazy_nodes(events, root, tags).next()
+
+
 class Converter(object):
     """
-    Base class.
+    Base class. The names of the record types listed in `streamed` are
+    the ones which can be converted without storing their records,
+    by reading them in order from the CSV files (see
+    :meth:`openquake.commonlib.csvmanager.CSVManager.get_stream_tableset`).
+    Viceversa the nodes with a tag in `streamed_tags` can be converted
+    without storing their subnodes (see :func:`lazy_node_from_nrml`).
     """
+    streamed = ()
+    streamed_tags = ()
 
     @classmethod
-    def from_node(cls, node):
+    def get_type(cls, node):
         """
-        Return a specialized Converter instance
+        Return the converter class suitable for the given node
         """
         tag = node.tag
         name = tag[0].upper() + tag[1:]
@@ -56,7 +139,14 @@ class Converter(object):
             clsname += node['format'].capitalize()
         if clsname == 'GmfSet':
             clsname = 'GmfCollection'
-        convertertype = globals()[clsname]
+        return globals()[clsname]
+
+    @classmethod
+    def from_node(cls, node):
+        """
+        Return a specialized Converter instance
+        """
+        convertertype = cls.get_type(node)
         tset = record.TableSet(convertertype)
         tset.insert_all(convertertype.node_to_records(node))
         return convertertype(tset)
@@ -131,9 +221,8 @@ class Vulnerability(Converter):
         tset = self.tableset
         dvs_node = record.nodedict(tset.tableDiscreteVulnerabilitySet)
         dvf_node = record.nodedict(tset.tableDiscreteVulnerability)
-        for (set_id, vf_id), group in groupby(
-                tset.tableDiscreteVulnerabilityData,
-                ['vulnerabilitySetID', 'vulnerabilityFunctionID']):
+        data = tset.tableDiscreteVulnerabilityData
+        for (set_id, vf_id), group in data.groupby('function'):
             dvf = dvf_node[set_id, vf_id]
             imt = dvs_node[(set_id,)].IML['IMT']
             coeffs = []
@@ -196,10 +285,8 @@ class FragilityDiscrete(Converter):
         nodamage = float(ffs_node['noDamageLimit']) \
             if 'noDamageLimit' in ffs_node else None
         frag.nodes.extend(ffs_node.values())
-        for (ls, ordinal), data in groupby(
-                tset.tableFFDataDiscrete, ['limitState', 'ffs_ordinal']):
-            data = list(data)
-
+        for (ls, ordinal), data in tset.tableFFDataDiscrete.groupby(
+                'function'):
             # check that we can instantiate a FragilityFunction in risklib
             if nodamage:
                 scientific.FragilityFunctionDiscrete(
@@ -259,9 +346,8 @@ class FragilityContinuous(Converter):
         frag = tset.tableFragilityContinuous[0].to_node()
         ffs_node = record.nodedict(tset.tableFFSetContinuous)
         frag.nodes.extend(ffs_node.values())
-        for (ls, ordinal), data in groupby(
-                tset.tableFFDataContinuous, ['limitState', 'ffs_ordinal']):
-            data = list(data)
+        for (ls, ordinal), data in tset.tableFFDataContinuous.groupby(
+                'function'):
             n = Node('ffc', dict(ls=ls))
             param = dict(row[2:] for row in data)  # param, value
 
@@ -279,19 +365,46 @@ class FragilityContinuous(Converter):
 
 class Exposure(Converter):
     """A converter for exposureModel nodes"""
+    streamed = ('Asset',)
+    streamed_tags = ('exposureModel', 'assets')
 
     @classmethod
     def node_to_records(cls, node):
         """
-        Convert the node into a sequence of Exposure records
+        Convert the node into a sequence of Exposure records. The
+        subnodes are read in order, so that the node can be lazy.
+        """
+        description = conv = None
+        headers = True  # the header records are still to be yielded
+        for subnode in node:
+            if subnode.tag == 'description':
+                description = subnode.text.strip()
+            elif subnode.tag == 'conversions':
+                conv = subnode
+            elif subnode.tag == 'assets':
+                for rec in cls._header_records(node, description, conv):
+                    yield rec
+                headers = False
+                for rec in cls._asset_records(subnode):
+                    yield rec
+        if headers:  # there are no assets
+            for rec in cls._header_records(node, description, conv):
+                yield rec
+
+    @staticmethod
+    def _header_records(node, description, conv):
+        """
+        Yield the CostType records and the Exposure record
         """
         taxonomysource = node.attrib.get('taxonomySource', 'UNKNOWN')
+        if description is None:
+            raise NameError('No subnode named "description" found in '
+                            '"%s"' % node.tag)
         if node['category'] == 'buildings':
-            for c in node.conversions.costTypes:
+            for c in conv.costTypes:
                 yield records.CostType(c['name'], c['type'], c['unit'],
                                        c.attrib.get('retrofittedType', ''),
                                        c.attrib.get('retrofittedUnit', ''))
-            conv = node.conversions
             try:
                 area = conv.area
                 area_type = area['type']
@@ -303,7 +416,7 @@ class Exposure(Converter):
                 node['id'],
                 node['category'],
                 taxonomysource,
-                node.description.text.strip(),
+                description,
                 area_type,
                 area_unit,
                 conv.deductible['isAbsolute'],
@@ -313,11 +426,17 @@ class Exposure(Converter):
                 node['id'],
                 node['category'],
                 taxonomysource,
-                node.description.text.strip())
+                description)
 
+    @staticmethod
+    def _asset_records(assets):
+        """
+        Yield the Occupancy, Cost, Location and Asset records for each
+        asset node
+        """
         locations = {}  # location -> id
         loc_counter = itertools.count(1)
-        for asset in node.assets:
+        for asset in assets:
             asset_ref = asset['id']
 
             # convert occupancies
@@ -388,8 +507,8 @@ class Exposure(Converter):
                     Node('area', {'type': area_type, 'unit': area_unit})]))
         if t.tableOccupancy:
             # extract the occupancies corresponding to the first asset
-            _asset_ref, occupancies = groupby(
-                t.tableOccupancy, ['asset_ref']).next()
+            occupancies = t.tableOccupancy.lookup(
+                'asset', t.tableOccupancy[0]['asset_ref'])
             periods = sorted(occ.period for occ in occupancies)
         else:
             periods = []
@@ -407,29 +526,32 @@ class Exposure(Converter):
 
         :returns: an iterable over Node objects describing exposure assets
         """
-        # each asset contains the subnodes location, costs and occupancies
-        loc_dict = record.nodedict(self.tableset.tableLocation)
-        cost_dict = record.nodedict(self.tableset.tableCost)
-        occ_dict = record.nodedict(self.tableset.tableOccupancy)
+        # each asset contains the subnodes location, costs and occupancies;
+        # they are extracted with lookups on the primary keys
+        tset = self.tableset
         for asset in assets:
             ref = asset['asset_ref']
             nodes = []
-            location = loc_dict[(asset['location_id'],)]
-            nodes.append(location)
+            location = tset.tableLocation.getrecord(asset['location_id'])
+            nodes.append(location.to_node())
 
             costnodes = []
             for ctype in costtypes:
-                cost = cost_dict.get((ref, ctype))
-                if cost is not None:
-                    costnodes.append(cost)
+                try:
+                    cost = tset.tableCost.getrecord(ref, ctype)
+                except KeyError:
+                    continue
+                costnodes.append(cost.to_node())
             if costnodes:
                 nodes.append(Node('costs', {}, nodes=costnodes))
 
             occupancynodes = []
             for period in periods:
-                occupancy = occ_dict.get((ref, period))
-                if occupancy is not None:
-                    occupancynodes.append(occupancy)
+                try:
+                    occupancy = tset.tableOccupancy.getrecord(ref, period)
+                except KeyError:
+                    continue
+                occupancynodes.append(occupancy.to_node())
             if occupancynodes:
                 nodes.append(Node('occupancies', {}, nodes=occupancynodes))
 
@@ -442,15 +564,18 @@ class Exposure(Converter):
 
 class GmfCollection(Converter):
     """A converter for gmfSet/GmfCollection nodes"""
+    streamed = ('GmfData',)
+    streamed_tags = ('gmfCollection', 'gmfSet', 'gmf')
 
     @classmethod
     def node_to_records(cls, node):
         """
-        Convert the node into a sequence of Gmf records
+        Convert the node into a sequence of Gmf records. The subnodes
+        are read in order, so that the node can be lazy.
         """
         if node.tag == 'gmfSet':
             yield records.GmfSet('0', '')
-            for gmf in node.getnodes('gmf'):
+            for gmf in children(node, 'gmf'):
                 imt = gmf['IMT']
                 if imt == 'SA':
                     imt += '(%s)' % gmf['saPeriod']
@@ -462,10 +587,10 @@ class GmfCollection(Converter):
         yield records.GmfCollection(
             node['sourceModelTreePath'],
             node['gsimTreePath'])
-        for gmfset in node.getnodes('gmfSet'):
+        for gmfset in children(node, 'gmfSet'):
             ses_id = gmfset['stochasticEventSetId']
             yield records.GmfSet(ses_id, gmfset['investigationTime'])
-            for gmf in gmfset.getnodes('gmf'):
+            for gmf in children(gmfset, 'gmf'):
                 rup = gmf['ruptureId']
                 imt = gmf['IMT']
                 if imt == 'SA':
@@ -477,7 +602,8 @@ class GmfCollection(Converter):
 
     def _to_node(self):
         """
-        Add to a gmfset node all the data from a file GmfData.csv of the form::
+        Return the gmfSet nodes with all the data from a file GmfData.csv
+        of the form::
 
          stochasticEventSetId,imtStr,ruptureId,lon,lat,gmv
          1,SA(0.025),,0.0,0.0,0.2
@@ -491,32 +617,64 @@ class GmfCollection(Converter):
         """
         tset = self.tableset
         gmfset_node = record.nodedict(tset.tableGmfSet)
-        for (ses, imt, rupture), rows in groupby(
-                tset.tableGmfData,
-                ['stochasticEventSetId', 'imtStr', 'ruptureId']):
-            if imt.startswith('SA'):
-                attr = dict(IMT='SA', saPeriod=imt[3:-1], saDamping='5')
-            else:
-                attr = dict(IMT=imt)
-            if rupture:
-                attr['ruptureId'] = rupture
-            nodes = [records.GmfData(*r).to_node() for r in rows]
-            gmfset_node[(ses,)].append(Node('gmf', attr, nodes=nodes))
-        return gmfset_node
+        for (ses, imt, rupture), rows in tset.tableGmfData.groupby('gmf'):
+            gmfset_node[(ses,)].append(self._gmf_node(imt, rupture, rows))
+        return gmfset_node.values()
+
+    @staticmethod
+    def _gmf_node(imt, rupture, rows):
+        """Build a gmf node from the GmfData records of a rupture"""
+        if imt.startswith('SA'):
+            attr = dict(IMT='SA', saPeriod=imt[3:-1], saDamping='5')
+        else:
+            attr = dict(IMT=imt)
+        if rupture:
+            attr['ruptureId'] = rupture
+        return Node('gmf', attr, nodes=[r.to_node() for r in rows])
+
+    def _stream_gmfsets(self):
+        """
+        Yield the gmfSet nodes, in the order of the GmfSet table, with
+        the gmf nodes generated lazily while streaming the GmfData records,
+        which must be grouped by set in the same order.
+        """
+        sets = record.nodedict(self.tableset.tableGmfSet).items()
+        gmfs = ((ses, self._gmf_node(imt, rupture, rows))
+                for (ses, imt, rupture), rows in
+                self.tableset.tableGmfData.groupby('gmf'))
+        i = 0
+        for ses, pairs in itertools.groupby(gmfs, lambda pair: pair[0]):
+            while i < len(sets) and sets[i][0] != (ses,):
+                yield sets[i][1]  # a set without data
+                i += 1
+            if i == len(sets):
+                raise ValueError(
+                    'The GmfData records are not grouped by '
+                    'stochasticEventSetId in the order of the GmfSet '
+                    'table: found %s' % ses)
+            node = sets[i][1]
+            node.nodes = (gmf_node for _ses, gmf_node in pairs)
+            yield node
+            i += 1
+        for _key, node in sets[i:]:
+            yield node
 
     def to_node(self):
         """
         Build a gmfCollection node from GmfCollection.csv,
-        GmfSet.csv and GmfData.csv
+        GmfSet.csv and GmfData.csv. If GmfData is a
+        :class:`openquake.commonlib.record.StreamTable` the gmf nodes
+        are generated lazily.
         """
         tset = self.tableset
+        if isinstance(tset.tableGmfData, record.StreamTable):
+            gmfset_nodes = self._stream_gmfsets()
+        else:
+            gmfset_nodes = self._to_node()
         try:
             gmfcoll = tset.tableGmfCollection[0]
         except IndexError:  # no data for GmfCollection
-            gmfset_node = self._to_node()
-            return gmfset_node.values()[0]  # there is a single node
-        gmfset_node = self._to_node()
+            return iter(gmfset_nodes).next()  # there is a single node
         gmfcoll_node = gmfcoll.to_node()
-        for node in gmfset_node.values():
-            gmfcoll_node.append(node)
+        gmfcoll_node.nodes = gmfset_nodes
         return gmfcoll_node
@@ -17,17 +17,37 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import bz2
 import csv
+import json
+import zlib
+import time
+import shutil
 import inspect
+import logging
 import zipfile
+import itertools
 import StringIO
 import tempfile
+import collections
+import multiprocessing
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from backports import lzma
+except ImportError:  # the xz codec is optional
+    lzma = None
 
 from openquake.nrmllib import InvalidFile
 from openquake.nrmllib.node import node_to_nrml, node_from_nrml
-from openquake.commonlib.record import Table
-from openquake.commonlib import record, records, converter
+from openquake.commonlib.record import Table, ColumnTable, StreamTable
+from openquake.commonlib import record, records, converter, snapshot
+from openquake.commonlib.sqltable import SqlTableSet
+from openquake.commonlib.parallel import imap_unordered, map_reduce
+
+CHUNKSIZE = 4 * 1024 * 1024  # bytes of CSV validated by a single task
+CONVERTED = 'converted.json'  # manifest of the incremental conversions
 
 
 class FileWrapper(object):
@@ -71,6 +91,7 @@ class FileObject(FileWrapper):
         self.name = name
         self.bytestring = bytestring
         self.fileobj = StringIO.StringIO(bytestring)
+        self.mtime = time.time()
 
     def close(self):
         data = self.fileobj.getvalue()
@@ -78,6 +99,179 @@ class FileObject(FileWrapper):
         self.fileobj = StringIO.StringIO(data)
 
 
+def gzip_compress(data, level=6):
+    """Compress the data into a complete gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+# extension -> (compress function, decompressor factory); the compress
+# functions release the GIL, so that blocks can be compressed in threads
+CODECS = {
+    'gz': (gzip_compress, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    'bz2': (bz2.compress, bz2.BZ2Decompressor),
+}
+
+
+def xz_compress(data, level=6):
+    """Compress the data into a complete xz stream"""
+    return lzma.compress(data, preset=level)
+
+
+if lzma is not None:
+    CODECS['xz'] = (xz_compress, lzma.LZMADecompressor)
+
+
+def get_codec(fname):
+    """
+    Return the extension of the codec used for the given file name,
+    or None if the file is not compressed
+    """
+    ext = fname.rsplit('.', 1)[-1]
+    return ext if ext in CODECS else None
+
+
+class DecompressedFile(FileWrapper):
+    """
+    A file-like object reading a file compressed with one of the
+    CODECS, decompressed block by block. A file can contain several
+    concatenated streams, as the ones written by
+    :class:`CompressedFile`.
+    """
+    blocksize = 64 * 1024
+
+    def __init__(self, fileobj, codec):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.new_decompressor = CODECS[codec][1]
+        self.decompressor = self.new_decompressor()
+        self.lines = []  # the decompressed lines not yet read
+        self.lineno = 0  # the index of the next line to read
+        self.partial = ''  # the last decompressed line, if incomplete
+        self.eof = False
+
+    def _fill(self):
+        # decompress a block and split it in lines
+        raw = self.fileobj.read(self.blocksize)
+        data = []
+        while raw:
+            try:
+                data.append(self.decompressor.decompress(raw))
+            except EOFError:  # the stream is ended, a new one starts
+                self.decompressor = self.new_decompressor()
+                continue
+            raw = self.decompressor.unused_data
+            if raw:  # a new stream starts
+                self.decompressor = self.new_decompressor()
+        if not data:
+            self.eof = True
+        self._setlines(self.partial + ''.join(data))
+
+    def _setlines(self, data):
+        # split the data in lines, keeping apart the incomplete last line
+        lines = data.split('\n')
+        last = lines.pop()
+        self.lines = [line + '\n' for line in lines]
+        self.lineno = 0
+        if self.eof:
+            if last:  # the last line of the file has no newline
+                self.lines.append(last)
+            self.partial = ''
+        else:
+            self.partial = last
+
+    def next(self):
+        while self.lineno >= len(self.lines):
+            if self.eof:
+                raise StopIteration
+            self._fill()
+        line = self.lines[self.lineno]
+        self.lineno += 1
+        return line
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ''
+
+    def read(self, n=-1):
+        data = [''.join(self.lines[self.lineno:])]
+        size = len(data[0])
+        self.lines = []
+        while (n < 0 or size < n) and not self.eof:
+            self._fill()
+            data.append(''.join(self.lines))
+            size += len(data[-1])
+            self.lines = []
+        data = ''.join(data)
+        if n < 0 or size <= n:
+            return data
+        self._setlines(data[n:] + self.partial)  # the data not read
+        return data[:n]
+
+
+class CompressedFile(FileWrapper):
+    """
+    A file-like object writing a file compressed with one of the
+    CODECS. The data are split in blocks of `blocksize` bytes, which
+    are compressed as independent streams by `threads` threads and
+    written in order. If `level` is None the default level of the codec
+    is used, otherwise it is passed to the compress function (from 1,
+    fastest, to 9, smallest).
+    """
+    blocksize = 1024 * 1024
+    threads = multiprocessing.cpu_count()
+
+    def __init__(self, fileobj, codec, level=None):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.compress = CODECS[codec][0]
+        self.args = () if level is None else (level,)
+        self.executor = None  # started at the second block
+        self.pending = collections.deque()  # futures of compressed blocks
+        self.buf = []
+        self.buflen = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.blocksize:
+            self._compress_block()
+
+    def _compress_block(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buflen = 0
+        if self.threads <= 1:
+            self.fileobj.write(self.compress(data, *self.args))
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads)
+        self.pending.append(
+            self.executor.submit(self.compress, data, *self.args))
+        while len(self.pending) > 2 * self.threads:  # bound the memory
+            self.fileobj.write(self.pending.popleft().result())
+
+    def flush(self):
+        pass  # the blocks are compressed when full
+
+    def close(self):
+        if self.closed:  # already closed, do nothing
+            return
+        self.closed = True
+        if self.executor is None:  # at most one block, no threads needed
+            self.fileobj.write(self.compress(''.join(self.buf), *self.args))
+        else:
+            if self.buf:
+                self._compress_block()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.executor.shutdown()
+        self.fileobj.close()
+
+
 class NotInArchive(Exception):
     """Raised when trying to open a non-existing file in the archive"""
 
@@ -85,13 +279,20 @@ class NotInArchive(Exception):
 class Archive(object):
     """
     Abstract Base Class for Archive classes. Subclasses must override
-    the methods ``_open`` and ``extract_filenames``.
+    the methods ``_open`` and ``_scan``. The names, sizes and modification
+    times of the files are cached in an index, which is invalidated when
+    a file is opened for writing and when the archive is closed; if the
+    underlying files are changed by other means (for instance by other
+    processes) :meth:`refresh` must be called.
     """
     __metaclass__ = ABCMeta
 
     opened = []
+    _index = None
 
     def open(self, name, mode='r'):
+        if any(c in mode for c in 'wa+'):  # opened for writing
+            self._index = None
         f = self._open(name, mode)
         self.opened.add(f)
         return f
@@ -101,12 +302,44 @@ class Archive(object):
         pass
 
     @abstractmethod
+    def _scan(self):
+        """Return a dictionary name -> (size, mtime) for all the files"""
+
+    @property
+    def index(self):
+        """The cached dictionary name -> (size, mtime)"""
+        if self._index is None:
+            self._index = self._scan()
+        return self._index
+
+    def refresh(self):
+        """Invalidate the cached index"""
+        self._index = None
+
     def extract_filenames(self, prefix=''):
-        pass
+        """
+        Return the names of the files in the archive with the given prefix
+        """
+        return set(name for name in self.index if name.startswith(prefix))
+
+    def getsize(self, name):
+        """Return the size in bytes of the given file"""
+        try:
+            return self.index[name][0]
+        except KeyError:
+            raise NotInArchive(name)
+
+    def getmtime(self, name):
+        """Return the modification time of the given file, in seconds"""
+        try:
+            return self.index[name][1]
+        except KeyError:
+            raise NotInArchive(name)
 
     def close(self):
         for f in self.opened:
             f.close()
+        self._index = None
 
     def __enter__(self):
         return self
@@ -115,16 +348,12 @@ class Archive(object):
         self.close()
 
     def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, self.extract_filenames())
+        return '<%s %s>' % (self.__class__.__name__,
+                            sorted(self.extract_filenames()))
 
     def __contains__(self, name):
         """Check if a name is contained in the archive"""
-        try:
-            self.open(name, 'r').close()
-        except:
-            return False
-        else:
-            return True
+        return name in self.index
 
 
 # Writing directly to a zip archive is not possible because .writestr
@@ -153,29 +382,178 @@ class TempFile(FileWrapper):
         self.closed = True
 
 
+class ZipEntry(FileWrapper):
+    """
+    A file opened for writing in a ZipArchive. The data are compressed
+    as soon as they are written: if no other entry is being written,
+    directly in the zip file, otherwise in an anonymous temporary file,
+    whose compressed content is copied in the zip file when both this
+    entry and the one being written directly are closed. The data are
+    collected in blocks of `bufsize` bytes before being compressed,
+    since CSV files are written line by line.
+    """
+    bufsize = 64 * 1024
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+        self.zinfo = zinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+        zinfo.external_attr = 0644 << 16L
+        zinfo.compress_type = archive.zip.compression
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.compressor = zlib.compressobj(
+                archive.compresslevel, zlib.DEFLATED, -15)
+        else:
+            self.compressor = None
+        if archive.writing is None:  # write directly in the zip file
+            archive.writing = self
+            self.fileobj = fp = archive.zip.fp
+            zinfo.header_offset = fp.tell()
+            # the size is unknown, so space for the ZIP64 extra field
+            # is reserved in the header, which is rewritten at the end
+            fp.write(zinfo.FileHeader(zip64=True))
+        else:
+            self.fileobj = tempfile.TemporaryFile()
+        self.buf = []
+        self.buflen = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        """Compress and write the buffered data"""
+        if not self.buf:
+            return
+        data = ''.join(self.buf)
+        self.buf = []
+        self.buflen = 0
+        zinfo = self.zinfo
+        zinfo.file_size += len(data)
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+        if self.compressor:
+            data = self.compressor.compress(data)
+        zinfo.compress_size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        if self.closed:  # already closed, do nothing
+            return
+        self.flush()
+        self.closed = True
+        if self.compressor:
+            data = self.compressor.flush()
+            self.zinfo.compress_size += len(data)
+            self.fileobj.write(data)
+        archive = self.archive
+        if archive.writing is self:
+            fp = self.fileobj
+            end = fp.tell()
+            fp.seek(self.zinfo.header_offset)
+            fp.write(self.zinfo.FileHeader(zip64=True))
+            fp.seek(end)
+            self._register()
+            archive.writing = None
+            for entry in archive.pending:
+                entry._copy()
+            archive.pending = []
+        elif archive.writing is None:
+            self._copy()
+        else:  # wait for the end of the entry being written
+            archive.pending.append(self)
+
+    def _copy(self):
+        # copy the compressed data from the temporary file to the zip file
+        fp = self.archive.zip.fp
+        self.zinfo.header_offset = fp.tell()
+        fp.write(self.zinfo.FileHeader())
+        self.fileobj.seek(0)
+        shutil.copyfileobj(self.fileobj, fp)
+        self.fileobj.close()
+        self._register()
+
+    def _register(self):
+        # add the entry to the central directory, as ZipFile.write does
+        zipf = self.archive.zip
+        zipf.filelist.append(self.zinfo)
+        zipf.NameToInfo[self.name] = self.zinfo
+        zipf._didModify = True
+        zipf.fp.flush()  # so that the entry can be read immediately
+
+
 class ZipArchive(Archive):
     """
-    Thin wrapper over a ZipFile object.
+    Thin wrapper over a ZipFile object. If `compresslevel` is None the
+    files are stored without compression, otherwise they are deflated
+    with the given zlib level (from 1, fastest, to 9, smallest).
+    If `streaming` is true the files opened for writing are
+    :class:`ZipEntry` objects, compressed while written, otherwise
+    they are :class:`TempFile` objects, added to the archive (with the
+    default compression level) when closed.
     """
-    def __init__(self, zipname, mode='a'):
-        self.zip = zipfile.ZipFile(zipname, mode)
+    def __init__(self, zipname, mode='a', compresslevel=None,
+                 streaming=True):
+        if compresslevel is None:
+            compression = zipfile.ZIP_STORED
+        else:
+            compression = zipfile.ZIP_DEFLATED
+        self.zip = zipfile.ZipFile(zipname, mode, compression,
+                                   allowZip64=True)
         self.name = self.zip.filename
+        self.compresslevel = compresslevel
+        self.streaming = streaming
+        self.writing = None  # the ZipEntry being written directly
+        self.pending = []  # the closed ZipEntries waiting to be copied
         self.opened = set()
 
     def _open(self, name, mode):
         if mode in ('w', 'w+', 'r+'):
+            if self.streaming:
+                return ZipEntry(self, name)
             # write on a temporary file
             return TempFile(self.zip, name, mode)
         else:
             # open for reading
-            return self.zip.open(name, mode)
+            try:
+                return self.zip.open(name, mode)
+            except KeyError:
+                raise NotInArchive(name)
 
-    def extract_filenames(self, prefix=''):
+    def _scan(self):
+        return dict((i.filename, (i.file_size,
+                                  time.mktime(i.date_time + (0, 0, -1))))
+                    for i in self.zip.infolist())
+
+    def remove_duplicates(self):
         """
-        Return the file objects in the archive with the given prefix
+        Rewrite the archive keeping only the last entry with each name.
+        A ZipFile cannot replace an entry: a file written again is
+        appended as a new entry with the same name, which some readers
+        ignore. The entries keep their modification times.
         """
-        return set(i.filename for i in self.zip.infolist()
-                   if i.filename.startswith(prefix))
+        self.close()
+        infos = self.zip.infolist()
+        last = dict((info.filename, info) for info in infos)
+        if len(last) == len(infos):
+            return
+        tmpname = self.name + '.tmp'
+        out = ZipArchive(tmpname, 'w', self.compresslevel)
+        for info in infos:
+            if last[info.filename] is info:
+                with self.zip.open(info) as src, out.open(
+                        info.filename, 'w') as dest:
+                    dest.zinfo.date_time = info.date_time
+                    shutil.copyfileobj(src, dest)
+        out.zip.close()
+        compression = self.zip.compression
+        self.zip.close()
+        os.rename(tmpname, self.name)
+        self.zip = zipfile.ZipFile(self.name, 'a', compression,
+                                   allowZip64=True)
 
 
 class DirArchive(Archive):
@@ -192,13 +570,17 @@ class DirArchive(Archive):
         self.opened = set()
 
     def _open(self, name, mode):
-        return open(os.path.join(self.name, name), mode)
+        path = os.path.join(self.name, name)
+        if mode == 'r' and not os.path.exists(path):
+            raise NotInArchive(name)
+        return open(path, mode)
 
-    def extract_filenames(self, prefix=''):
-        """
-        Return the file objects in the archive with the given prefix
-        """
-        return [f for f in os.listdir(self.name) if f.startswith(prefix)]
+    def _scan(self):
+        index = {}
+        for fname in os.listdir(self.name):
+            st = os.stat(os.path.join(self.name, fname))
+            index[fname] = st.st_size, st.st_mtime
+        return index
 
 
 class MemArchive(Archive):
@@ -213,33 +595,206 @@ class MemArchive(Archive):
 
     def add(self, name, csvstr):
         self.dic[name] = FileObject(name, csvstr)
+        self._index = None
 
     def _open(self, name, mode='r'):
         if mode in ('w', 'w+', 'r+'):
             self.dic[name] = f = FileObject(name, '')
             return f
         try:
-            return self.dic[name]
+            f = self.dic[name]
         except KeyError:
             raise NotInArchive(name)
+        f.fileobj.seek(0)  # a reopened file is read from the start
+        return f
 
-    def extract_filenames(self, prefix=''):
-        """
-        Return the file objects in the archive with the given prefix
-        """
-        return [f for f in self.dic if f.startswith(prefix)]
+    def _scan(self):
+        return dict((name, (len(f.fileobj.getvalue()), f.mtime))
+                    for name, f in self.dic.iteritems())
 
 
-def mkarchive(pathname, mode):
+def mkarchive(pathname, mode, compresslevel=None):
     """
-    Return a ZipArchive or a DirArchive depending on the pathname extension
+    Return a ZipArchive or a DirArchive depending on the pathname extension;
+    the compression level is used only for zip archives
     """
     if pathname.endswith('.zip'):
-        return ZipArchive(pathname, mode)
+        return ZipArchive(pathname, mode, compresslevel)
     else:
         return DirArchive(pathname, mode)
 
 
+def check_header(fname, header, recordtype):
+    """
+    Raise an InvalidFile error if the header of the CSV file does not
+    correspond to the fields of the record type
+    """
+    if header != recordtype.fieldnames:
+        raise InvalidFile('%s: line 1: got %s as header, expected %s' %
+                          (fname, header, recordtype.fieldnames))
+
+
+def split_columns(data, numfields):
+    """
+    Split a string of CSV data into a list of columns of strings, one
+    for each field, without using the csv module. Return None if the data
+    contain quotes, carriage returns not followed by a newline or rows
+    with a number of fields different from `numfields`: such data must
+    be parsed with csv.reader.
+    """
+    if '"' in data:
+        return None
+    data = data.replace('\r\n', '\n')
+    if '\r' in data:
+        return None
+    if data and not data.endswith('\n'):
+        data += '\n'
+    tokens = data.replace('\n', ',\n,').split(',')
+    tokens.pop()  # the empty token after the last newline
+    ncols = numfields + 1
+    nrows = len(tokens) // ncols
+    if len(tokens) % ncols or tokens[numfields::ncols] != ['\n'] * nrows:
+        return None
+    return [tokens[i::ncols] for i in range(numfields)]
+
+
+def csv_columns(data, recordtype):
+    """
+    Parse a string of CSV data into a list of columns of strings, one for
+    each field of the record type, with the same values of the records
+    built from csv.reader, which is used when :func:`split_columns`
+    cannot parse the data.
+    """
+    numfields = len(recordtype.fields)
+    columns = split_columns(data, numfields)
+    if columns is None:
+        rows = [recordtype(*row).row
+                for row in csv.reader(StringIO.StringIO(data))]
+        columns = map(list, zip(*rows)) or [[] for _ in range(numfields)]
+    return columns
+
+
+def split_chunks(fileobj, chunksize):
+    """
+    Yield strings of about `chunksize` bytes read from the file object,
+    each one ending on a line boundary.
+    """
+    while True:
+        data = fileobj.read(chunksize)
+        if not data:
+            break
+        if not data.endswith('\n'):
+            data += fileobj.readline()
+        yield data
+
+
+def byte_ranges(path, start, chunksize):
+    """
+    Yield pairs (start, stop) of byte offsets splitting the file from
+    `start` in chunks of about `chunksize` bytes, each one ending on a
+    line boundary. The file is not read, except for the lines crossing
+    the boundaries.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(start + chunksize - 1)
+            f.readline()
+            stop = min(f.tell(), size)
+            yield start, stop
+            start = stop
+
+
+def validate_chunk(chunkno, recordtype, chunk):
+    """
+    Validate a chunk of a CSV file, given either as a string or as a
+    triple (path, start, stop). Return the chunk number, the number of
+    rows in the chunk and the InvalidRecord exceptions found, with the
+    row numbers relative to the beginning of the chunk.
+    """
+    if isinstance(chunk, tuple):
+        path, start, stop = chunk
+        with open(path, 'rb') as f:
+            f.seek(start)
+            chunk = f.read(stop - start)
+    columns = csv_columns(chunk, recordtype)
+    return chunkno, len(columns[0]), list(
+        record.find_invalid_columns(recordtype, columns))
+
+
+def convert_prefix(convertertype, archive, prefix, outdir, tmpdb, streaming):
+    """
+    Convert the CSV files with the given prefix into NRML in a worker
+    process (see :meth:`CSVManager.convert_to_nrml`). The input archive
+    is a DirArchive or a MemArchive with the files of the prefix. If
+    `outdir` is not None the XML file is written in that directory,
+    otherwise its content is returned. Return a tuple
+    (prefix, outname, data, seconds).
+    """
+    t0 = time.time()
+    man = CSVManager(archive, prefix)
+    man.convertertype = convertertype
+    if outdir is None:
+        out_archive = MemArchive([])
+        outname = man._convert_to_nrml(out_archive, tmpdb, streaming)
+        data = out_archive.dic[outname].fileobj.getvalue()
+    else:
+        outname = man._convert_to_nrml(DirArchive(outdir), tmpdb, streaming)
+        data = None
+    return prefix, outname, data, time.time() - t0
+
+
+def read_converted(archive):
+    """
+    Return the manifest of the incremental conversions stored in the
+    archive, as a dictionary prefix -> entry, or an empty dictionary
+    if there is no valid manifest (see
+    :meth:`CSVManager.convert_to_nrml`)
+    """
+    try:
+        with archive.open(CONVERTED, 'r') as f:
+            return json.load(f)
+    except (NotInArchive, ValueError):
+        return {}
+
+
+def write_converted(archive, manifest):
+    """
+    Store the manifest of the incremental conversions in the archive
+    """
+    with archive.open(CONVERTED, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def _file_infos(archive, fnames, old=None, verify=False):
+    """
+    Return a dictionary fname -> dict(size=..., mtime=..., sha1=...)
+    describing the given files in the archive. The hashes in `old`, a
+    dictionary in the same format, are reused for the files with the
+    same size and modification time, unless `verify` is true.
+    """
+    old = old or {}
+    infos = {}
+    for fname in fnames:
+        size = archive.getsize(fname)
+        mtime = archive.getmtime(fname)
+        info = old.get(fname)
+        if verify or info is None or (
+                [info['size'], info['mtime']] != [size, mtime]):
+            info = dict(size=size, mtime=mtime,
+                        sha1=snapshot.file_hash(archive, fname))
+        infos[fname] = info
+    return infos
+
+
+def _hashes(files):
+    """
+    Extract the dictionary fname -> hash from a dictionary
+    fname -> file information of a manifest entry
+    """
+    return dict((fname, info['sha1']) for fname, info in files.iteritems())
+
+
 # used in the tests
 def create_table(recordtype, csvstr):
     """
@@ -282,13 +837,23 @@ class CSVManager(object):
     the CSV files by calling
 
     CSVManager(archive).convert_from_nrml()
+
+    The CSV files can also be compressed with one of the CODECS, with
+    names of the form <prefix>__<recordtype>.csv.gz: they are found and
+    decompressed transparently when reading; when writing they are
+    compressed if `compression` is the extension of a codec, with the
+    given `compresslevel` (None means the default level of the codec).
     """
     convertertype = converter.Converter
 
-    def __init__(self, archive, prefix='', has_header=True):
+    def __init__(self, archive, prefix='', has_header=True,
+                 compression=None, compresslevel=None):
+        assert compression is None or compression in CODECS, compression
         self.archive = archive
         self.prefix = prefix
         self.has_header = has_header
+        self.compression = compression
+        self.compresslevel = compresslevel
         self.rt2reader = {}
         self.rt2writer = {}
         self.rt2file = {}
@@ -309,6 +874,9 @@ class CSVManager(object):
                 prefix, recordcsv = fname.split('__')
             except ValueError:
                 continue
+            codec = get_codec(recordcsv)
+            if codec:
+                recordcsv = recordcsv[:-len(codec) - 1]
             if not recordcsv.endswith('.csv'):
                 continue
             recordtype = getattr(records, recordcsv[:-4], None)
@@ -320,14 +888,27 @@ class CSVManager(object):
                 managers[prefix] = man
         return managers.values()
 
+    def _selected_managers(self, prefixes):
+        """
+        Return the managers with the given prefixes, or all of them if
+        `prefixes` is None
+        """
+        managers = self._getmanagers()
+        if prefixes is None:
+            return managers
+        return [man for man in managers if man.prefix in prefixes]
+
     def _getconverter(self):
         """
         Extract the appropriate converter class to convert the files in
         the underlying archive. Raise an error is no converter is
         found (this happens if there are no files following the
-        naming conventions).
+        naming conventions). If the manager has a prefix, only the
+        files with that prefix are considered.
         """
         managers = self._getmanagers()
+        if self.prefix:
+            managers = [man for man in managers if man.prefix == self.prefix]
         if not managers:
             raise NotInArchive(
                 'Could not determine the right manager '
@@ -338,19 +919,128 @@ class CSVManager(object):
                 (len(managers), managers))
         return managers[0].convertertype
 
-    def get_tableset(self):
+    def get_tableset(self, tabletype=Table, dbname=None):
         """
         Return a populated TableSet from the underlying CSV files
+
+        :param tabletype: :class:`Table` or :class:`ColumnTable`
+        :param dbname:
+            if not None, return a
+            :class:`openquake.commonlib.sqltable.SqlTableSet` stored in
+            the given SQLite database (':memory:' for an in-memory one);
+            in that case `tabletype` is ignored
+
+        If the archive is a directory containing an up-to-date snapshot
+        (see :meth:`save_snapshot`) the tables are loaded from it.
+        ColumnTables of record types without foreign keys are filled
+        by reading the CSV files in columns (see :meth:`read_columns`).
         """
-        tset = record.TableSet(self._getconverter())
+        if dbname is None:
+            tset = self._load_snapshot(tabletype)
+            if tset is not None:
+                return tset
+            tset = record.TableSet(self._getconverter(), tabletype=tabletype)
+        else:
+            tset = SqlTableSet(self._getconverter(), dbname=dbname)
         for rectype in tset.convertertype.recordtypes():
             try:
-                tset.insert_all(self.read(rectype))
+                if isinstance(tset, record.TableSet) and issubclass(
+                        tabletype, ColumnTable) and not (
+                        rectype.get_descriptors(record.ForeignKey)):
+                    tbl = getattr(tset, 'table' + rectype.__name__)
+                    for columns in self.read_columns(rectype):
+                        tbl.extend_columns(columns)
+                else:
+                    tset.insert_all(self.read(rectype))
             except NotInArchive:
                 # this may happen for optional tables in the tableset
                 continue
         return tset
 
+    def get_stream_tableset(self, tabletype=Table):
+        """
+        Return a TableSet where the tables of the record types listed in
+        the `streamed` attribute of the converter are
+        :class:`openquake.commonlib.record.StreamTable` objects reading
+        the CSV files on demand, while the other tables are populated as
+        in :meth:`get_tableset`. The returned
+        :class:`openquake.commonlib.record.StreamTableSet` can be converted
+        only once.
+
+        :param tabletype: :class:`Table` or :class:`ColumnTable`
+        """
+        convertertype = self._getconverter()
+        streams = {}
+        for rectype in convertertype.recordtypes():
+            if rectype.__name__ in convertertype.streamed:
+                fname = self.csvname(rectype)
+                streams[rectype.__name__] = (
+                    self.read(rectype) if fname in self.archive else [])
+        tset = record.StreamTableSet(convertertype, streams, tabletype)
+        for tbl in tset.tables:
+            if isinstance(tbl, StreamTable):
+                continue
+            try:
+                tset.insert_all(self.read(tbl.recordtype))
+            except NotInArchive:
+                # this may happen for optional tables in the tableset
+                continue
+        return tset
+
+    def _csvfiles(self, convertertype):
+        """
+        Return the names of the CSV files in the archive associated to
+        the given converter
+        """
+        fnames = [self.csvname(rt) for rt in convertertype.recordtypes()]
+        return [fname for fname in fnames if fname in self.archive]
+
+    def _snapshot_dir(self):
+        """
+        Return the directory of the snapshot of the underlying CSV files,
+        or None if the archive is not a directory
+        """
+        if isinstance(self.archive, DirArchive):
+            return os.path.join(self.archive.name, self.prefix + '.snapshot')
+
+    def _load_snapshot(self, tabletype):
+        """
+        Return the TableSet stored in the snapshot, or None if there is
+        no snapshot, if it was saved with different record types or if
+        it is not up to date with the CSV files. As for the incremental
+        conversions, only the files whose size or modification time
+        changed are hashed again.
+        """
+        dirname = self._snapshot_dir()
+        manifest = dirname and snapshot.read_manifest(dirname)
+        if not manifest or 'inputs' not in manifest:
+            return None
+        convertertype = self._getconverter()
+        if manifest['converter'] != convertertype.__name__ or (
+                manifest.get('schema') != snapshot.schema(convertertype)):
+            return None
+        inputs = _file_infos(self.archive, self._csvfiles(convertertype),
+                             manifest['inputs'])
+        if _hashes(inputs) != _hashes(manifest['inputs']):
+            return None
+        return snapshot.load(convertertype, dirname, tabletype)
+
+    def save_snapshot(self):
+        """
+        Save a binary snapshot of the TableSet read from the CSV files,
+        which will be used by :meth:`get_tableset` until the CSV files
+        change. It works only for directory archives. Return the
+        directory of the snapshot.
+        """
+        dirname = self._snapshot_dir()
+        if dirname is None:
+            raise TypeError('Snapshots can be saved only for directory '
+                            'archives, got %s' % self.archive)
+        tset = self.get_tableset(ColumnTable)
+        fnames = self._csvfiles(tset.convertertype)
+        snapshot.save(tset, dirname, _file_infos(self.archive, fnames))
+        return dirname
+
     def convert_to_node(self):
         """
         Convert the CSV files in the archive with the given prefix
@@ -358,98 +1048,441 @@ class CSVManager(object):
         """
         return self.get_tableset().to_node()
 
-    def convert_to_nrml(self, out_archive=None):
+    def convert_to_nrml(self, out_archive=None, tmpdb=False, streaming=False,
+                        parallel=False, incremental=False, verify=False,
+                        changes=None):
         """
         From CSV files with the given prefix to .xml files; if the output
         directory is not specified, use the input archive to store the output.
+        If `tmpdb` is true, the records are stored in a temporary SQLite
+        database on disk, so that it is possible to convert files larger
+        than the available memory. If `streaming` is true, the records
+        of the largest tables are not stored at all: they are read from
+        the CSV files while writing the XML (see
+        :meth:`get_stream_tableset`); it requires the records to be in
+        the order of the output, as in the files written by
+        :meth:`convert_from_nrml`. If `parallel` is true, each prefix
+        is converted in a different worker process (see
+        :meth:`_convert_parallel`). The time spent for each file is
+        logged.
+
+        If `incremental` is true, the output archive keeps a manifest
+        (see :data:`CONVERTED`) with the hashes of the CSV files and of
+        the .xml file of each prefix, and the prefixes whose CSV files
+        did not change since the previous conversion are skipped. The
+        hashes in the manifest are trusted for the files with the same
+        size and modification time, and the .xml files are only required
+        to have the recorded size; if `verify` is true all the files are
+        hashed again. If the `changes` returned by :meth:`find_changed`
+        are passed, the files are not compared again. A zip output
+        archive is rewritten at the end, to remove the old entries of
+        the files written again.
+        """
+        managers = self._getmanagers()
+        if incremental:
+            return self._convert_incremental(
+                managers, out_archive or self.archive, tmpdb, streaming,
+                parallel, verify, changes)
+        return self._convert_all(
+            managers, out_archive, tmpdb, streaming, parallel)
+
+    def _convert_all(self, managers, out_archive, tmpdb, streaming, parallel):
+        """
+        Convert the files of the given managers and return the names of
+        the .xml files
         """
+        if parallel:
+            return self._convert_parallel(
+                managers, out_archive, tmpdb, streaming)
         fnames = []
+        for man in managers:
+            t0 = time.time()
+            fnames.append(man._convert_to_nrml(
+                out_archive or man.archive, tmpdb, streaming))
+            logging.info('Converted %s in %.2f s', fnames[-1],
+                         time.time() - t0)
+        return fnames
+
+    def _convert_incremental(self, managers, out_archive, tmpdb, streaming,
+                             parallel, verify, changes=None):
+        """
+        Convert the files of the managers which changed since the last
+        conversion recorded in the manifest of the output archive, then
+        update the manifest. Return the names of all the .xml files,
+        converted or not.
+        """
+        manifest, changed = changes or self.find_changed(out_archive, verify)
+        outnames = {}  # prefix -> name of the .xml file
+        todo = []
+        for man in managers:
+            if man.prefix in changed:
+                todo.append(man)
+            else:
+                outnames[man.prefix] = manifest[man.prefix]['outname']
+                logging.info('Skipped %s, unchanged', outnames[man.prefix])
+        converted = self._convert_all(
+            todo, out_archive, tmpdb, streaming, parallel)
+        for man, outname in zip(todo, converted):
+            name = man.prefix + '.xml'
+            manifest[man.prefix].update(outname=outname, output=dict(
+                name=name, size=out_archive.getsize(name),
+                sha1=snapshot.file_hash(out_archive, name)))
+            outnames[man.prefix] = outname
+        if manifest != read_converted(out_archive):
+            write_converted(out_archive, manifest)
+        if isinstance(out_archive, ZipArchive):
+            out_archive.remove_duplicates()
+        return [outnames[man.prefix] for man in managers]
+
+    def find_changed(self, out_archive=None, verify=False):
+        """
+        Compare the CSV files with the manifest of the incremental
+        conversions in the output archive. Return a pair (manifest,
+        prefixes) where the manifest is updated with the current
+        information about the CSV files and `prefixes` is the sorted list
+        of the prefixes which :meth:`convert_to_nrml` would convert with
+        `incremental=True`. The pair can be passed to it as `changes`.
+        """
+        out_archive = out_archive or self.archive
+        manifest = read_converted(out_archive)
+        changed = []
         for man in self._getmanagers():
-            with man:
-                outname = man.prefix + '.xml'
-                if out_archive is None:
-                    out = man.archive.open(outname, 'w+')
+            entry = manifest.get(man.prefix)
+            inputs = man._inputs(entry, verify)
+            if man._is_converted(entry, inputs, out_archive, verify):
+                entry['inputs'] = inputs  # the modification times may change
+            else:
+                changed.append(man.prefix)
+                manifest[man.prefix] = dict(
+                    converter=man.convertertype.__name__, inputs=inputs)
+        return manifest, sorted(changed)
+
+    def _inputs(self, entry, verify):
+        """
+        Return a dictionary fname -> dict(size=..., mtime=..., sha1=...)
+        describing the CSV files of the manager. The hashes in the given
+        manifest entry are reused for the files with the same size and
+        modification time, unless `verify` is true.
+        """
+        return _file_infos(self.archive, self._csvfiles(self.convertertype),
+                           entry['inputs'] if entry else None, verify)
+
+    def _is_converted(self, entry, inputs, out_archive, verify):
+        """
+        Return True if the manifest entry records a conversion of the
+        given CSV files whose .xml file is still in the output archive,
+        with the recorded size or, if `verify` is true, hash
+        """
+        if not entry or 'output' not in entry or (
+                entry['converter'] != self.convertertype.__name__ or
+                _hashes(entry['inputs']) != _hashes(inputs)):
+            return False
+        output = entry['output']
+        try:
+            if verify:
+                return snapshot.file_hash(
+                    out_archive, output['name']) == output['sha1']
+            return out_archive.getsize(output['name']) == output['size']
+        except NotInArchive:
+            return False
+
+    def _convert_to_nrml(self, out_archive, tmpdb, streaming):
+        """
+        Convert the CSV files of the manager into an .xml file in the
+        given archive and return its name
+        """
+        with self:
+            out = out_archive.open(self.prefix + '.xml', 'w+')
+            with out:
+                if tmpdb:
+                    self._convert_with_tmpdb(out)
+                elif streaming:
+                    node_to_nrml(self.get_stream_tableset().to_node(), out)
                 else:
-                    out = out_archive.open(outname, 'w+')
-                with out:
-                    node = man.get_tableset().to_node()
-                    node_to_nrml(node, out)
-                fnames.append(out.name)
-        return fnames
+                    node_to_nrml(self.get_tableset().to_node(), out)
+        return out.name
 
-    def convert_from_nrml(self, fname):
+    def _convert_parallel(self, managers, out_archive, tmpdb, streaming):
+        """
+        Convert the prefixes with :func:`convert_prefix` in the process
+        pool, the largest first, and return the names of the .xml files
+        in the same order as in the sequential case. Directory archives
+        are read and written directly by the workers; the files of other
+        archives are sent to the workers and the XML files are sent back,
+        to be stored in the archive by the current process.
+        """
+        out_archive = out_archive or self.archive
+        if isinstance(out_archive, DirArchive):
+            outdir = out_archive.name
+        else:
+            outdir = None
+        args = []
+        for man in managers:
+            fnames = sorted(self.archive.extract_filenames(man.prefix + '__'))
+            if isinstance(self.archive, DirArchive):
+                archive = DirArchive(self.archive.name)
+                size = sum(self.archive.getsize(f) for f in fnames)
+            else:
+                items = []
+                for fname in fnames:
+                    with self.archive.open(fname, 'r') as f:
+                        items.append((fname, f.read()))
+                archive = MemArchive(items)
+                size = sum(len(data) for _, data in items)
+            args.append((size, (man.convertertype, archive, man.prefix,
+                                outdir, tmpdb, streaming)))
+        args.sort(key=lambda arg: arg[0], reverse=True)
+
+        def agg(acc, res):
+            prefix, outname, data, seconds = res
+            if data is not None:
+                with out_archive.open(outname, 'w+') as out:
+                    out.write(data)
+                outname = out.name
+            logging.info('Converted %s in %.2f s', outname, seconds)
+            acc[prefix] = outname
+            return acc
+        outnames = map_reduce(convert_prefix, [arg for _, arg in args],
+                              agg, {})
+        if outdir is not None:  # the workers have written in the directory
+            out_archive.refresh()
+        return [outnames[man.prefix] for man in managers]
+
+    def _convert_with_tmpdb(self, out):
+        """
+        Convert the CSV files into NRML by using a temporary SQLite
+        database, removed at the end
+        """
+        fd, dbname = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            tset = self.get_tableset(dbname=dbname)
+            try:
+                node_to_nrml(tset.to_node(), out)
+            finally:
+                tset.close()
+        finally:
+            os.remove(dbname)
+
+    def convert_from_nrml(self, fname, streaming=False):
         """
         Populate the underlying archive with CSV files extracted from the
-        given XML file.
+        given XML file. If `streaming` is true, the file is parsed
+        incrementally and the records are written as soon as they are
+        extracted, so that the memory occupation does not depend on the
+        size of the file; in that case the file is not validated.
         """
         assert fname.endswith('.xml'), fname
         prefix = os.path.basename(fname)[:-4]
+        if streaming:
+            return self.convert_from_node(
+                converter.lazy_node_from_nrml(fname), prefix, validate=False)
         return self.convert_from_node(node_from_nrml(fname)[0], prefix)
 
-    def convert_from_node(self, node, prefix=None):
+    def convert_from_node(self, node, prefix=None, validate=True):
         """
         Populate the underlying archive with CSV files extracted from the
         given Node object. If the prefix is not None, instantiate a new
         manager object associated to the same archive and return it.
+        If `validate` is false, the records are not collected in a
+        TableSet and the constraints are not checked: this is required
+        for lazy nodes, which can be iterated only once.
         """
         if prefix is None:
             man = self
         else:  # creates a new CSVManager for the given prefix
-            man = self.__class__(self.archive, prefix)
-        convtype = converter.Converter.from_node(node)
+            man = self.__class__(self.archive, prefix,
+                                 compression=self.compression,
+                                 compresslevel=self.compresslevel)
+        if validate:
+            convtype = converter.Converter.from_node(node)
+        else:
+            convtype = converter.Converter.get_type(node)
         with man:
             for rec in convtype.node_to_records(node):
                 man.write(rec)  # automatically opens the needed files
         return man
 
+    def csvname(self, recordtype):
+        """
+        Return the name of the CSV file for the given record type: the
+        name of a compressed file if there is one in the archive and not
+        an uncompressed one, otherwise <prefix>__<recordtype>.csv
+        """
+        fname = '%s__%s.csv' % (self.prefix, recordtype.__name__)
+        if fname not in self.archive:
+            for codec in sorted(CODECS):
+                if '%s.%s' % (fname, codec) in self.archive:
+                    return '%s.%s' % (fname, codec)
+        return fname
+
+    def open_csv(self, fname, mode='r'):
+        """
+        Open a CSV file in the archive, decompressing or compressing it
+        if its name has the extension of a codec
+        """
+        f = self.archive.open(fname, mode)
+        codec = get_codec(fname)
+        if codec is None:
+            return f
+        elif mode == 'r':
+            return DecompressedFile(f, codec)
+        return CompressedFile(f, codec, self.compresslevel)
+
     def read(self, recordtype):
         """
         Read the records from the underlying CSV file. Returns an iterator.
         """
         reader = self.rt2reader.get(recordtype)
         if reader is None:
-            fname = '%s__%s.csv' % (self.prefix, recordtype.__name__)
-            self.rt2file[recordtype] = f = self.archive.open(fname, 'r')
+            fname = self.csvname(recordtype)
+            self.rt2file[recordtype] = f = self.open_csv(fname)
             self.rt2reader[recordtype] = reader = csv.reader(f)
             if self.has_header:
-                header = reader.next()
-                if header != recordtype.fieldnames:
-                    raise InvalidFile(
-                        '%s: line 1: got %s as header, expected %s' %
-                        (fname, header, recordtype.fieldnames))
+                check_header(fname, reader.next(), recordtype)
         for row in reader:
             yield recordtype(*row)
 
-    def readtable(self, recordtype):
+    def read_columns(self, recordtype, chunksize=CHUNKSIZE):
         """
-        Generate a Table object from the underlying CSV
+        Read the underlying CSV file in chunks of about `chunksize` bytes
+        and yield for each chunk a list of columns of strings, one for
+        each field, without building the records.
         """
-        return Table(recordtype, list(self.read(recordtype)))
+        fname = self.csvname(recordtype)
+        with self.open_csv(fname) as f:
+            if self.has_header:
+                line = f.readline()
+                if not line:  # empty file
+                    return
+                check_header(fname, csv.reader([line]).next(), recordtype)
+            for data in split_chunks(f, chunksize):
+                yield csv_columns(data, recordtype)
+
+    def readtable(self, recordtype, tabletype=Table):
+        """
+        Generate a Table object from the underlying CSV. ColumnTables
+        are filled by reading the file in columns, so that the numeric
+        fields are cast in batch.
 
-    def find_invalid(self, limit=None):
+        :param tabletype: :class:`Table` or :class:`ColumnTable`
         """
-        Yield the InvalidRecord exceptions found in the CSV files.
+        if issubclass(tabletype, ColumnTable):
+            tbl = tabletype(recordtype, [])
+            for columns in self.read_columns(recordtype):
+                tbl.extend_columns(columns)
+            return tbl
+        return tabletype(recordtype, self.read(recordtype))
+
+    def find_invalid(self, limit=None, parallel=False, chunksize=CHUNKSIZE,
+                     prefixes=None):
+        """
+        Return the InvalidRecord exceptions found in the CSV files.
         If limit=1, the search stops at the first exception found.
 
         :param limit:
 
            the maximum number of exceptions to retrieve;
            if None, all the exceptions are retrieved.
+        :param parallel:
+
+           if True, the files are split in chunks of about `chunksize`
+           bytes which are validated in the process pool; the result
+           is the same as in the sequential case.
+        :param prefixes:
+
+           if not None, only the files with the given prefixes are
+           validated (see :meth:`find_changed`)
         """
-        it = self._find_invalid()
+        if parallel:
+            it = self._find_invalid_parallel(chunksize, prefixes)
+        else:
+            it = self._find_invalid(prefixes)
         if limit is None:
             return list(it)  # return all
-        return [e for i, e in zip(range(limit), it)]
+        invalid = list(itertools.islice(it, limit))
+        it.close()  # cancel the outstanding tasks, if any
+        return invalid
 
-    def _find_invalid(self):
-        for man in self._getmanagers():
+    def _find_invalid(self, prefixes=None):
+        for man in self._selected_managers(prefixes):
             for recordtype in man.convertertype.recordtypes():
-                fname = '%s__%s.csv' % (man.prefix, recordtype.__name__)
+                fname = man.csvname(recordtype)
                 if fname in self.archive:
-                    recorditer = man.read(recordtype)
-                    for invalid in record.find_invalid(recorditer):
-                        invalid.fname = fname
-                        yield invalid
+                    rowno = 0  # number of rows in the previous chunks
+                    for columns in man.read_columns(recordtype):
+                        for invalid in record.find_invalid_columns(
+                                recordtype, columns):
+                            invalid.fname = fname
+                            invalid.rowno += rowno
+                            yield invalid
+                        rowno += len(columns[0])
+
+    def _chunks(self, chunksize, prefixes=None):
+        """
+        Yield triples (fname, recordtype, chunk) for the CSV files in the
+        archive, in the same order used by :meth:`_find_invalid`. For
+        directory archives the chunks are byte ranges read directly by
+        the workers, otherwise they are strings.
+        """
+        for man in self._selected_managers(prefixes):
+            for recordtype in man.convertertype.recordtypes():
+                fname = man.csvname(recordtype)
+                if fname not in self.archive:
+                    continue
+                with self.open_csv(fname) as f:
+                    start = 0
+                    if self.has_header:
+                        line = f.readline()
+                        if not line:  # empty file
+                            continue
+                        start = len(line)
+                        check_header(fname, csv.reader([line]).next(),
+                                     recordtype)
+                    if isinstance(self.archive, DirArchive) and not (
+                            get_codec(fname)):
+                        path = os.path.join(self.archive.name, fname)
+                        for start, stop in byte_ranges(
+                                path, start, chunksize):
+                            yield fname, recordtype, (path, start, stop)
+                    else:
+                        for data in split_chunks(f, chunksize):
+                            yield fname, recordtype, data
+
+    def _find_invalid_parallel(self, chunksize, prefixes=None):
+        """
+        Validate the chunks in parallel and yield the InvalidRecord
+        exceptions in file order, with the right file names and row
+        numbers. The results of the chunks are buffered until all the
+        previous chunks have been validated.
+        """
+        fnames = []  # file name of each chunk
+
+        def args():
+            for chunkno, (fname, rt, chunk) in enumerate(
+                    self._chunks(chunksize, prefixes)):
+                fnames.append(fname)
+                yield chunkno, rt, chunk
+        results = imap_unordered(validate_chunk, args())
+        done = {}  # chunkno -> (nrows, invalid)
+        nextno = 0  # the next chunk to process
+        rowno = 0  # number of rows before the next chunk in its file
+        try:
+            for chunkno, nrows, invalid in results:
+                done[chunkno] = nrows, invalid
+                while nextno in done:
+                    nrows, invalid = done.pop(nextno)
+                    fname = fnames[nextno]
+                    if nextno and fname != fnames[nextno - 1]:
+                        rowno = 0
+                    for exc in invalid:
+                        exc.fname = fname
+                        exc.rowno += rowno
+                        yield exc
+                    rowno += nrows
+                    nextno += 1
+        finally:
+            results.close()
 
     def write(self, record):
         """
@@ -459,7 +1492,9 @@ class CSVManager(object):
         writer = self.rt2writer.get(rt)
         if writer is None:
             fname = '%s__%s.csv' % (self.prefix, rt.__name__)
-            self.rt2file[rt] = f = self.archive.open(fname, 'w')
+            if self.compression:
+                fname += '.' + self.compression
+            self.rt2file[rt] = f = self.open_csv(fname, 'w')
             self.rt2writer[rt] = writer = csv.writer(f)
             if self.has_header:
                 writer.writerow(rt.fieldnames)
@@ -474,7 +1509,9 @@ class CSVManager(object):
         return self
 
     def __exit__(self, etype, exc, tb):
-        """Close the underlying archive"""
+        """Close the CSV files and the underlying archive"""
+        for f in self.rt2file.values():
+            f.close()  # flush the compressed files
         self.archive.close()
 
     def __str__(self):
@@ -154,7 +154,10 @@ def block_splitter(items, max_weight, weight=lambda item: 1,
                    kind=lambda item: 'Unspecified'):
     """
     :param items: an iterator over items
-    :param max_weight: the max weight to split on
+    :param max_weight:
+        the max weight to split on, or a callable without arguments
+        returning it; the callable is called at the beginning of each
+        block, so that the size of the blocks can change while iterating
     :param weight: a function returning the weigth of a given item
     :param kind: a function returning the kind of a given item
 
@@ -170,8 +173,11 @@ def block_splitter(items, max_weight, weight=lambda item: 1,
 
     The default weight is 1 for all items.
     """
-    if max_weight <= 0:
-        raise ValueError('max_weight=%s' % max_weight)
+    get_max_weight = max_weight if callable(max_weight) else (
+        lambda: max_weight)
+    limit = get_max_weight()
+    if limit <= 0:
+        raise ValueError('max_weight=%s' % limit)
     ws = WeightedSequence([])
     prev_kind = 'Unspecified'
     for item in items:
@@ -182,10 +188,13 @@ def block_splitter(items, max_weight, weight=lambda item: 1,
                              (item, w))
         elif w == 0:  # ignore items with 0 weight
             pass
-        elif ws.weight + w > max_weight or k != prev_kind:
+        elif ws.weight + w > limit or k != prev_kind:
             new_ws = WeightedSequence([(item, w)])
             if ws:
                 yield ws
+                limit = get_max_weight()
+                if limit <= 0:
+                    raise ValueError('max_weight=%s' % limit)
             ws = new_ws
         else:
             ws.append((item, w))
@@ -35,21 +35,235 @@ print map_reduce(sum_all, [(1, 2, 3), (4, 5), (6,)], operator.add, 0)
 
 import os
 import sys
+import glob
+import Queue
 import cPickle
+import itertools
 import logging
 import traceback
 import time
+import multiprocessing
 from datetime import datetime
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import (
+    as_completed, wait, ProcessPoolExecutor, CancelledError, FIRST_COMPLETED)
 
 import psutil
 
 
-executor = ProcessPoolExecutor()
+def get_num_workers():
+    """
+    The number of worker processes in the pool, as specified by the
+    variable OQ_NUM_WORKERS; if not set, the number of CPUs is used.
+    """
+    return int(os.environ.get('OQ_NUM_WORKERS') or multiprocessing.cpu_count())
+
+
+AFFINITY_POLICIES = ('none', 'core', 'numa')
+
+
+def get_affinity():
+    """
+    The policy used to pin the worker processes of the pool, as specified
+    by the variable OQ_CPU_AFFINITY:
+
+    - 'none' (the default): the workers are not pinned
+    - 'core': each worker is pinned to a single core; consecutive workers
+      are placed on different NUMA nodes, to use all the memory channels
+    - 'numa': each worker is pinned to all the cores of a NUMA node,
+      in round-robin order
+
+    Only the CPUs of the workers are set: no memory policy is applied.
+    With the default first-touch policy of Linux, the pages allocated by
+    a worker after it has been pinned (for instance when unpickling the
+    arguments of its tasks) usually end up on its node, but this is not
+    enforced. The pages inherited from the parent at fork time, such as
+    data broadcast before the pool starts, stay on the node where the
+    parent allocated them, and the pages the worker touched before
+    being pinned may be on another node too.
+    """
+    affinity = os.environ.get('OQ_CPU_AFFINITY', '').lower() or 'none'
+    if affinity not in AFFINITY_POLICIES:
+        raise ValueError('Invalid OQ_CPU_AFFINITY=%s, expected one of %s' %
+                         (affinity, AFFINITY_POLICIES))
+    return affinity
+
+
+def parse_cpulist(cpulist):
+    """
+    Convert a Linux CPU list into a list of integers:
+
+    >>> parse_cpulist('0-3,8,10-11')
+    [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []
+    for chunk in cpulist.strip().split(','):
+        if '-' in chunk:
+            first, last = chunk.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif chunk:
+            cpus.append(int(chunk))
+    return cpus
+
+
+def get_numa_nodes(sysdir='/sys/devices/system/node'):
+    """
+    Return a list of lists of CPU ids, one for each NUMA node, as
+    read from `sysdir`; if the information is not available, assume
+    a single node with all the CPUs.
+    """
+    nodes = []
+    nodedirs = glob.glob(os.path.join(sysdir, 'node[0-9]*'))
+    for nodedir in sorted(nodedirs, key=lambda d: int(d.rsplit('node', 1)[1])):
+        with open(os.path.join(nodedir, 'cpulist')) as f:
+            cpus = parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [range(multiprocessing.cpu_count())]
+
+
+def get_cpu_sets(affinity, num_workers, nodes=None):
+    """
+    Return a list with the CPUs to assign to each worker, or None if
+    the workers are not pinned.
+
+    :param affinity: an affinity policy, see :func:`get_affinity`
+    :param num_workers: the number of workers in the pool
+    :param nodes: a list of CPU lists, by default :func:`get_numa_nodes`
+    """
+    if affinity == 'none':
+        return None
+    nodes = nodes or get_numa_nodes()
+    if affinity == 'numa':
+        return [nodes[i % len(nodes)] for i in range(num_workers)]
+    # interleave the cores of the different nodes
+    cores = [cpu for cpus in itertools.izip_longest(*nodes)
+             for cpu in cpus if cpu is not None]
+    return [[cores[i % len(cores)]] for i in range(num_workers)]
+
+
+class ProcessPool(ProcessPoolExecutor):
+    """
+    A ProcessPoolExecutor pinning its worker processes to the CPUs
+    according to the given affinity policy (see :func:`get_affinity`).
+
+    :param max_workers: the number of worker processes
+    :param affinity: the affinity policy, 'none', 'core' or 'numa'
+    """
+    def __init__(self, max_workers=None, affinity='none'):
+        assert affinity in AFFINITY_POLICIES, affinity
+        ProcessPoolExecutor.__init__(self, max_workers)
+        self.affinity = affinity
+        self.cpu_sets = get_cpu_sets(affinity, self._max_workers)
+        self.pinned = {}  # pid -> cpus
+
+    def _adjust_process_count(self):
+        # the worker processes are spawned at the first submission
+        ProcessPoolExecutor._adjust_process_count(self)
+        if self.cpu_sets is not None:
+            self.pin_workers()
+
+    def pin_workers(self):
+        """
+        Pin the worker processes which are not pinned yet
+        """
+        for proc in self._processes:
+            if proc.pid in self.pinned:
+                continue
+            cpus = self.cpu_sets[len(self.pinned) % len(self.cpu_sets)]
+            try:
+                psutil.Process(proc.pid).set_cpu_affinity(cpus)
+            except (psutil.Error, OSError) as exc:
+                logging.warn('Could not pin worker %d to %s: %s',
+                             proc.pid, cpus, exc)
+            self.pinned[proc.pid] = cpus
+
+
+executor = ProcessPool(get_num_workers(), get_affinity())
+
+# the workers put here a pair (task ID, start time) when a task with an
+# ID starts; the queue is inherited by the workers when they are forked
+_started = multiprocessing.Queue()
+_start_times = {}  # task ID -> start time, see get_start_times
+_task_ids = itertools.count()
 
 ONE_MB = 1024 * 1024
 
 
+def init_executor(num_workers=None, affinity=None):
+    """
+    Shutdown the process pool and replace it with a new one.
+
+    :param num_workers:
+        the number of worker processes; if None, use :func:`get_num_workers`
+    :param affinity:
+        the affinity policy of the workers; if None, use :func:`get_affinity`
+    """
+    global executor
+    executor.shutdown()
+    executor = ProcessPool(num_workers or get_num_workers(),
+                           affinity or get_affinity())
+
+
+class TaskTimeout(Exception):
+    """
+    Raised when some tasks exceed their deadline. The attribute `.tasks`
+    is a list with the arguments of the tasks which timed out, so that
+    it is possible to diagnose the problem.
+    """
+    def __init__(self, msg, tasks):
+        Exception.__init__(self, msg)
+        self.tasks = tasks
+
+
+# private attributes of ProcessPoolExecutor used by _kill_workers
+POOL_INTERNALS = ('_max_workers', '_processes', '_pending_work_items',
+                  '_work_ids', '_queue_management_thread', '_call_queue')
+
+
+def _kill_workers(pool):
+    """
+    Cancel the tasks submitted to the given pool and kill its worker
+    processes. ProcessPoolExecutor has no public API for that, so this
+    is the only place relying on its private attributes: if they are
+    missing a RuntimeError is raised.
+    """
+    missing = [name for name in POOL_INTERNALS if not hasattr(pool, name)]
+    if missing:
+        raise RuntimeError('Cannot terminate %s: missing attribute(s) %s' % (
+            pool.__class__.__name__, ', '.join(missing)))
+    for work_item in pool._pending_work_items.values():
+        fut = work_item.future
+        if not fut.cancel() and not fut.done():  # the task is running
+            fut.set_exception(CancelledError())
+    for proc in pool._processes:
+        proc.terminate()
+        proc.join()
+    # remove the killed processes and the pending work items, so that
+    # the management thread of the pool can exit at shutdown
+    pool._processes.clear()
+    pool._pending_work_items.clear()
+    while not pool._work_ids.empty():
+        pool._work_ids.get_nowait()
+    if pool._queue_management_thread is not None:
+        pool._call_queue.cancel_join_thread()
+    pool.shutdown(wait=False)
+
+
+def terminate_executor():
+    """
+    Cancel all the tasks submitted to the process pool, kill the
+    worker processes and replace the pool with a fresh one.
+    """
+    global executor, _started
+    old = executor
+    _kill_workers(old)
+    # a killed worker may have left the queue in an inconsistent state
+    _started.cancel_join_thread()
+    _started = multiprocessing.Queue()
+    _start_times.clear()
+    executor = ProcessPool(old._max_workers, old.affinity)
+
+
 def no_distribute():
     """
     True if the variable OQ_NO_DISTRIBUTE is true
@@ -96,32 +310,203 @@ def safely_call(func, args, pickle=False):
     return res
 
 
-def log_percent_gen(taskname, todo, progress):
+def timed_call(func, args, task_id=None):
+    """
+    Call :func:`safely_call` and return a triple (result, exc_type,
+    duration) where duration is the number of seconds spent in the
+    function call. If a `task_id` is given, the start time of the call
+    is sent to the parent process (see :func:`get_start_times`).
+    """
+    t0 = time.time()
+    if task_id is not None:
+        _started.put((task_id, t0))
+    res, etype = safely_call(func, args)
+    return res, etype, time.time() - t0
+
+
+def get_start_times():
+    """
+    Return a dictionary task ID -> time when the task started running
+    in a worker process, for the tasks submitted with an ID which are
+    started and not yet collected.
+    """
+    while True:
+        try:
+            task_id, t0 = _started.get_nowait()
+        except Queue.Empty:
+            break
+        _start_times[task_id] = t0
+    return _start_times
+
+
+def get_weight(args):
+    """
+    Return the weight of a task, i.e. the sum of the `.weight` attributes
+    of its arguments (for instance the WeightedSequences generated by
+    :func:`openquake.commonlib.general.block_splitter`). If no argument
+    has a weight, the task has weight 1.
+
+    :param args: the arguments passed to the task
+    """
+    weight = sum(getattr(arg, 'weight', 0) for arg in args)
+    return weight or 1
+
+
+class ProgressReport(object):
     """
-    Generator factory. Each time the generator object is called
-    log a message if the percentage is bigger than the last one.
-    Yield the number of calls done at the current iteration.
+    A progress reporter tracking the completed weight of a set of tasks.
+    Each time a task completes the method `.update(weight)` must be called;
+    a message is logged if the completed percentage (in terms of weight)
+    is bigger than the last one. The throughput (weight per second) is
+    estimated with an exponential moving average, so that it is possible to
+    estimate the remaining time. The numbers are exposed as attributes and
+    properties, so that a scheduler can use them to take decisions, for
+    instance to add workers.
 
     :param str taskname:
         the name of the task
-    :param int todo:
-        the number of times the generator object will be called
+    :param todo:
+        the total weight of the tasks (the number of tasks if all the
+        tasks have weight 1)
     :param progress:
         a logging function for the progress report
+    :param float smoothing:
+        the smoothing factor of the moving average, between 0 and 1;
+        higher values give more importance to the recent tasks
     """
-    progress('spawned %d tasks of kind %s', todo, taskname)
-    yield 0
-    done = 1
-    prev_percent = 0
-    while done < todo:
-        percent = int(float(done) / todo * 100)
-        if percent > prev_percent:
-            progress('%s %3d%%', taskname, percent)
-            prev_percent = percent
-        yield done
-        done += 1
-    progress('%s 100%%', taskname)
-    yield done
+    def __init__(self, taskname, todo, progress=logging.info, smoothing=0.3):
+        assert 0 < smoothing <= 1, smoothing
+        self.taskname = taskname
+        self.todo = todo
+        self.progress = progress
+        self.smoothing = smoothing
+        self.done = 0  # completed weight
+        self.num_done = 0  # number of completed tasks
+        self.throughput = None  # smoothed weight per second
+        self.start_time = self._last_time = time.time()
+        self._pending = 0  # weight completed since the last measurement
+        self._prev_percent = 0
+
+    @property
+    def percent(self):
+        """The completed percentage, in terms of weight"""
+        if not self.todo:
+            return 100.
+        return 100. * self.done / self.todo
+
+    @property
+    def elapsed(self):
+        """The number of seconds elapsed since the start"""
+        return time.time() - self.start_time
+
+    @property
+    def eta(self):
+        """
+        The estimated number of seconds to completion, or None if
+        the throughput is still unknown.
+        """
+        if not self.throughput:
+            return None
+        return max(self.todo - self.done, 0) / self.throughput
+
+    def update(self, weight=1):
+        """
+        Register the completion of a task with the given weight and
+        log a message if the percentage is bigger than the last one.
+
+        :param weight: the weight of the completed task
+        """
+        now = time.time()
+        self.done += weight
+        self.num_done += 1
+        self._pending += weight
+        dt = now - self._last_time
+        if dt > 0:  # tasks completing at the same time are measured together
+            rate = self._pending / dt
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = (self.smoothing * rate +
+                                   (1 - self.smoothing) * self.throughput)
+            self._pending = 0
+            self._last_time = now
+        percent = int(self.percent)
+        if percent > self._prev_percent:
+            eta = self.eta
+            self.progress('%s %3d%%, %.1f/s, ETA %s', self.taskname, percent,
+                          self.throughput or 0,
+                          '?' if eta is None else '%ds' % eta)
+            self._prev_percent = percent
+
+    def __repr__(self):
+        return '<%s %s %d/%s>' % (self.__class__.__name__, self.taskname,
+                                  self.done, self.todo)
+
+
+class GranularityTuner(object):
+    """
+    Adapt the weight of the blocks submitted as tasks so that the tasks
+    last between `min_duration` and `max_duration` seconds. A tuner is a
+    callable returning the current maximum weight of a block, therefore
+    it can be passed to :func:`openquake.commonlib.general.block_splitter`
+    or to :meth:`openquake.commonlib.source.SourceCollector.gen_blocks`.
+    The durations of the completed tasks are registered with the method
+    `.add` (a :class:`TaskManager` instantiated with a tuner does it
+    automatically). After `num_samples` tasks the number of seconds
+    per unit of weight is estimated and, if the expected duration of a
+    block falls outside the range, the maximum weight is changed so that
+    the expected duration is in the middle of the range. Since the blocks
+    are generated lazily, the blocks submitted later use the learned size.
+
+    :param max_weight: the initial maximum weight of a block
+    :param min_duration: the minimum desired duration of a task
+    :param max_duration: the maximum desired duration of a task
+    :param num_samples: the number of tasks to measure before tuning
+    """
+    def __init__(self, max_weight, min_duration=30, max_duration=120,
+                 num_samples=3):
+        assert 0 < min_duration <= max_duration, (min_duration, max_duration)
+        self.max_weight = max_weight
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.num_samples = num_samples
+        self.num_tasks = 0
+        self.tot_weight = 0
+        self.tot_duration = 0.
+
+    @property
+    def seconds_per_weight(self):
+        """The estimated duration of a task of weight 1, or None"""
+        if self.num_tasks < self.num_samples or not self.tot_weight:
+            return None
+        return self.tot_duration / self.tot_weight
+
+    def add(self, weight, duration):
+        """
+        Register the duration of a completed task and update the
+        maximum weight.
+
+        :param weight: the weight of the task
+        :param duration: the duration of the task in seconds
+        """
+        self.num_tasks += 1
+        self.tot_weight += weight
+        self.tot_duration += duration
+        spw = self.seconds_per_weight
+        if not spw:
+            return
+        expected = spw * self.max_weight
+        if not self.min_duration <= expected <= self.max_duration:
+            target = (self.min_duration + self.max_duration) / 2.
+            self.max_weight = max(target / spw, 1)
+            logging.debug('Changed the block weight to %d', self.max_weight)
+
+    def __call__(self):
+        return self.max_weight
+
+    def __repr__(self):
+        return '<%s max_weight=%s>' % (self.__class__.__name__,
+                                       self.max_weight)
 
 
 class Pickled(object):
@@ -183,14 +568,43 @@ class TaskManager(object):
       tm.send(arg3, arg4)
       print tm.aggregate_results(agg, acc)
 
-    Progress report is built-in.
+    Progress report is built-in: the attribute `.report` is a
+    :class:`ProgressReport` instance tracking the completed weight
+    during the aggregation (the weight of a task is computed with
+    :func:`get_weight`).
+
+    It is possible to bound the runtime of the tasks by passing a
+    `task_timeout` (in seconds, counted from the moment a worker process
+    starts the task, so that the time spent in the queue is excluded)
+    and/or a `job_timeout` (in seconds, counted from the instantiation
+    of the TaskManager). When a deadline is exceeded the
+    outstanding tasks are cancelled, the workers are terminated and a
+    :class:`TaskTimeout` exception is raised during the aggregation.
+    The timeouts are ignored if OQ_NO_DISTRIBUTE is set.
+
+    If a :class:`GranularityTuner` is passed, the duration of each
+    task is registered in the tuner when its result is collected.
+    To let the tuner change the size of the later blocks, the arguments
+    must be passed lazily to :meth:`aggregate_results`, which submits
+    a new task only when a previous one completes.
     """
-    def __init__(self, oqtask, progress, name=None):
+    poll_time = 0.5  # seconds between the checks of the deadlines
+
+    def __init__(self, oqtask, progress, name=None,
+                 task_timeout=None, job_timeout=None, tuner=None):
         self.oqtask = oqtask
         self.progress = progress
         self.name = name or oqtask.__name__
+        self.task_timeout = task_timeout
+        self.job_timeout = job_timeout
+        self.tuner = tuner
+        self.start_time = time.time()
         self.results = []
+        self.weights = []
+        self.args = []  # populated only if there are timeouts
+        self.task_ids = []  # populated only if there is a task timeout
         self.sent = 0
+        self.report = None
 
     def submit(self, *args):
         """
@@ -200,11 +614,151 @@ class TaskManager(object):
         result is returned.
         """
         check_mem_usage()  # log a warning if too much memory is used
+        weight = get_weight(args)
         if no_distribute():
-            res = safely_call(self.oqtask, args)
+            res = timed_call(self.oqtask, args)
+            if self.tuner:
+                self.tuner.add(weight, res[2])
         else:
-            res = executor.submit(safely_call, self.oqtask, args)
+            # the start of the task is notified only if there is a deadline
+            task_id = next(_task_ids) if self.task_timeout else None
+            res = executor.submit(timed_call, self.oqtask, args, task_id)
+            if self.task_timeout:
+                self.task_ids.append(task_id)
         self.results.append(res)
+        self.weights.append(weight)
+        if self.task_timeout or self.job_timeout:
+            self.args.append(args)
+
+    def _submit_window(self, function_args, num):
+        """
+        Submit at most `num` tasks with the arguments taken from the
+        given iterator, add their weight to the progress report, if any,
+        and return the number of submitted tasks.
+        """
+        start = len(self.results)
+        for args in itertools.islice(function_args, max(num, 0)):
+            self.submit(*args)
+        if self.report:
+            self.report.todo += sum(self.weights[start:])
+        return len(self.results) - start
+
+    def _iter_results(self, function_args=None, maxpending=None):
+        """
+        Yield pairs (result, weight) as soon as the tasks complete;
+        the results are pairs (value, exc_type) as returned by
+        :func:`safely_call`. If an iterator of arguments is given, the
+        tasks are submitted lazily, keeping at most `maxpending` of
+        them outstanding.
+        """
+        if no_distribute():
+            # the tuner is updated by .submit, before the next arguments
+            # are pulled from the iterator
+            i = 0
+            while i < len(self.results) or function_args is not None and (
+                    self._submit_window(function_args, 1)):
+                yield self.results[i][:2], self.weights[i]
+                i += 1
+        elif (self.task_timeout or self.job_timeout or
+              function_args is not None):
+            for res in self._iter_futures(function_args, maxpending):
+                yield res
+        else:
+            weight = dict(zip(self.results, self.weights))
+            for future in as_completed(self.results):
+                check_mem_usage()  # log a warning if too much memory is used
+                yield self._result(future, weight[future]), weight[future]
+
+    def _result(self, future, weight):
+        """
+        Return the pair (value, exc_type) of a completed task and register
+        its weight and duration in the tuner, if any; the tuner is updated
+        in the thread consuming the results, before they are aggregated.
+        """
+        res, etype, duration = future.result()
+        if self.tuner:
+            self.tuner.add(weight, duration)
+        return res, etype
+
+    def _iter_futures(self, function_args=None, maxpending=None):
+        """
+        Yield pairs (result, weight) as soon as the tasks complete,
+        by checking the deadlines, if any, every `.poll_time` seconds.
+        If an iterator of arguments is given, new tasks are submitted
+        as the previous ones complete, after registering their durations
+        in the tuner, with at most `maxpending` tasks outstanding.
+        """
+        maxpending = maxpending or 2 * executor._max_workers
+        if self.task_timeout or self.job_timeout:
+            poll_time = self.poll_time
+        else:
+            poll_time = None
+        weight = {}
+        args = {}
+        task_id = {}
+        pending = set()
+        start = 0  # index of the first future not yet registered
+        while True:
+            for i in xrange(start, len(self.results)):
+                future = self.results[i]
+                weight[future] = self.weights[i]
+                if self.args:
+                    args[future] = self.args[i]
+                if self.task_ids:
+                    task_id[future] = self.task_ids[i]
+                pending.add(future)
+            start = len(self.results)
+            if not pending:
+                break
+            done, pending = wait(pending, poll_time, FIRST_COMPLETED)
+            start_times = get_start_times()
+            for future in done:
+                start_times.pop(task_id.get(future), None)
+                check_mem_usage()  # log a warning if too much memory is used
+                yield self._result(future, weight[future]), weight[future]
+            now = time.time()
+            if pending and self.job_timeout and (
+                    now - self.start_time > self.job_timeout):
+                self._timeout('The job %s exceeded the timeout of %ss' % (
+                    self.name, self.job_timeout), [args[f] for f in pending])
+            expired = []
+            for fut in pending:
+                t0 = start_times.get(task_id.get(fut))
+                if t0 is not None and now - t0 > self.task_timeout:
+                    expired.append(args[fut])
+            if expired:
+                self._timeout('%d task(s) of kind %s exceeded the timeout '
+                              'of %ss' % (len(expired), self.name,
+                                          self.task_timeout), expired)
+            if function_args is not None:
+                self._submit_window(function_args, maxpending - len(pending))
+
+    def _timeout(self, msg, tasks):
+        """
+        Log the arguments of the tasks which timed out, abort the
+        job and raise a TaskTimeout exception.
+        """
+        for task_args in tasks:
+            logging.error('Timed out %s%s', self.name, task_args)
+        self.abort()
+        raise TaskTimeout(msg, tasks)
+
+    def abort(self):
+        """
+        Cancel the outstanding tasks; if some of them are already
+        running, terminate the worker processes.
+        """
+        if no_distribute():
+            return
+        # a future which cannot be cancelled and is not done is running
+        running = [fut for fut in self.results
+                   if not (fut.cancel() or fut.done())]
+        if running:
+            terminate_executor()
+        self.results = []
+        self.weights = []
+        self.args = []
+        self.task_ids = []
 
     def aggregate_result_set(self, agg, acc):
         """
@@ -215,41 +769,48 @@ class TaskManager(object):
         :param acc: the initial value of the accumulator
         :returns: the final value of the accumulator
         """
-        for future in as_completed(self.results):
-            check_mem_usage()  # log a warning if too much memory is used
-            acc = agg(acc, future.result())
+        for res, _weight in self._iter_results():
+            acc = agg(acc, res)
         return acc
 
-    def aggregate_results(self, agg, acc):
+    def aggregate_results(self, agg, acc, function_args=None,
+                          maxpending=None):
         """
         Loop on a set of results and update the accumulator
         by using the aggregation function.
 
-        :param results: a list of results
         :param agg: the aggregation function, (acc, val) -> new acc
         :param acc: the initial value of the accumulator
+        :param function_args:
+            an iterator over positional arguments of further tasks, which
+            are submitted lazily; the total weight in the progress report
+            grows as they are submitted
+        :param maxpending:
+            the maximum number of outstanding tasks when submitting lazily
+            (by default twice the number of workers)
         :returns: the final value of the accumulator
         """
+        self.report = None
+        if function_args is not None and not no_distribute():
+            self._submit_window(function_args, (
+                maxpending or 2 * executor._max_workers) - len(self.results))
         if self.sent / ONE_MB:
             logging.info('Sent %dM of data', self.sent / ONE_MB)
-        log_percent = log_percent_gen(
-            self.name, len(self.results), self.progress)
-        log_percent.next()
-
-        def agg_and_percent(acc, (val, exc)):
+        self.progress('spawned %d tasks of kind %s', len(self.results),
+                      self.name)
+        self.report = ProgressReport(
+            self.name, sum(self.weights), self.progress)
+        for (val, exc), weight in self._iter_results(
+                function_args, maxpending):
             if exc:
                 raise RuntimeError(val)
-            res = agg(acc, val)
-            log_percent.next()
-            return res
-
-        if no_distribute():
-            agg_result = reduce(agg_and_percent, self.results, acc)
-        else:
-            agg_result = self.aggregate_result_set(agg_and_percent, acc)
-
+            acc = agg(acc, val)
+            self.report.update(weight)
         self.results = []
-        return agg_result
+        self.weights = []
+        self.args = []
+        self.task_ids = []
+        return acc
 
     def wait(self):
         """
@@ -257,10 +818,11 @@ class TaskManager(object):
 
         :returns: the total number of tasks that were spawned
         """
-        return self.aggregate_results(self, lambda acc, res: acc + 1, 0)
+        return self.aggregate_results(lambda acc, res: acc + 1, 0)
 
 
-def map_reduce(function, function_args, agg, acc, name=None):
+def map_reduce(function, function_args, agg, acc, name=None,
+               task_timeout=None, job_timeout=None, tuner=None):
     """
     Given a function and an iterable of positional arguments, apply the
     function to the arguments in parallel and return an aggregate
@@ -281,14 +843,63 @@ def map_reduce(function, function_args, agg, acc, name=None):
     :param function_args: an iterable over positional arguments
     :param agg: the aggregation function, (acc, val) -> new acc
     :param acc: the initial value of the accumulator
+    :param task_timeout: the maximum runtime of a task, in seconds
+    :param job_timeout: the maximum runtime of all the tasks, in seconds
+    :param tuner:
+        a :class:`GranularityTuner` instance or None; if given, the
+        arguments are consumed lazily, so that the blocks generated
+        after the first tasks complete use the learned size
     :returns: the final value of the accumulator
     """
-    tm = TaskManager(function, logging.info, name)
+    tm = TaskManager(function, logging.info, name, task_timeout, job_timeout,
+                     tuner)
+    if tuner:
+        return tm.aggregate_results(agg, acc, iter(function_args))
     for args in function_args:
         tm.submit(*args)
     return tm.aggregate_results(agg, acc)
 
 
+def imap_unordered(function, function_args, maxpending=None):
+    """
+    Apply the function to the arguments in the process pool and yield
+    the results as soon as they come. Contrarily to :func:`map_reduce`,
+    the arguments are consumed lazily: at most `maxpending` tasks are
+    in flight at any given time (by default twice the number of
+    workers), so that the arguments are never all in memory. Closing
+    the generator cancels the outstanding tasks. If OQ_NO_DISTRIBUTE
+    is set the function is called sequentially in process.
+
+    :param function: a top level Python function
+    :param function_args: an iterable over positional arguments
+    :param maxpending: the maximum number of outstanding tasks
+    :returns: an iterator over the results
+    """
+    if no_distribute():
+        for args in function_args:
+            yield function(*args)
+        return
+    maxpending = maxpending or 2 * executor._max_workers
+    function_args = iter(function_args)
+    pending = set()
+    try:
+        while True:
+            for args in itertools.islice(
+                    function_args, maxpending - len(pending)):
+                pending.add(executor.submit(safely_call, function, args))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                val, exc = future.result()
+                if exc:
+                    raise RuntimeError(val)
+                yield val
+    finally:
+        for future in pending:
+            future.cancel()
+
+
 # this is not thread-safe
 class PerformanceMonitor(object):
     """
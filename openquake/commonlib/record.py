@@ -38,10 +38,16 @@ ValueError if the string is invalid.
 """
 
 import abc
+import bisect
 import itertools
+import contextlib
 import operator
 import collections
 
+import numpy
+
+NoneType = type(None)
+
 
 class InvalidRecord(Exception):
     """
@@ -52,6 +58,7 @@ class InvalidRecord(Exception):
     """
 
     def __init__(self, record, errorlist):
+        Exception.__init__(self, record, errorlist)  # makes it picklable
         self.fname = None
         self.rowno = 0
         self.record = record
@@ -71,6 +78,37 @@ class ForeignKeyError(Exception):
     pass
 
 
+class IntegrityError(KeyError, ForeignKeyError):
+    """
+    Raised by the bulk insertion methods, collecting all the violations
+    of the unique and foreign key constraints. It is both a KeyError
+    and a ForeignKeyError, consistently with the exceptions raised when
+    inserting a single record.
+    """
+    def __init__(self, errors):
+        KeyError.__init__(self, errors)
+        self.errors = errors
+
+    def __str__(self):
+        return '\n'.join(self.errors)
+
+
+def keygetter(indices):
+    """
+    Return a function extracting from a row the tuple of the values
+    at the given indices.
+
+    >>> keygetter([1])(['a', 'b', 'c'])
+    ('b',)
+    >>> keygetter([2, 0])(['a', 'b', 'c'])
+    ('c', 'a')
+    """
+    if len(indices) == 1:
+        [i] = indices
+        return lambda row: (row[i],)
+    return operator.itemgetter(*indices)
+
+
 class Unique(object):
     """
     Descriptor used to describe unique constraints on a record type.
@@ -91,11 +129,13 @@ class Unique(object):
         self.names = names
         self.name = None  # set by MetaRecord
         self.recordtype = None  # set by MetaRecord
+        self.indices = None  # set by MetaRecord
+        self.getkey = None  # set by MetaRecord
 
     def __get__(self, rec, recordtype):
         if rec is None:
             return self
-        return tuple(rec[f] for f in self.names)
+        return self.getkey(rec.row)
 
     def __repr__(self):
         return '<Unique%s>' % str((self.recordtype,) + self.names)
@@ -104,22 +144,71 @@ class Unique(object):
 class ForeignKey(object):
     """
     Descriptor used to describe unique constraints on a record type.
+    The attribute `.index` is an :class:`Index` with the same name and
+    fields, used by the tables as reverse index of the foreign key.
     """
     def __init__(self, unique, *names):
         self.unique = unique
         self.names = names
         self.name = None  # set by MetaRecord
         self.recordtype = None  # set by MetaRecord
+        self.indices = None  # set by MetaRecord
+        self.getkey = None  # set by MetaRecord
+        self.index = None  # set by MetaRecord
 
     def __get__(self, rec, recordtype):
         if rec is None:
             return self
-        return tuple(rec[f] for f in self.names)
+        return self.getkey(rec.row)
 
     def __repr__(self):
         return '<ForeignKey%s>' % str((self.recordtype,) + self.names)
 
 
+class Index(object):
+    """
+    Descriptor used to describe a secondary index on a record type.
+    For instance
+
+    class Cost(record.Record):
+        asset_ref = record.Field(str)
+        type = record.Field(str)
+        value = record.Field(float)
+
+        pkey = Unique('asset_ref', 'type')
+        asset = Index('asset_ref')
+        by_value = Index('value', sorted=True)
+
+    A hash index supports equality lookups and grouping, in order of
+    insertion; a sorted index supports also range queries and grouping
+    in key order. The keys of a sorted index are ordered by the casted
+    values of the fields, so inserting a record with invalid values
+    raises a ValueError. See the query methods of :class:`Table`.
+    """
+    def __init__(self, *names, **kw):
+        assert len(set(names)) == len(names), 'Duplicates in %s!' % names
+        self.names = names
+        self.sorted = kw.pop('sorted', False)
+        assert not kw, 'Unexpected arguments %s' % kw
+        self.name = None  # set by MetaRecord
+        self.recordtype = None  # set by MetaRecord
+        self.indices = None  # set by MetaRecord
+        self.getkey = None  # set by MetaRecord
+
+    def __get__(self, rec, recordtype):
+        if rec is None:
+            return self
+        return self.getkey(rec.row)
+
+    def sortkey(self, key):
+        """Cast a key of UTF8-encoded strings into a tuple of values"""
+        fields = self.recordtype.fields
+        return tuple(fields[i].cast(v) for i, v in zip(self.indices, key))
+
+    def __repr__(self):
+        return '<Index%s>' % str((self.recordtype,) + self.names)
+
+
 class Field(object):
     """
     Descriptor used to describe record fields. A Field instance has
@@ -143,6 +232,25 @@ class Field(object):
             return lambda rec: self.cast(rec[self.name])
         return self.cast(rec[self.name])
 
+    def cast_column(self, values):
+        """
+        Cast a sequence of UTF-8 strings and return a typed NumPy array,
+        or None if the casted values are not numbers. Fields with cast
+        `float` or `int` are converted directly into an array of the
+        right type, without building intermediate lists; a ValueError
+        is raised if some value is invalid. Fields with cast `str` are
+        not cast at all.
+        """
+        if self.cast is str:
+            return None
+        elif self.cast in (float, int):
+            try:
+                return numpy.fromiter(itertools.imap(self.cast, values),
+                                      self.cast, len(values))
+            except OverflowError:  # big integers, cast them one by one
+                pass
+        return _typed_column(map(self.cast, values))
+
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, self.name)
 
@@ -154,12 +262,19 @@ class MetaRecord(abc.ABCMeta):
     it sets their .name attribute.
     It defines on the record subclasses the ``__init__`` method
     and the attributes ``_name2index``, ``fields``,
-    ``_ntuple``. Moreover it defines the metaclass method
+    ``_ntuple`` and ``__slots__`` (empty, so that the record instances
+    have no ``__dict__``). Moreover it defines the metaclass method
     ``__len__`` and the metaclass property ``fieldnames``.
+    The Unique and ForeignKey constraints and the Index descriptors are
+    bound to the record subclass at definition time, together with the
+    functions extracting their keys from the rows, and stored in the
+    ``_descriptors``
+    dictionary, so that ``get_descriptors`` does not need to scan the
+    class namespace.
     """
     _counter = itertools.count()
     _reserved_names = set(
-        'fields fieldnames _name2index _ntuple _ordinal'.split())
+        'fields fieldnames _name2index _ntuple _ordinal _descriptors'.split())
 
     def __new__(mcl, name, bases, dic):
         for nam in dic:
@@ -186,6 +301,8 @@ class MetaRecord(abc.ABCMeta):
         # and they will have the precedence against the default ones
         if '__init__' not in dic:
             dic['__init__'] = mcl.mkinit(fieldnames)
+        if 'cast' not in dic and fields:
+            dic['cast'] = mcl.mkcast(fields)
         if '_name2index' not in dic:
             dic['_name2index'] = _name2index
         if 'fields' not in dic:
@@ -193,6 +310,8 @@ class MetaRecord(abc.ABCMeta):
         if '_ntuple' not in dic:
             dic['_ntuple'] = collections.namedtuple(name, fieldnames)
         dic['_ordinal'] = mcl._counter.next()
+        if '__slots__' not in dic:
+            dic['__slots__'] = ()
         if '_constraints' not in dic:
             dic['_constraints'] = []
         return super(MetaRecord, mcl).__new__(mcl, name, bases, dic)
@@ -200,26 +319,37 @@ class MetaRecord(abc.ABCMeta):
     def __init__(cls, name, bases, dic):
         if name != 'Record':
             cls.pkey  # raise an AttributeError if pkey is not defined
-        for n, v in dic.iteritems():
-            # make a bound copy of the unbound Unique and ForeignKey constraint
+        cls._descriptors = {Unique: [], ForeignKey: [], Index: []}
+        for n, v in sorted(dic.iteritems()):
+            # make a bound copy of the unbound Unique, ForeignKey and Index
             if isinstance(v, Unique):
-                unique = Unique(*v.names)
-                unique.name = n
-                unique.recordtype = cls
-                setattr(cls, n, unique)
+                kind, descr = Unique, Unique(*v.names)
             elif isinstance(v, ForeignKey):
-                fkey = ForeignKey(v.unique, *v.names)
-                fkey.name = n
-                fkey.recordtype = cls
-                setattr(cls, n, fkey)
+                kind, descr = ForeignKey, ForeignKey(v.unique, *v.names)
+            elif isinstance(v, Index):
+                kind, descr = Index, Index(*v.names, sorted=v.sorted)
+            else:
+                continue
+            descr.name = n
+            descr.recordtype = cls
+            descr.indices = [cls._name2index[f] for f in v.names]
+            descr.getkey = keygetter(descr.indices)
+            setattr(cls, n, descr)
+            cls._descriptors[kind].append(descr)
+            if kind is ForeignKey:
+                descr.index = index = Index(*v.names)
+                index.name = n
+                index.recordtype = cls
+                index.indices = descr.indices
+                index.getkey = descr.getkey
 
     @staticmethod
     def mkinit(fieldnames):
         """Build the __init__ method for record subclasses"""
-        fields = ', '.join(fieldnames)
+        fields = ''.join('%s, ' % f for f in fieldnames)
         defaults = ', '.join("%s=''" % f for f in fieldnames)
         templ = '''def __init__(self, %s):
-        self.row = [%s]
+        self.row = (%s)
         self.init()''' % (defaults, fields)
         dic = {}
         try:
@@ -229,6 +359,31 @@ class MetaRecord(abc.ABCMeta):
             raise
         return dic['__init__']
 
+    @staticmethod
+    def mkcast(fields):
+        """
+        Build the cast method for record subclasses; if some field is
+        invalid it falls back on the generic method Record.cast, which
+        collects all the errors.
+        """
+        casts = ''.join('cast%d(row[%d]), ' % (i, i)
+                        for i in range(len(fields)))
+        templ = '''def cast(self):
+        row = self.row
+        try:
+            return self._ntuple(%s), None
+        except ValueError:
+            return Record.cast(self)''' % casts
+        dic = dict(('cast%d' % i, f.cast) for i, f in enumerate(fields))
+        dic['Record'] = Record
+        try:
+            exec(templ, dic)
+        except:
+            print 'Could not build cast method, error in:', templ
+            raise
+        dic['cast'].__doc__ = Record.cast.__doc__
+        return dic['cast']
+
     @property
     def fieldnames(cls):
         """Returns the names of the fields defined in cls"""
@@ -238,8 +393,11 @@ class MetaRecord(abc.ABCMeta):
         """
         Return the instances of descriptor_cls defined in cls.
         """
-        return [v.__get__(None, cls) for v in vars(cls).values()
-                if isinstance(v, descriptor_cls)]
+        try:
+            return cls.__dict__['_descriptors'][descriptor_cls]
+        except KeyError:
+            return [v.__get__(None, cls) for v in vars(cls).values()
+                    if isinstance(v, descriptor_cls)]
 
     def add_check(cls, constraint):
         cls._constraints.append(constraint)
@@ -252,17 +410,20 @@ class MetaRecord(abc.ABCMeta):
         return '<class %s>' % cls.__name__
 
 
-class Record(collections.Sequence):
+class Record(object):
     """
     The abstract base class for the record subclasses. It defines
     a number of methods, including an ``init`` method called by
     the ``__init__`` method and overridable for post-initialization
     operations. The ``__init__`` method defines a .row attribute
-    with the contents of the record, stored as a UTF8-encoded string list.
+    with the contents of the record, stored as a UTF8-encoded string tuple.
     Records implements the Sequence interface and have a .cast()
     method, a .check_valid() method and a .is_valid() method.
+    Record instances have no ``__dict__``: the only per-instance data
+    are the object itself and its .row tuple.
     """
     __metaclass__ = MetaRecord
+    __slots__ = ('row',)
     convertername = 'Converter'
 
     @classmethod
@@ -337,14 +498,40 @@ class Record(collections.Sequence):
         """
         i = self.get_field_index(i)
         self.fields[i].cast(value)
-        self.row[i] = value
+        row = list(self.row)
+        row[i] = value
+        self.row = tuple(row)
 
     def __delitem__(self, i):
         """
         Delete the column 'i', where 'i' can be an integer or a field name
         """
         i = self.get_field_index(i)
-        del self.row[i]
+        row = list(self.row)
+        del row[i]
+        self.row = tuple(row)
+
+    # the Sequence mixin methods, since collections.Sequence has no
+    # __slots__ and cannot be a base class of Record
+
+    def __iter__(self):
+        return iter(self.row)
+
+    def __reversed__(self):
+        return reversed(self.row)
+
+    def __contains__(self, value):
+        return value in self.row
+
+    def index(self, value):
+        return self.row.index(value)
+
+    def count(self, value):
+        return self.row.count(value)
+
+    def __reduce__(self):
+        """Records are pickled as (recordtype, row) pairs"""
+        return self.__class__, self.row
 
     def __eq__(self, other):
         """
@@ -371,6 +558,8 @@ class Record(collections.Sequence):
         """A CSV representation of the record"""
         return ','.join(self.row)
 
+collections.Sequence.register(Record)
+
 
 def nodedict(records):
     """
@@ -395,6 +584,40 @@ def find_invalid(recorditer):
             yield exc
 
 
+def find_invalid_columns(recordtype, columns):
+    """
+    Yield the InvalidRecord exceptions found in the rows given as a list
+    of columns of strings, the same as :func:`find_invalid`. The columns
+    are cast in batch and the records are built only if some value is
+    invalid.
+    """
+    try:
+        for field, column in zip(recordtype.fields, columns):
+            field.cast_column(column)
+    except ValueError:
+        for exc in find_invalid(
+                itertools.starmap(recordtype, itertools.izip(*columns))):
+            yield exc
+
+
+def duplicated(recordtype, position, names, key):
+    """
+    Return a KeyError describing a duplicated record
+    """
+    msg = ['%s=%s' % (name, k) for name, k in zip(names, key)]
+    return KeyError('%s:%d:Duplicated record:%s' %
+                    (recordtype.__name__, position, ','.join(msg)))
+
+
+def missing(fkey, fkvalues):
+    """
+    Return a ForeignKeyError describing a record referencing a missing key
+    """
+    return ForeignKeyError(
+        'Missing record in table %s corresponding to the keys %s'
+        % (fkey.unique.recordtype.__name__, fkvalues))
+
+
 class UniqueData(object):
     """Table-related"""
     def __init__(self, table, unique):
@@ -407,10 +630,111 @@ class UniqueData(object):
         return self.unique.names
 
 
+class IndexData(object):
+    """
+    Table-related data of an Index: an ordered dictionary key -> list
+    of items and, for sorted indexes, the sorted list of the pairs
+    (sortkey, key). The pairs of the new keys are appended to a separate
+    list and sorted in a single pass at the first ordered access, so
+    that loading a table is not quadratic. The items are records for
+    :class:`Table` and row indices for :class:`ColumnTable`. The items
+    of a group are in order of insertion; a ColumnTable rebuilds its
+    indexes after a deletion or an insertion in the middle, so then they
+    are in order of position.
+    """
+    def __init__(self, index):
+        self.index = index
+        self.clear()
+
+    def clear(self):
+        """Remove all the items"""
+        self.groups = collections.OrderedDict()
+        self.sortedkeys = []
+        self.newkeys = []  # pairs (sortkey, key) not yet sorted
+        self.size = 0  # number of indexed items
+
+    def _sort(self):
+        """Merge the new pairs (sortkey, key) into the sorted ones"""
+        if self.newkeys:
+            self.sortedkeys.extend(self.newkeys)
+            self.sortedkeys.sort()
+            self.newkeys = []
+
+    def add(self, key, item):
+        """Add an item with the given key"""
+        group = self.groups.get(key)
+        if group is None:
+            self.groups[key] = [item]
+            if self.index.sorted:
+                self.newkeys.append((self.index.sortkey(key), key))
+        else:
+            group.append(item)
+        self.size += 1
+
+    def remove(self, key, item):
+        """Remove the given item, which must have the given key"""
+        group = self.groups[key]
+        if group[-1] is item:  # i.e. when reverting an append
+            pos = len(group) - 1
+        else:  # look for the very same object first, then for an equal one
+            try:
+                pos = map(id, group).index(id(item))
+            except ValueError:
+                try:
+                    pos = group.index(item)  # row indices of a ColumnTable
+                except ValueError:
+                    raise KeyError(key)
+        del group[pos]
+        if not group:
+            del self.groups[key]
+            if self.index.sorted:
+                self._sort()
+                pair = (self.index.sortkey(key), key)
+                del self.sortedkeys[bisect.bisect_left(self.sortedkeys, pair)]
+        self.size -= 1
+
+    def lookup(self, key):
+        """Return the items with the given key"""
+        return self.groups.get(key, [])
+
+    def range(self, low=None, high=None):
+        """
+        Return the items with low <= sortkey < high, in key order; low and
+        high are tuples of casted values or None for unbounded ranges.
+        """
+        if not self.index.sorted:
+            raise TypeError('%s is not sorted' % self.index)
+        self._sort()
+        start = 0 if low is None else bisect.bisect_left(
+            self.sortedkeys, (low,))
+        stop = len(self.sortedkeys) if high is None else bisect.bisect_left(
+            self.sortedkeys, (high,))
+        items = []
+        for _sortkey, key in self.sortedkeys[start:stop]:
+            items.extend(self.groups[key])
+        return items
+
+    def iterkeys(self):
+        """
+        Iterate on the keys, in key order for sorted indexes and in
+        order of insertion otherwise
+        """
+        if self.index.sorted:
+            self._sort()
+            return (key for _sortkey, key in self.sortedkeys)
+        return iter(self.groups)
+
+
 class Table(collections.MutableSequence):
     """
     In-memory table storing a sequence of record objects.
-    Unique constraints are checked at insertion time.
+    Unique constraints are checked at insertion time and the
+    secondary indexes are updated at each modification; they can be
+    queried with the methods `lookup`, `range` and `groupby`.
+    The records deleted by :meth:`TableSet.delete` are removed from the
+    list of records lazily, at the next access by position.
+    During a transaction (see :meth:`TableSet.begin`) each modification
+    records in the undo log how to revert it.
     """
     def __init__(self, recordtype, records, ordinal=None):
         self.recordtype = recordtype
@@ -418,7 +742,11 @@ class Table(collections.MutableSequence):
         self._unique_data = dict(
             (u.name, UniqueData(self, u))
             for u in recordtype.get_descriptors(Unique))
+        self._index_data = dict(
+            (i.name, IndexData(i)) for i in recordtype.get_descriptors(Index))
         self._records = []
+        self._deleted = set()  # ids of the records to remove from the list
+        self._journal = None  # undo log of the current transaction, if any
         for rec in records:
             self.append(rec)
         self.attr = {}  # a dictionary that can be populated by extension
@@ -428,51 +756,235 @@ class Table(collections.MutableSequence):
     def name(self):
         return 'table' + self.recordtype.__name__
 
+    def _log(self, undo, *args):
+        """
+        Append to the undo log of the current transaction, if any, the
+        function (and its arguments) reverting a modification; it must
+        be called just before performing the modification, when all the
+        checks have been passed.
+        """
+        if self._journal is not None:
+            self._journal.append((undo, args))
+
+    def flush(self):
+        """A Table has no buffered records: do nothing"""
+
+    def _compact(self):
+        """Remove the deleted records from the list of records"""
+        if self._deleted:
+            # the old list is not modified, so it can be restored
+            self._log(self._uncompact, self._records, self._deleted)
+            self._records = [rec for rec in self._records
+                             if id(rec) not in self._deleted]
+            self._deleted = set()
+
+    def _uncompact(self, records, deleted):
+        """Restore the list of records as it was before a compaction"""
+        self._records = records
+        self._deleted = deleted
+
     def __getitem__(self, i):
         """Return the i-th record"""
+        self._compact()
         return self._records[i]
 
     def __setitem__(self, i, new_record):
-        """Set the i-th record"""
-        # TODO: the fk dictionaries must be updated!
-        # TODO: there is no unique check here!
-        for name, unique in self._unique_data.iteritems():
-            old_key = getattr(self._records[i], name)
-            new_key = getattr(new_record, name)
-            del unique.dict[old_key]
-            unique.dict[new_key] = new_record
+        """
+        Set the i-th record, by checking the unique constraints; the
+        foreign keys referring to the table see the change, since they
+        share the dictionaries of the unique constraints.
+        """
+        self._compact()
+        old_record = self._records[i]
+        self._check_update(old_record, new_record, i)
+        self._log(self.__setitem__, i, old_record)
+        self._replace_keys(old_record, new_record)
         self._records[i] = new_record
 
+    def _check_update(self, old_record, new_record, position=None):
+        """
+        Raise a KeyError if replacing the old record with the new one
+        would violate a unique constraint
+        """
+        for name, unique in self._unique_data.iteritems():
+            key = getattr(new_record, name)
+            if unique.dict.get(key, old_record) is not old_record:
+                if position is None:  # find it, only in case of error
+                    self._compact()
+                    position = self._records.index(old_record)
+                raise duplicated(self.recordtype, position, unique.names, key)
+
+    def _replace_keys(self, old_record, new_record):
+        """
+        Update the unique constraints and the indexes when replacing the
+        old record with the new one
+        """
+        for name, unique in self._unique_data.iteritems():
+            del unique.dict[getattr(old_record, name)]
+            unique.dict[getattr(new_record, name)] = new_record
+        self._remove_from_indexes(old_record)
+        self._add_to_indexes(new_record)
+
+    def _item(self, rec):
+        """
+        Return the item stored in the indexes for the record with the
+        same primary key of the given one (the stored record itself for
+        :class:`Table`); raise a KeyError if there is no such record
+        """
+        return self._unique_data['pkey'].dict[rec.pkey]
+
+    def _update_item(self, item, new_record):
+        """
+        Replace the stored record with the new one, without moving it:
+        the row of the stored record is updated in place, so that the
+        position of the record is not needed
+        """
+        self._check_update(item, new_record)
+        self._log(self._update_item, item, self.recordtype(*item.row))
+        for name, unique in self._unique_data.iteritems():
+            del unique.dict[getattr(item, name)]
+        self._remove_from_indexes(item)
+        item.row = tuple(new_record)
+        for name, unique in self._unique_data.iteritems():
+            unique.dict[getattr(item, name)] = item
+        self._add_to_indexes(item)
+
+    def _delete_items(self, items):
+        """
+        Delete the given stored records from the unique constraints and
+        the indexes; they are removed from the list of records lazily.
+        """
+        self._log(self._undelete, items)
+        for rec in items:
+            for name, unique in self._unique_data.iteritems():
+                del unique.dict[getattr(rec, name)]
+            self._remove_from_indexes(rec)
+            self._deleted.add(id(rec))
+
+    def _undelete(self, items):
+        """
+        Revert the deletion of the given stored records, which have not
+        been removed from the list of records; they are added again to
+        the unique constraints and at the end of the groups of the indexes
+        """
+        for rec in items:
+            self._deleted.remove(id(rec))
+            for name, unique in self._unique_data.iteritems():
+                unique.dict[getattr(rec, name)] = rec
+            self._add_to_indexes(rec)
+
     def __delitem__(self, i):
         """Delete the i-th record"""
         # i must be an integer, not a range
+        self._compact()
+        i = self._position(i)
+        self._log(self.insert, i, self._records[i])
         for name, unique in self._unique_data.iteritems():
             key = getattr(self._records[i], name)
             del unique.dict[key]
+        self._remove_from_indexes(self._records[i])
         del self._records[i]
 
+    def _position(self, i):
+        """Normalize a (possibly negative) record index"""
+        n = len(self)
+        if not -n <= i < n:
+            raise IndexError('table index out of range')
+        return i % n
+
     def insert(self, position, rec):
         """
         Insert a record in the table, at the given position index.
         This is called by the .append method, with position equal
         to the record length. Trying to insert a duplicated record
         (in terms of unique constraints, including the primary
-        key) raises a KeyError.
+        key) raises a KeyError and leaves the table unchanged.
         """
         for name, unique in self._unique_data.iteritems():
             key = getattr(rec, name)
-            try:
-                rec = unique.dict[key]
-            except KeyError:  # not inserted yet
-                unique.dict[key] = rec
-            else:
-                msg = []
-                for k, name in zip(key, unique.names):
-                    msg.append('%s=%s' % (name, k))
-                raise KeyError('%s:%d:Duplicated record:%s' %
-                               (self.recordtype.__name__, position,
-                                ','.join(msg)))
-        self._records.insert(position, rec)
+            if key in unique.dict:
+                raise duplicated(self.recordtype, position, unique.names, key)
+        for name, unique in self._unique_data.iteritems():
+            unique.dict[getattr(rec, name)] = rec
+        self._add_to_indexes(rec)
+        if position >= len(self):  # no need to compact
+            self._log(self._discard, len(self._records))
+            self._records.append(rec)
+        else:
+            self._compact()
+            if position < 0:  # normalize the position as list.insert does
+                position = max(position + len(self._records), 0)
+            self._log(self.__delitem__, position)
+            self._records.insert(position, rec)
+
+    def _discard(self, n):
+        """
+        Remove the records with index >= n in the list of records, which
+        are the last appended ones, when reverting the appends
+        """
+        for rec in reversed(self._records[n:]):
+            for name, unique in self._unique_data.iteritems():
+                del unique.dict[getattr(rec, name)]
+            self._remove_from_indexes(rec)
+        del self._records[n:]
+
+    def _add_to_indexes(self, rec):
+        """Add a record to the secondary indexes"""
+        for idata in self._index_data.itervalues():
+            idata.add(idata.index.getkey(rec.row), rec)
+
+    def _remove_from_indexes(self, rec):
+        """Remove a record from the secondary indexes"""
+        for idata in self._index_data.itervalues():
+            idata.remove(idata.index.getkey(rec.row), rec)
+
+    def _check_batch(self, records):
+        """
+        Check the unique constraints on a list of records to be appended.
+        Return a dictionary unique name -> list of keys and a list of
+        error messages, one for each duplicated record.
+        """
+        start = len(self)
+        keys = {}
+        errors = []
+        for name, udata in self._unique_data.iteritems():
+            column = map(operator.attrgetter(name), records)
+            newkeys = set(column)
+            old = udata.dict  # membership tests only, it may not be a dict
+            if len(newkeys) < len(column) or any(
+                    key in old for key in newkeys):
+                seen = set()  # find the positions of the duplicates
+                for pos, key in enumerate(column, start):
+                    if key in seen or key in old:
+                        errors.append(duplicated(
+                            self.recordtype, pos, udata.names, key).args[0])
+                    seen.add(key)
+            keys[name] = column
+        return keys, errors
+
+    def _extend_checked(self, records, keys):
+        """
+        Append records already checked with `._check_batch`
+        """
+        self._log(self._discard, len(self._records))
+        for name, column in keys.iteritems():
+            self._unique_data[name].dict.update(
+                itertools.izip(column, records))
+        for rec in records:
+            self._add_to_indexes(rec)
+        self._records.extend(records)
+
+    def extend(self, records):
+        """
+        Append many records at once, by checking the unique constraints
+        in batch. If there are duplicates no record is appended and an
+        IntegrityError listing all of them is raised.
+        """
+        records = list(records)
+        keys, errors = self._check_batch(records)
+        if errors:
+            raise IntegrityError(errors)
+        self._extend_checked(records, keys)
 
     def getrecord(self, *pkey):
         """
@@ -481,10 +993,137 @@ class Table(collections.MutableSequence):
         """
         return self._unique_data['pkey'].dict[pkey]
 
+    def _new_index(self, name):
+        """
+        Return an empty IndexData for the reverse index of the foreign
+        key with the given name; raise a KeyError if there is no such
+        foreign key
+        """
+        for fkey in self.recordtype.get_descriptors(ForeignKey):
+            if fkey.name == name:
+                return IndexData(fkey.index)
+        raise KeyError(name)
+
+    def _get_index(self, name):
+        """
+        Return the IndexData with the given name; the reverse indexes of
+        the foreign keys are built at the first access and then kept
+        up to date
+        """
+        idata = self._index_data.get(name)
+        if idata is None:
+            self._compact()
+            idata = self._index_data[name] = self._new_index(name)
+            for rec in self._records:
+                idata.add(idata.index.getkey(rec.row), rec)
+        return idata
+
+    def _to_records(self, items):
+        """Convert a list of index items into a list of records"""
+        return list(items)
+
+    def lookup(self, indexname, *key):
+        """
+        Return the list of records with the given key (UTF8-encoded
+        strings) in the given index. The name of a foreign key can be
+        used too: then the records referring to the given key are
+        returned.
+        """
+        return self._to_records(self._get_index(indexname).lookup(key))
+
+    def range(self, indexname, low=None, high=None):
+        """
+        Return the list of records with low <= key < high in the given
+        sorted index, in key order. `low` and `high` are tuples of
+        casted values (or single values for indexes on a single field);
+        None means unbounded.
+        """
+        if low is not None and not isinstance(low, tuple):
+            low = (low,)
+        if high is not None and not isinstance(high, tuple):
+            high = (high,)
+        return self._to_records(self._get_index(indexname).range(low, high))
+
+    def groupby(self, indexname):
+        """
+        Yield pairs (key, records) for each key in the given index, in
+        key order for sorted indexes and in order of insertion otherwise.
+        """
+        idata = self._get_index(indexname)
+        for key in idata.iterkeys():
+            yield key, self._to_records(idata.groups[key])
+
     def is_valid(self):
         """True if all the records in the table are valid"""
         return all(rec.is_valid() for rec in self)
 
+    def _cast_columns(self, columns, offset):
+        """
+        Cast the given columns of strings; return a list of typed arrays
+        (or None for non-numeric fields). Raise an InvalidRecord error
+        for the first invalid row, numbered starting from `offset`, with
+        all its invalid fields, as :meth:`Record.cast` does.
+        """
+        typed = []
+        first = None  # the index of the first invalid row
+        for field, column in zip(self.recordtype.fields, columns):
+            try:
+                typed.append(field.cast_column(column))
+            except ValueError:  # find the first invalid row
+                for rowno, value in enumerate(column[:first]):
+                    try:
+                        field.cast(value)
+                    except ValueError:
+                        first = rowno
+                        break
+                typed.append(None)
+        if first is not None:
+            _, exc = self.recordtype(*[col[first] for col in columns]).cast()
+            exc.rowno = offset + first
+            raise exc
+        return typed
+
+    def _columns(self):
+        """
+        Return the list of the columns of strings and the list of the
+        typed columns (None for the non-numeric fields) of the table
+        """
+        self._compact()
+        columns = zip(*self._records) or [[]] * len(self.recordtype.fields)
+        raw = [numpy.array(col, 'S') if col else numpy.array([], 'S1')
+               for col in columns]
+        return raw, self._cast_columns(raw, 0)
+
+    def to_array(self):
+        """
+        Return a NumPy structured array with a column for each field.
+        The numeric fields are cast into typed columns (int, float or
+        bool, the NoneOr fields into float columns with NaN for the
+        missing values); the other fields are kept as strings. Raise an
+        InvalidRecord error if the table contains invalid records.
+        """
+        raw, typed = self._columns()
+        names = self.recordtype.fieldnames
+        cols = [r if t is None else t for r, t in zip(raw, typed)]
+        arr = numpy.zeros(len(raw[0]), [(name, col.dtype)
+                                        for name, col in zip(names, cols)])
+        for name, col in zip(names, cols):
+            arr[name] = col
+        return arr
+
+    @classmethod
+    def from_array(cls, recordtype, array, ordinal=None):
+        """
+        Build a table from a structured array, as returned by
+        :meth:`to_array`; the fields are converted back into strings
+        column by column.
+        """
+        raw = [_string_column(array[name]) for name in recordtype.fieldnames]
+        self = cls(recordtype, [], ordinal)
+        self.extend(itertools.starmap(
+            recordtype, itertools.izip(*[col.tolist() for col in raw])))
+        return self
+
     def __eq__(self, other):
         """
         A table is equal to another sequence if they have the same
@@ -512,20 +1151,754 @@ class Table(collections.MutableSequence):
 
     def __len__(self):
         """The number of records stored in the table"""
-        return len(self._records)
+        return len(self._records) - len(self._deleted)
+
+
+def _typed_column(values):
+    """
+    Convert a list of casted values into a typed NumPy array, if the
+    values are numbers (or booleans), otherwise return None. None values
+    are converted into NaNs.
+    """
+    types = set(type(v) for v in values)
+    if not types or not types <= set([int, long, float, bool, NoneType]):
+        return None
+    if NoneType in types:
+        return numpy.array([numpy.nan if v is None else v for v in values],
+                           float)
+    elif types == set([bool]):
+        return numpy.array(values, bool)
+    elif float in types:
+        return numpy.array(values, float)
+    return numpy.array(values, numpy.int64)
+
+
+def _string_column(column):
+    """
+    Convert a column of a structured array into an array of strings:
+    NaNs become empty strings and booleans 'true' and 'false'
+    """
+    if column.dtype.kind == 'S':
+        return column
+    elif column.dtype.kind == 'U':
+        return numpy.char.encode(column, 'utf8')
+    elif column.dtype.kind == 'b':
+        return numpy.where(column, 'true', 'false')
+    strings = column.astype('S')
+    if column.dtype.kind == 'f':
+        strings[numpy.isnan(column)] = ''
+    return strings
+
+
+class RowMapping(collections.Mapping):
+    """
+    A read-only mapping key -> record over a dictionary key -> row index
+    of a :class:`ColumnTable`; the records are materialized on demand.
+    """
+    def __init__(self, table, positions):
+        self.table = table
+        self.positions = positions
+
+    def __getitem__(self, key):
+        return self.table._record(self.positions[key])
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def _common_keys(*arrays):
+    """
+    Cast the given structured arrays of strings to a common dtype, with
+    the fields large enough for the values of all the arrays
+    """
+    names = arrays[0].dtype.names
+    dtype = [(name, 'S%d' % max(arr.dtype[name].itemsize for arr in arrays))
+             for name in names]
+    return [arr.astype(dtype) for arr in arrays]
+
+
+class ColumnUniqueData(UniqueData):
+    """
+    UniqueData for a :class:`ColumnTable`. Until the first lookup, the
+    constraint is checked on a sorted structured array with the keys of
+    the rows, so that loading a large table does not create a Python
+    object per row. The dictionary key -> row index `.positions` is
+    built at the first access and then updated incrementally; it is
+    rebuilt only when the row indices change. As for :class:`Table`,
+    `.dict` maps the keys to the records.
+    """
+    def __init__(self, table, unique):
+        self.table = table
+        self.unique = unique
+        self.indices = unique.indices
+        self._positions = None
+        self._sorted = None  # sorted keys of the checked rows, or None
+
+    @property
+    def positions(self):
+        if self._positions is None:  # index the checked rows
+            tbl = self.table
+            cols = [tbl._raw[i][:tbl._checked] for i in self.indices]
+            self._positions = dict(
+                (key, i) for i, key in enumerate(itertools.izip(*cols))
+                if i not in tbl._deleted)
+            self._sorted = None
+        return self._positions
+
+    def _keys(self, start, stop=None):
+        """
+        Return a structured array with the keys of the rows with
+        start <= index < stop
+        """
+        cols = [self.table._raw[i][start:stop] for i in self.indices]
+        return numpy.rec.fromarrays(cols).view(numpy.ndarray)
+
+    def merge_keys(self, start):
+        """
+        Check the keys of the rows with index >= start against the sorted
+        keys of the previous rows and return the sorted keys of all the
+        rows, which must be stored in `._sorted` by the caller. Raise a
+        KeyError for the first row with a duplicated key.
+        """
+        tbl = self.table
+        if self._sorted is None:
+            old = self._keys(0, start)
+            if tbl._deleted:
+                mask = numpy.ones(len(old), bool)
+                mask[[i for i in tbl._deleted if i < start]] = False
+                old = old[mask]
+            old.sort(kind='mergesort')
+        else:
+            old = self._sorted
+        old, new = _common_keys(old, self._keys(start))
+        order = numpy.argsort(new, kind='mergesort')  # stable
+        new_sorted = new[order]
+        dupl = numpy.zeros(len(new), bool)
+        # the repetitions of a key within the new rows, after the first one
+        dupl[order[1:]] = new_sorted[1:] == new_sorted[:-1]
+        idx = numpy.searchsorted(old, new_sorted)
+        if len(old):
+            dupl[order] |= old[numpy.minimum(idx, len(old) - 1)] == new_sorted
+        if dupl.any():
+            pos = dupl.argmax()
+            raise duplicated(tbl.recordtype, start + pos, self.unique.names,
+                             tuple(new[pos]))
+        return numpy.insert(old, idx, new_sorted)
+
+    def remove_keys(self, start, stop):
+        """
+        Remove from the sorted keys the keys of the rows with
+        start <= index < stop
+        """
+        old, keys = _common_keys(self._sorted, self._keys(start, stop))
+        self._sorted = numpy.delete(old, numpy.searchsorted(old, keys))
+
+    @property
+    def dict(self):
+        self.table.flush()  # the buffered records must be seen
+        return RowMapping(self.table, self.positions)
+
+    def invalidate(self):
+        """Discard the positions; they will be rebuilt when needed"""
+        self._positions = None
+        self._sorted = None
+
+
+class ColumnIndexData(IndexData):
+    """
+    IndexData for a :class:`ColumnTable`: the items are row indices and
+    `.nrows` is the number of rows already indexed, deleted ones included
+    """
+    def clear(self):
+        IndexData.clear(self)
+        self.nrows = 0
+
+
+class ColumnTable(Table):
+    """
+    Columnar version of :class:`Table`. Each field is stored in a NumPy
+    array of (UTF8-encoded) strings; moreover the numeric fields are
+    casted once, when the rows are consolidated, and stored in a typed
+    NumPy array, accessible with the method `.column(name)`. Records are
+    materialized on demand, so that the memory occupation does not
+    depend on the number of Python objects; modifications to a
+    materialized record are not stored in the table, use
+    `table[i] = record` instead.
+
+    Appended records are buffered and consolidated in batch at the first
+    read access (they are cast in chunks while appending, to limit the
+    memory occupation): at that moment they are validated and the unique
+    constraints are checked, possibly raising an InvalidRecord or a
+    KeyError exception and discarding the buffered records.
+
+    As for :class:`Table`, the rows deleted by :meth:`TableSet.delete`
+    are removed from the unique constraints and the indexes at once,
+    but they are removed from the columns lazily, at the next access by
+    position.
+    """
+    chunksize = 10000  # number of buffered rows cast at once
+
+    def __init__(self, recordtype, records, ordinal=None):
+        self.recordtype = recordtype
+        self.ordinal = ordinal  # not None if part of a TableSet
+        self._raw = [numpy.array([], 'S1') for _ in recordtype.fields]
+        self._typed = [None] * len(recordtype.fields)
+        self._pending = []  # rows to consolidate
+        self._checked = 0  # number of rows satisfying the unique constraints
+        self._deleted = set()  # indices of the rows to remove
+        self._unique_data = dict(
+            (u.name, ColumnUniqueData(self, u))
+            for u in recordtype.get_descriptors(Unique))
+        self._index_data = dict(
+            (i.name, ColumnIndexData(i))
+            for i in recordtype.get_descriptors(Index))
+        self._journal = None
+        self.extend(records)
+        self.flush()
+        self.attr = {}
+
+    @classmethod
+    def from_columns(cls, recordtype, raw, typed, ordinal=None):
+        """
+        Build a table from the columns of strings and the typed columns
+        (None for the non-numeric fields) of records already validated,
+        as saved by a snapshot; the columns are neither cast nor checked
+        and they are not copied.
+        """
+        self = cls(recordtype, [], ordinal)
+        self._raw = list(raw)
+        self._typed = list(typed)
+        self._checked = len(self._raw[0])
+        return self
+
+    def _cast(self, rows, offset):
+        """
+        Cast the columns of the given rows; return a list of typed
+        arrays (or None for non-numeric fields).
+        """
+        return self._cast_columns(
+            [[row[i] for row in rows]
+             for i in range(len(self.recordtype.fields))], offset)
+
+    def _columns(self):
+        """
+        Return the columns of strings and the typed columns of the table
+        """
+        self.flush()
+        self._compact()
+        return self._raw, self._typed
+
+    @classmethod
+    def from_array(cls, recordtype, array, ordinal=None):
+        """
+        Build a table from a structured array, as returned by
+        :meth:`to_array`; the fields are converted into strings and
+        validated column by column, without materializing the records.
+        """
+        self = cls(recordtype, [], ordinal)
+        self._raw = [_string_column(array[name])
+                     for name in recordtype.fieldnames]
+        self._typed = self._cast_columns(self._raw, 0)
+        self._check_unique(0)
+        self._checked = len(array)
+        return self
+
+    def _check_unique(self, start):
+        """
+        Check the unique constraints on the rows with index >= start, by
+        adding their keys to the positions of the constraints or, if the
+        positions have not been built yet, to the sorted keys. Raise a
+        KeyError if there are duplicates; in that case the added keys
+        are removed.
+        """
+        added = []  # pairs (udata, stop) of the keys added to the positions
+        merged = []  # pairs (udata, sorted keys) to store if there are no
+        # duplicates
+        try:
+            for udata in self._unique_data.itervalues():
+                if udata._positions is None:
+                    merged.append((udata, udata.merge_keys(start)))
+                    continue
+                positions = udata._positions
+                cols = [self._raw[i][start:] for i in udata.indices]
+                for pos, key in enumerate(itertools.izip(*cols), start):
+                    if key in positions:
+                        added.append((udata, pos))
+                        raise duplicated(
+                            self.recordtype, pos, udata.names, key)
+                    positions[key] = pos
+                added.append((udata, len(self._raw[0])))
+        except KeyError:
+            for udata, stop in added:
+                self._remove_keys(udata, start, stop)
+            raise
+        for udata, keys in merged:
+            udata._sorted = keys
+
+    def _remove_keys(self, udata, start, stop):
+        """
+        Remove from the positions of the given unique constraint the keys
+        of the rows with start <= index < stop
+        """
+        cols = [self._raw[i][start:stop] for i in udata.indices]
+        for key in itertools.izip(*cols):
+            del udata._positions[key]
+
+    def _consolidate(self):
+        """
+        Cast the buffered rows and append them to the columns
+        """
+        rows, self._pending = self._pending, []
+        start = len(self._raw[0])
+        typed = self._cast(rows, start)
+        self._append_columns(
+            [numpy.array(col, 'S') for col in zip(*rows)], typed, start)
+
+    def _append_columns(self, newcols, typed, start):
+        """
+        Append the given columns of strings and typed columns to the
+        table, which has `start` rows
+        """
+        self._raw = [numpy.concatenate([old, new])
+                     for old, new in zip(self._raw, newcols)]
+        for i, col in enumerate(typed):
+            if col is None:
+                self._typed[i] = None
+            elif start == 0:
+                self._typed[i] = col
+            elif self._typed[i] is not None:
+                self._typed[i] = numpy.concatenate([self._typed[i], col])
+
+    def extend_columns(self, columns):
+        """
+        Append the rows given as a list of columns of strings, one for
+        each field, without building the records. The columns are cast
+        and the unique constraints are checked at once, raising the same
+        errors as :meth:`extend` followed by :meth:`flush`; in that case
+        no row is appended.
+        """
+        self.flush()
+        if not len(columns[0]):
+            return
+        start = len(self._raw[0])
+        typed = self._cast_columns(columns, start)
+        self._log(self._discard, start)
+        self._append_columns(
+            [numpy.array(col, 'S') for col in columns], typed, start)
+        self.flush()
+
+    def _truncate(self, n):
+        """
+        Discard the buffered records and the rows with index >= n
+        """
+        self._pending = []
+        self._raw = [col[:n] for col in self._raw]
+        self._typed = [None if col is None else col[:n]
+                       for col in self._typed]
+        self._checked = n
+
+    def flush(self):
+        """
+        Consolidate the buffered records and check the unique constraints.
+        If the check fails the unchecked records are discarded.
+        """
+        start = self._checked
+        try:
+            if self._pending:
+                self._consolidate()
+            if start < len(self._raw[0]):
+                self._check_unique(start)
+        except (InvalidRecord, KeyError):
+            self._truncate(start)
+            raise
+        self._checked = len(self._raw[0])
+
+    def column(self, name):
+        """
+        Return the column with the given name, as a typed array for
+        numeric fields and as an array of strings otherwise.
+        """
+        self.flush()
+        self._compact()
+        i = self.recordtype.get_field_index(name)
+        typed = self._typed[i]
+        return self._raw[i] if typed is None else typed
+
+    def _record(self, i):
+        """Materialize the i-th record"""
+        return self.recordtype(*[col[i] for col in self._raw])
+
+    def _new_index(self, name):
+        """
+        Return an empty ColumnIndexData for the reverse index of the
+        foreign key with the given name
+        """
+        return ColumnIndexData(Table._new_index(self, name).index)
+
+    def _get_index(self, name):
+        """
+        Return the ColumnIndexData with the given name, after indexing the
+        rows added since the last access; the items are row indices.
+        """
+        self.flush()
+        idata = self._index_data.get(name)
+        if idata is None:
+            idata = self._index_data[name] = self._new_index(name)
+        start = idata.nrows
+        cols = [self._raw[i][start:] for i in idata.index.indices]
+        for pos, key in enumerate(itertools.izip(*cols), start):
+            if pos not in self._deleted:
+                idata.add(key, pos)
+        idata.nrows = len(self._raw[0])
+        return idata
+
+    def _to_records(self, items):
+        """Convert a list of row indices into a list of records"""
+        return map(self._record, items)
+
+    def _clear_indexes(self):
+        """Clear the secondary indexes; they will be rebuilt when needed"""
+        for idata in self._index_data.itervalues():
+            idata.clear()
+
+    def __getitem__(self, i):
+        """Return the i-th record or a list of records for slices"""
+        self.flush()
+        self._compact()
+        if isinstance(i, slice):
+            return map(self._record, range(*i.indices(len(self))))
+        return self._record(i)
+
+    def _set_row(self, i, row, typed, insert=False):
+        """
+        Store the given row and typed values at the position i; if
+        `insert` is true, the row is inserted before the position i.
+        """
+        for j, value in enumerate(row):
+            col = self._raw[j]
+            if len(value) > col.itemsize:  # make room for the value
+                col = col.astype('S%d' % len(value))
+            if insert:
+                col = numpy.insert(col, i, value)
+            else:
+                col[i] = value
+            self._raw[j] = col
+            tcol = self._typed[j]
+            if tcol is None:
+                continue
+            elif typed[j] is None:  # the column is not numeric anymore
+                tcol = None
+            else:
+                dtype = numpy.result_type(tcol, typed[j])
+                if dtype != tcol.dtype:
+                    tcol = tcol.astype(dtype)
+                if insert:
+                    tcol = numpy.insert(tcol, i, typed[j][0])
+                else:
+                    tcol[i] = typed[j][0]
+            self._typed[j] = tcol
+
+    def __setitem__(self, i, new_record):
+        """Set the i-th record, by checking the unique constraints"""
+        self.flush()
+        self._compact()
+        self._update_item(self._position(i), new_record)
+
+    # appended records are buffered and checked at consolidation time
+    extend = collections.MutableSequence.extend
+
+    def _extend_checked(self, records, keys):
+        """
+        Append records already checked with `._check_batch`
+        """
+        self.extend(records)
+
+    def __delitem__(self, i):
+        """Delete the i-th record"""
+        self.flush()
+        self._compact()
+        self._delete_items([self._position(i)])
+
+    def _item(self, rec):
+        """
+        Return the row index of the record with the same primary key of
+        the given one; raise a KeyError if there is no such record
+        """
+        self.flush()
+        return self._unique_data['pkey'].positions[rec.pkey]
+
+    def _update_item(self, item, new_record):
+        """
+        Replace the record in the row `item` with the new one, by checking
+        the unique constraints; they and the indexes are updated in place
+        """
+        self.flush()
+        row = list(new_record)
+        typed = self._cast([row], item)
+        for udata in self._unique_data.itervalues():
+            key = tuple(row[j] for j in udata.indices)
+            if udata.positions.get(key, item) != item:
+                raise duplicated(self.recordtype, item, udata.names, key)
+        old_row = [col[item] for col in self._raw]
+        self._log(self._update_item, item, self.recordtype(*old_row))
+        for udata in self._unique_data.itervalues():
+            del udata.positions[tuple(old_row[j] for j in udata.indices)]
+            udata.positions[tuple(row[j] for j in udata.indices)] = item
+        self._set_row(item, row, typed)
+        for idata in self._index_data.itervalues():
+            if item < idata.nrows:  # the row is indexed, update the index
+                idata.remove(idata.index.getkey(old_row), item)
+                idata.add(idata.index.getkey(row), item)
+
+    def _delete_items(self, items):
+        """
+        Delete the rows with the given indices from the unique constraints
+        and the indexes; they are removed from the columns lazily
+        """
+        self.flush()
+        self._log(self._undelete, items)
+        for pos in items:
+            row = [col[pos] for col in self._raw]
+            for udata in self._unique_data.itervalues():
+                del udata.positions[tuple(row[j] for j in udata.indices)]
+            for idata in self._index_data.itervalues():
+                if pos < idata.nrows:
+                    idata.remove(idata.index.getkey(row), pos)
+            self._deleted.add(pos)
+
+    def _undelete(self, items):
+        """
+        Revert the deletion of the given rows, which have not been removed
+        from the columns; they are added again to the unique constraints
+        and at the end of the groups of the indexes
+        """
+        for pos in items:
+            self._deleted.remove(pos)
+            row = [col[pos] for col in self._raw]
+            for udata in self._unique_data.itervalues():
+                udata.positions[tuple(row[j] for j in udata.indices)] = pos
+            for idata in self._index_data.itervalues():
+                if pos < idata.nrows:
+                    idata.add(idata.index.getkey(row), pos)
+
+    def _compact(self):
+        """
+        Remove the deleted rows from the columns; since the rows are
+        shifted, the unique constraints and the indexes are rebuilt when
+        needed
+        """
+        if self._deleted:
+            # numpy.delete returns new arrays, so the old ones can be restored
+            self._log(self._restore, self._raw, self._typed, self._deleted)
+            items = sorted(self._deleted)
+            self._raw = [numpy.delete(col, items) for col in self._raw]
+            self._typed = [None if col is None else numpy.delete(col, items)
+                           for col in self._typed]
+            self._restore(self._raw, self._typed)
+
+    def _restore(self, raw, typed, deleted=()):
+        """
+        Restore the columns as they were before a compaction or an
+        insertion in the middle; the unique constraints and the indexes
+        are rebuilt when needed
+        """
+        self._pending = []
+        self._raw = raw
+        self._typed = typed
+        self._deleted = set(deleted)
+        self._checked = len(raw[0])
+        for udata in self._unique_data.itervalues():
+            udata.invalidate()
+        self._clear_indexes()
+
+    def _discard(self, n):
+        """
+        Remove the rows with index >= n, buffered or not, which are the
+        last appended ones, when reverting the appends
+        """
+        size = len(self._raw[0])
+        if n >= size:
+            del self._pending[n - size:]
+            return
+        for udata in self._unique_data.itervalues():
+            if udata._positions is not None:
+                self._remove_keys(udata, n, self._checked)
+            elif udata._sorted is not None:
+                udata.remove_keys(n, self._checked)
+        for idata in self._index_data.itervalues():
+            for pos in xrange(idata.nrows - 1, n - 1, -1):
+                idata.remove(idata.index.getkey(
+                    [col[pos] for col in self._raw]), pos)
+            idata.nrows = min(idata.nrows, n)
+        self._truncate(n)
+
+    def insert(self, position, rec):
+        """
+        Insert a record in the table, at the given position index.
+        Records appended at the end are buffered.
+        """
+        if position >= len(self):
+            # the rows are counted including the deleted ones
+            self._log(self._discard, len(self._raw[0]) + len(self._pending))
+            self._pending.append(list(rec))
+            if len(self._pending) >= self.chunksize:
+                self._consolidate()
+            return
+        self.flush()
+        self._compact()
+        row = list(rec)
+        typed = self._cast([row], position)
+        for udata in self._unique_data.itervalues():
+            key = tuple(row[j] for j in udata.indices)
+            if key in udata.positions:
+                raise duplicated(self.recordtype, position, udata.names, key)
+        # numpy.insert returns new arrays, so the old ones can be restored
+        self._log(self._restore, self._raw, self._typed)
+        self._set_row(position, row, typed, insert=True)
+        self._checked += 1
+        for udata in self._unique_data.itervalues():
+            udata.invalidate()
+        self._clear_indexes()
+
+    def getrecord(self, *pkey):
+        """
+        Extract the record specified by the given primary key.
+        Raise a KeyError if the record is missing from the table.
+        """
+        self.flush()
+        return self._record(self._unique_data['pkey'].positions[pkey])
+
+    def __len__(self):
+        """The number of records stored in the table"""
+        return len(self._raw[0]) + len(self._pending) - len(self._deleted)
+
+
+class StreamTable(object):
+    """
+    A table whose records are not stored: they are read on demand from
+    an iterable, which can be consumed only once, either by iterating on
+    the table or by calling :meth:`groupby`. It is used to convert files
+    larger than the available memory, when the records in the files are
+    already in the order of the output.
+
+    The foreign keys are checked with the function `check_fk`, if any.
+    When iterating, the unique constraints are checked by storing only
+    the keys; when grouping, they are checked within each group, and
+    only for the constraints including all the fields of the index.
+    """
+    def __init__(self, recordtype, records, ordinal=None, check_fk=None):
+        self.recordtype = recordtype
+        self.ordinal = ordinal  # not None if part of a TableSet
+        self.check_fk = check_fk
+        self._records = iter(records)
+        self._consumed = False
+        self._unique_data = {}  # a StreamTable cannot be referred to
+        self.attr = {}
+
+    @property
+    def name(self):
+        return 'table' + self.recordtype.__name__
+
+    def flush(self):
+        """A StreamTable has no buffered records: do nothing"""
+
+    def _read(self):
+        """Yield pairs (position, record), checking the foreign keys"""
+        if self._consumed:
+            raise TypeError('%r can be read only once' % self)
+        self._consumed = True
+        for position, rec in enumerate(self._records):
+            if self.check_fk is not None:
+                self.check_fk(rec)
+            yield position, rec
+
+    def _check_unique(self, uniques, seen, position, rec):
+        """
+        Raise a KeyError if the record has the same key of a record
+        already seen for the given unique constraints
+        """
+        for unique in uniques:
+            key = getattr(rec, unique.name)
+            keys = seen[unique.name]
+            if key in keys:
+                raise duplicated(self.recordtype, position, unique.names, key)
+            keys.add(key)
+
+    def __iter__(self):
+        uniques = self.recordtype.get_descriptors(Unique)
+        seen = dict((unique.name, set()) for unique in uniques)
+        for position, rec in self._read():
+            self._check_unique(uniques, seen, position, rec)
+            yield rec
+
+    def groupby(self, indexname):
+        """
+        Yield pairs (key, records) for the runs of consecutive records
+        with the same key in the given index, in order of reading. Raise
+        a ValueError if the records with the same key are not consecutive.
+        """
+        for index in self.recordtype.get_descriptors(Index):
+            if index.name == indexname:
+                break
+        else:
+            raise KeyError(indexname)
+        uniques = [u for u in self.recordtype.get_descriptors(Unique)
+                   if set(index.names) <= set(u.names)]
+        done = set()
+        for key, group in itertools.groupby(
+                self._read(), lambda pair: index.getkey(pair[1].row)):
+            if key in done:
+                raise ValueError(
+                    'The records of %s with %s=%s are not consecutive' % (
+                        self.recordtype.__name__, ','.join(index.names),
+                        ','.join(key)))
+            done.add(key)
+            seen = dict((unique.name, set()) for unique in uniques)
+            recs = []
+            for position, rec in group:
+                self._check_unique(uniques, seen, position, rec)
+                recs.append(rec)
+            yield key, recs
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            self.recordtype.__name__)
 
 
 class TableSet(object):
     """
-    A set of tables associated to the same converter
+    A set of tables associated to the same converter. By default the
+    tables are instances of :class:`Table`; pass `tabletype=ColumnTable`
+    to use the columnar storage.
+
+    A batch of modifications can be performed atomically in a transaction::
+
+     with tableset.transaction():
+         tableset.update(rec1, new_rec1)
+         tableset.delete(rec2)
+
+    The tables are not copied: each modification records in an undo
+    log how to revert it, so that the cost of a rollback is proportional
+    to the number of modifications.
     """
-    def __init__(self, convertertype, tables=None):
+    def __init__(self, convertertype, tables=None, tabletype=Table):
         self.convertertype = convertertype
         self.name = convertertype.__name__
+        self.tabletype = tabletype
         self.tables = tables or [
-            Table(rt, [], ordinal)
+            tabletype(rt, [], ordinal)
             for ordinal, rt in enumerate(convertertype.recordtypes())]
+        self._journal = None  # undo log of the current transaction
+        self._marks = []  # lengths of the undo log at each begin
         self.fkdict = {}
+        # record type -> list of pairs (foreign key, referring table)
+        self.referrers = collections.defaultdict(list)
         for tbl in self.tables:
             rt = tbl.recordtype
             setattr(self, 'table' + rt.__name__, tbl)
@@ -534,9 +1907,11 @@ class TableSet(object):
                 target_name = 'table' + target.recordtype.__name__
                 target_tbl = getattr(self, target_name)
                 self.fkdict[fkey] = target_tbl._unique_data[target.name]
+                self.referrers[target.recordtype].append((fkey, tbl))
 
     def __getitem__(self, sliceobj):
-        return self.__class__(self.convertertype, self.tables[sliceobj])
+        return self.__class__(self.convertertype, self.tables[sliceobj],
+                              self.tabletype)
 
     def __iter__(self):
         """
@@ -546,6 +1921,79 @@ class TableSet(object):
             if len(table):
                 yield table
 
+    def begin(self):
+        """
+        Start a transaction: from now on the modifications of the tables
+        are recorded in an undo log, until :meth:`commit` or
+        :meth:`rollback` is called. The buffered records of the tables
+        are validated first. Transactions can be nested: a nested
+        transaction works as a savepoint of the enclosing one.
+        """
+        if self._journal is None:
+            for tbl in self.tables:
+                tbl.flush()
+            self._journal = []
+            self._attach(self._journal)
+        self._marks.append(len(self._journal))
+
+    def _attach(self, journal):
+        """Set the undo log of all the tables"""
+        for tbl in self.tables:
+            tbl._journal = journal
+
+    def commit(self):
+        """
+        End the current transaction, keeping its modifications. The
+        outermost transaction validates the buffered records and discards
+        the undo log; if the validation fails it is rolled back and the
+        error is raised.
+        """
+        if not self._marks:
+            raise RuntimeError('There is no transaction to commit')
+        if len(self._marks) == 1:
+            try:
+                for tbl in self.tables:
+                    tbl.flush()
+            except (InvalidRecord, KeyError):
+                self.rollback()
+                raise
+            self._journal = None
+            self._attach(None)
+        self._marks.pop()
+
+    def rollback(self):
+        """
+        End the current transaction, by reverting its modifications in
+        reverse order
+        """
+        if not self._marks:
+            raise RuntimeError('There is no transaction to roll back')
+        mark = self._marks.pop()
+        journal = self._journal
+        self._attach(None)  # the reverting operations are not logged
+        while len(journal) > mark:
+            undo, args = journal.pop()
+            undo(*args)
+        if self._marks:
+            self._attach(journal)
+        else:
+            self._journal = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager performing the modifications in its block in a
+        transaction, which is committed at the end of the block or
+        rolled back if an exception is raised
+        """
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
     def check_fk(self, rec):
         """
         Check is a record has a companion record in the referenced table.
@@ -553,9 +2001,7 @@ class TableSet(object):
         for fkey in rec.__class__.get_descriptors(ForeignKey):
             fkvalues = getattr(rec, fkey.name)
             if not fkvalues in self.fkdict[fkey].dict:
-                raise ForeignKeyError(
-                    'Missing record in table %s corresponding to the keys %s'
-                    % (fkey.unique.recordtype.__name__, fkvalues))
+                raise missing(fkey, fkvalues)
 
     def insert(self, rec):
         """
@@ -568,17 +2014,110 @@ class TableSet(object):
 
     def insert_all(self, recs):
         """
-        Insert a set of records in the right tables;
-        may raise a ForeignKeyError.
+        Insert a set of records in the right tables. The records are
+        grouped by type and the unique and foreign key constraints are
+        checked in batch, in the order of definition of the record types.
+        If there are violations no record is inserted and an
+        IntegrityError listing all of them is raised.
         """
+        groups = collections.defaultdict(list)
         for rec in recs:
-            self.insert(rec)
+            groups[rec.__class__].append(rec)
+        rectypes = sorted(groups, key=operator.attrgetter('_ordinal'))
+        newkeys = {}  # UniqueData -> set of the keys to be inserted
+        checked = []
+        errors = []
+        for rectype in rectypes:
+            group = groups[rectype]
+            for fkey in rectype.get_descriptors(ForeignKey):
+                udata = self.fkdict[fkey]
+                column = map(operator.attrgetter(fkey.name), group)
+                # membership tests, since the keys of the referenced table
+                # may not be stored in a dictionary
+                keys = udata.dict
+                new = newkeys.get(udata, ())
+                absent = set(k for k in set(column)
+                             if k not in keys and k not in new)
+                for fkvalues in column:
+                    if fkvalues in absent:
+                        absent.remove(fkvalues)
+                        errors.append(missing(fkey, fkvalues).args[0])
+            tbl = getattr(self, 'table' + rectype.__name__)
+            keys, errs = tbl._check_batch(group)
+            errors.extend(errs)
+            for name, column in keys.iteritems():
+                newkeys[tbl._unique_data[name]] = set(column)
+            checked.append((tbl, group, keys))
+        if errors:
+            raise IntegrityError(errors)
+        for tbl, group, keys in checked:
+            tbl._extend_checked(group, keys)
+
+    def _referring(self, rec):
+        """
+        Yield triples (fkey, table, items) for the records referring
+        to the given record, found with the reverse indexes
+        """
+        for fkey, tbl in self.referrers[rec.__class__]:
+            key = getattr(rec, fkey.unique.name)
+            items = tbl._get_index(fkey.name).lookup(key)
+            if items:
+                yield fkey, tbl, list(items)
 
     def delete(self, rec):
         """
-        Delete a record by cascading on the ForeignKeys
+        Delete a record by cascading on the ForeignKeys, i.e. the
+        records referring to it are deleted too, recursively. The
+        records to delete are found with the reverse indexes of the
+        foreign keys, then each affected table is compacted once.
+        Raise a KeyError if the record is not in the table set.
         """
-        raise NotImplementedError
+        tbl = getattr(self, 'table' + rec.__class__.__name__)
+        doomed = collections.OrderedDict()  # table -> {pkey: item}
+        stack = [(tbl, tbl._item(rec))]
+        while stack:
+            tbl, item = stack.pop()
+            [rec] = tbl._to_records([item])
+            items = doomed.setdefault(tbl, {})
+            if rec.pkey in items:
+                continue
+            items[rec.pkey] = item
+            for _fkey, reftbl, refitems in self._referring(rec):
+                stack.extend((reftbl, refitem) for refitem in refitems)
+        for tbl, items in doomed.iteritems():
+            tbl._delete_items(items.values())
+
+    def update(self, rec, new_rec):
+        """
+        Replace a record with a new one, by checking the unique and
+        foreign key constraints; if the key referred by other records
+        changes, the referring records are updated too, recursively.
+        The unique constraints and the indexes are updated incrementally.
+        Raise a KeyError if the record is not in the table set. If a
+        referring record cannot be updated, no change is performed.
+        """
+        with self.transaction():
+            self._update(rec, new_rec)
+
+    def _update(self, rec, new_rec):
+        """Update a record, and the referring records recursively"""
+        assert rec.__class__ is new_rec.__class__, (rec, new_rec)
+        tbl = getattr(self, 'table' + rec.__class__.__name__)
+        item = tbl._item(rec)
+        [old] = tbl._to_records([item])
+        oldrow = old.row  # a Table updates the stored record in place
+        self.check_fk(new_rec)
+        referring = list(self._referring(old))
+        tbl._update_item(item, new_rec)
+        for fkey, reftbl, refitems in referring:
+            newkey = getattr(new_rec, fkey.unique.name)
+            if newkey == fkey.unique.getkey(oldrow):
+                continue
+            for refrec in reftbl._to_records(refitems):
+                row = list(refrec)
+                for i, value in zip(fkey.indices, newkey):
+                    row[i] = value
+                self._update(refrec, refrec.__class__(*row))
 
     def to_node(self):
         """
@@ -591,3 +2130,36 @@ class TableSet(object):
 
     def __len__(self):
         return len(self.tables)
+
+
+class StreamTableSet(TableSet):
+    """
+    A TableSet where the tables of the record types in `streams` are
+    :class:`StreamTable` objects reading the given iterables, checking
+    the foreign keys against the other tables. Since the records are not
+    stored, the table set can be converted only once.
+
+    :param convertertype: a converter class
+    :param streams: a dictionary record type name -> iterable of records
+    :param tabletype: the type of the other tables
+    """
+    def __init__(self, convertertype, streams, tabletype=Table):
+        tables = []
+        for ordinal, rt in enumerate(convertertype.recordtypes()):
+            if rt.__name__ in streams:
+                tables.append(StreamTable(rt, streams[rt.__name__], ordinal,
+                                          check_fk=self.check_fk))
+            else:
+                tables.append(tabletype(rt, [], ordinal))
+        TableSet.__init__(self, convertertype, tables, tabletype)
+        self._converted = False
+
+    def to_node(self):
+        """
+        Convert the table set into a node object; raise a TypeError if
+        it has been converted already
+        """
+        if self._converted:
+            raise TypeError('%r can be converted only once' % self)
+        self._converted = True
+        return TableSet.to_node(self)
@@ -17,7 +17,8 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 from openquake.nrmllib.node import Node
-from openquake.commonlib.record import Record, Field, Unique, ForeignKey
+from openquake.commonlib.record import (
+    Record, Field, Unique, ForeignKey, Index)
 from openquake.commonlib import valid
 
 
@@ -65,6 +66,7 @@ class DiscreteVulnerabilityData(Record):
     pkey = Unique('vulnerabilitySetID', 'vulnerabilityFunctionID', 'IML')
     fkey = ForeignKey(DiscreteVulnerability.pkey,
                       'vulnerabilitySetID', 'vulnerabilityFunctionID')
+    function = Index('vulnerabilitySetID', 'vulnerabilityFunctionID')
 
     vulnerabilitySetID = Field(str)
     vulnerabilityFunctionID = Field(str)
@@ -120,6 +122,7 @@ class FFSetDiscrete(Record):
 class FFDataDiscrete(Record):
     convertername = 'FragilityDiscrete'
     pkey = Unique('limitState', 'ffs_ordinal', 'iml')
+    function = Index('limitState', 'ffs_ordinal')
 
     limitState = Field(str)
     ffs_ordinal = Field(int)
@@ -181,6 +184,7 @@ class FFSetContinuous(Record):
 class FFDataContinuous(Record):
     convertername = 'FragilityContinuous'
     pkey = Unique('limitState', 'ffs_ordinal', 'param')
+    function = Index('limitState', 'ffs_ordinal')
 
     limitState = Field(str)
     ffs_ordinal = Field(int)
@@ -286,6 +290,7 @@ class Asset(Record):
 class Occupancy(Record):
     convertername = 'Exposure'
     pkey = Unique('asset_ref', 'period')
+    asset = Index('asset_ref')
 
     asset_ref = Field(str)
     period = Field(str)
@@ -380,6 +385,7 @@ class Gmf(Record):
 class GmfData(Record):
     convertername = 'GmfCollection'
     pkey = Unique('stochasticEventSetId', 'imtStr', 'ruptureId', 'lon', 'lat')
+    gmf = Index('stochasticEventSetId', 'imtStr', 'ruptureId')
 
     stochasticEventSetId = Field(int)
     imtStr = Field(str)
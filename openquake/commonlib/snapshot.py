@@ -0,0 +1,154 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary snapshots of TableSets. A snapshot is a directory containing
+a .npy file for each table, storing a NumPy structured array with a
+column of strings for each field and a typed column for each numeric
+field, plus a MANIFEST file in JSON format with the name of the
+converter, the fields of its record types and the size, modification
+time and hash of the CSV files the tables were read from.
+When a snapshot is loaded the arrays are memory-mapped copy-on-write,
+so that the data are neither parsed nor cast again and are read from
+the disk only when accessed.
+"""
+import os
+import json
+import hashlib
+import itertools
+
+import numpy
+
+from openquake.commonlib.record import TableSet, ColumnTable
+
+MANIFEST = 'MANIFEST'
+BLOCKSIZE = 1024 * 1024  # bytes read at once when hashing the files
+
+
+def typedname(fieldname):
+    """The name of the typed column associated to a field"""
+    return '%s:typed' % fieldname
+
+
+def file_hash(archive, fname):
+    """
+    Return the SHA1 hash of the content of a file in the archive
+    """
+    h = hashlib.sha1()
+    with archive.open(fname, 'r') as f:
+        for block in iter(lambda: f.read(BLOCKSIZE), ''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def schema(convertertype):
+    """
+    Return a dictionary record type name -> list of pairs [field name,
+    name of the cast function] for the record types of the converter;
+    a snapshot can be loaded only by a converter with the same schema.
+    """
+    return dict((rt.__name__, [[f.name, getattr(f.cast, '__name__',
+                                                repr(f.cast))]
+                               for f in rt.fields])
+                for rt in convertertype.recordtypes())
+
+
+def save(tableset, dirname, inputs=None):
+    """
+    Save a snapshot of the table set in the given directory; the tables
+    must contain valid records. The MANIFEST is written last, so that
+    an interrupted save does not produce a valid snapshot.
+
+    :param tableset: a :class:`openquake.commonlib.record.TableSet`
+    :param dirname: the directory where to store the .npy files
+    :param inputs:
+        a dictionary fname -> dict(size=..., mtime=..., sha1=...)
+        describing the source files
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    manifest = os.path.join(dirname, MANIFEST)
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    for tbl in tableset.tables:
+        raw, typed = tbl._columns()
+        names = tbl.recordtype.fieldnames
+        dtype = [(name, col.dtype) for name, col in zip(names, raw)] + [
+            (typedname(name), col.dtype) for name, col in zip(names, typed)
+            if col is not None]
+        arr = numpy.zeros(len(raw[0]), dtype)
+        for name, col in zip(names, raw):
+            arr[name] = col
+        for name, col in zip(names, typed):
+            if col is not None:
+                arr[typedname(name)] = col
+        # the file is replaced and not overwritten, since the old one
+        # could be memory-mapped
+        fname = os.path.join(dirname, tbl.recordtype.__name__ + '.npy')
+        with open(fname + '.tmp', 'wb') as f:
+            numpy.save(f, arr)
+        os.rename(fname + '.tmp', fname)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump(dict(converter=tableset.name, inputs=inputs,
+                       schema=schema(tableset.convertertype)), f)
+    os.rename(manifest + '.tmp', manifest)
+
+
+def read_manifest(dirname):
+    """
+    Return the manifest of the snapshot in the given directory, as a
+    dictionary, or None if there is no valid snapshot
+    """
+    try:
+        with open(os.path.join(dirname, MANIFEST)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def load(convertertype, dirname, tabletype=ColumnTable):
+    """
+    Load a table set from the snapshot in the given directory. For
+    ColumnTables the memory-mapped columns are used directly, otherwise
+    the records are built from the columns of strings. Raise a
+    ValueError if the snapshot was saved with a different schema.
+
+    :param convertertype: the converter class
+    :param dirname: the directory containing the snapshot
+    :param tabletype: :class:`Table` or :class:`ColumnTable`
+    """
+    manifest = read_manifest(dirname) or {}
+    if manifest.get('schema') != schema(convertertype):
+        raise ValueError('The snapshot in %s does not match the record '
+                         'types of %s' % (dirname, convertertype.__name__))
+    tables = []
+    for ordinal, rt in enumerate(convertertype.recordtypes()):
+        arr = numpy.load(os.path.join(dirname, rt.__name__ + '.npy'),
+                         mmap_mode='c')
+        raw = [arr[name] for name in rt.fieldnames]
+        if issubclass(tabletype, ColumnTable):
+            typed = [arr[typedname(name)]
+                     if typedname(name) in arr.dtype.names else None
+                     for name in rt.fieldnames]
+            tables.append(tabletype.from_columns(rt, raw, typed, ordinal))
+        else:
+            tbl = tabletype(rt, [], ordinal)
+            tbl.extend(itertools.starmap(
+                rt, itertools.izip(*[col.tolist() for col in raw])))
+            tables.append(tbl)
+    return TableSet(convertertype, tables, tabletype)
@@ -126,15 +126,21 @@ class SourceCollector(object):
         the maximum weight.
 
         :param src_filter: a filtering function on sources
-        :param max_weight: the limit used to collect the sources
+        :param max_weight:
+            the limit used to collect the sources, or a callable returning
+            the current limit, such as a
+            :class:`openquake.commonlib.parallel.GranularityTuner` instance;
+            in the latter case the limit is used as it is and it can change
+            while the blocks are generated
         :param discr: area source discretization
         """
         num_sources = len(self.sources)
         assert num_sources, 'No sources for TRT=%s!' % self.trt
+        if not callable(max_weight):
+            max_weight = max_weight * num_sources / (num_sources + 100)
         return block_splitter(
             self._filter_and_split_sources(src_filter, discr),
-            max_weight * num_sources / (num_sources + 100),
-            self.update_num_ruptures)
+            max_weight, self.update_num_ruptures)
 
     def __repr__(self):
         return '<%s TRT=%s, %d source(s)>' % (self.__class__.__name__,
@@ -0,0 +1,605 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A TableSet stored in a SQLite database, in memory or on disk, so that
+it is possible to convert files larger than the available RAM.
+Each record type is stored in a table with a TEXT column for each
+field; the Unique constraints are mapped to UNIQUE constraints, the
+ForeignKey constraints to FOREIGN KEY constraints and the Index
+descriptors to indexes. The tables have the same interface as
+:class:`openquake.commonlib.record.Table` used by the converters
+(iteration, indexing, `getrecord`, `lookup`, `range`, `groupby`),
+but the records are read from the database on demand.
+"""
+import bisect
+import sqlite3
+import itertools
+import contextlib
+import collections
+
+from openquake.commonlib import record
+from openquake.commonlib.record import (
+    Table, TableSet, Unique, ForeignKey, Index, IntegrityError,
+    duplicated, missing)
+
+
+def quote(name):
+    """Quote a SQL identifier"""
+    return '"%s"' % name
+
+
+def columns(names, prefix=''):
+    """
+    >>> columns(['lon', 'lat'], 't.')
+    't."lon", t."lat"'
+    """
+    return ', '.join(prefix + quote(n) for n in names)
+
+
+def where(names):
+    """
+    >>> where(['lon', 'lat'])
+    '"lon" = ? AND "lat" = ?'
+    """
+    return ' AND '.join('%s = ?' % quote(n) for n in names)
+
+
+def equal(names1, names2, prefix1='', prefix2=''):
+    """
+    >>> equal(['a', 'b'], ['x', 'y'], 't.', 'p.')
+    't."a" = p."x" AND t."b" = p."y"'
+    """
+    return ' AND '.join(
+        '%s%s = %s%s' % (prefix1, quote(n1), prefix2, quote(n2))
+        for n1, n2 in zip(names1, names2))
+
+
+class SqlUniqueData(record.UniqueData, collections.Mapping):
+    """
+    UniqueData of a :class:`SqlTable`. As for a :class:`Table`, `.dict`
+    maps the keys to the records: here it is the object itself, a
+    read-only mapping querying the database.
+    """
+    def __init__(self, table, unique):
+        self.table = table
+        self.unique = unique
+        self._where = where(unique.names)
+
+    @property
+    def dict(self):
+        return self
+
+    def __getitem__(self, key):
+        for rec in self.table._select(self._where, key):
+            return rec
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.table.conn.execute('SELECT 1 FROM %s WHERE %s' % (
+            self.table.sqlname, self._where), key).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.table.conn.execute('SELECT %s FROM %s' % (
+            columns(self.unique.names), self.table.sqlname)))
+
+    def __len__(self):
+        return len(self.table)
+
+
+class SqlIndexData(object):
+    """
+    The counterpart of :class:`openquake.commonlib.record.IndexData` for
+    a :class:`SqlTable`, used to find the records referring to a given
+    one: the items are rowids, found with the SQL index on the fields
+    """
+    def __init__(self, table, names):
+        self.table = table
+        self._sql = 'SELECT rowid FROM %s WHERE %s ORDER BY rowid' % (
+            table.sqlname, where(names))
+
+    def lookup(self, key):
+        """Return the rowids of the records with the given key"""
+        return [row[0] for row in self.table.conn.execute(self._sql, key)]
+
+
+class SqlTable(Table):
+    """
+    A table of records stored in SQLite; the records are materialized on
+    demand. The rowids are kept contiguous, so that the i-th record has
+    rowid i + 1 and it can be accessed directly. The records can only be
+    appended: the converters never insert in the middle, which would
+    require to renumber the following records. Deleting a record
+    renumbers the following ones, which is linear in their number, as
+    for a list. The constraints are enforced by SQLite and the
+    violations are reported with the same exceptions raised by
+    :class:`Table`.
+    """
+    def __init__(self, recordtype, conn, ordinal=None):
+        self.recordtype = recordtype
+        self.ordinal = ordinal  # not None if part of a TableSet
+        self.conn = conn
+        self.attr = {}
+        self._journal = None  # the transactions are managed by SQLite
+        self.sqlname = quote(recordtype.__name__)
+        fieldnames = recordtype.fieldnames
+        self._insert_sql = 'INSERT INTO %s VALUES (%s)' % (
+            self.sqlname, ', '.join('?' * len(fieldnames)))
+        self._unique_data = dict(
+            (u.name, SqlUniqueData(self, u))
+            for u in recordtype.get_descriptors(Unique))
+        self.create()
+        self._len = conn.execute(
+            'SELECT COUNT(*) FROM %s' % self.sqlname).fetchone()[0]
+
+    def create(self):
+        """Create the SQL table and its indexes, if they do not exist"""
+        rt = self.recordtype
+        defs = ['%s TEXT NOT NULL' % quote(n) for n in rt.fieldnames]
+        for unique in rt.get_descriptors(Unique):
+            defs.append('UNIQUE (%s)' % columns(unique.names))
+        for fkey in rt.get_descriptors(ForeignKey):
+            defs.append('FOREIGN KEY (%s) REFERENCES %s (%s)' % (
+                columns(fkey.names), quote(fkey.unique.recordtype.__name__),
+                columns(fkey.unique.names)))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+            self.sqlname, ', '.join(defs)))
+        # the indexes on the foreign keys are used to find the referring
+        # records when deleting or updating in cascade
+        for index in (rt.get_descriptors(Index) +
+                      rt.get_descriptors(ForeignKey)):
+            self.conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                quote('%s_%s' % (rt.__name__, index.name)), self.sqlname,
+                columns(index.names)))
+
+    def _select(self, cond='', args=(), order='rowid'):
+        """Yield the records satisfying the given WHERE condition"""
+        sql = 'SELECT * FROM %s' % self.sqlname
+        if cond:
+            sql += ' WHERE ' + cond
+        sql += ' ORDER BY ' + order
+        for row in self.conn.execute(sql, args):
+            yield self.recordtype(*row)
+
+    def _rowid(self, i):
+        """Return the rowid of the i-th record; raise an IndexError"""
+        return self._position(i) + 1
+
+    def __iter__(self):
+        return self._select()
+
+    def __getitem__(self, i):
+        """Return the i-th record or a list of records for slices"""
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self._len)
+            if step != 1:
+                return [self[j] for j in range(start, stop, step)]
+            return list(self._select('rowid > ? AND rowid <= ?',
+                                     (start, stop)))
+        [rec] = self._select('rowid = ?', (self._rowid(i),))
+        return rec
+
+    def __setitem__(self, i, new_record):
+        """Set the i-th record, by checking the constraints"""
+        self._update_item(self._rowid(i), new_record)
+
+    def __delitem__(self, i):
+        """Delete the i-th record"""
+        self._delete_items([self._rowid(i)])
+
+    def _item(self, rec):
+        """
+        Return the rowid of the record with the same primary key of the
+        given one; raise a KeyError if there is no such record
+        """
+        row = self.conn.execute('SELECT rowid FROM %s WHERE %s' % (
+            self.sqlname, where(self.recordtype.pkey.names)),
+            rec.pkey).fetchone()
+        if row is None:
+            raise KeyError(rec.pkey)
+        return row[0]
+
+    def _to_records(self, items):
+        """Convert a list of rowids into a list of records"""
+        return [self._select('rowid = ?', (rowid,)).next()
+                for rowid in items]
+
+    def _get_index(self, name):
+        """
+        Return the SqlIndexData of the index or foreign key with the
+        given name
+        """
+        for descr in (self.recordtype.get_descriptors(Index) +
+                      self.recordtype.get_descriptors(ForeignKey)):
+            if descr.name == name:
+                return SqlIndexData(self, descr.names)
+        raise KeyError(name)
+
+    def _update_item(self, item, new_record):
+        """Replace the record with rowid `item` with the new one"""
+        sets = ', '.join('%s = ?' % quote(n)
+                         for n in self.recordtype.fieldnames)
+        try:
+            self.conn.execute('UPDATE %s SET %s WHERE rowid = ?' % (
+                self.sqlname, sets), tuple(new_record) + (item,))
+        except sqlite3.IntegrityError as exc:
+            self._raise(exc, new_record, item - 1, item)
+
+    def _delete_items(self, items):
+        """
+        Delete the records with the given rowids at once and renumber the
+        following ones; raise a ForeignKeyError if some of them are
+        referred by other records, leaving the table unchanged
+        """
+        rowids = sorted(items)
+        self.conn.execute('SAVEPOINT delete_items')
+        try:
+            self.conn.executemany('DELETE FROM %s WHERE rowid = ?' %
+                                  self.sqlname, [(r,) for r in rowids])
+        except sqlite3.IntegrityError as exc:
+            self.conn.execute('ROLLBACK TO delete_items')
+            self.conn.execute('RELEASE delete_items')
+            raise record.ForeignKeyError(
+                'Cannot delete the records %s of table %s: %s' % (
+                    [r - 1 for r in rowids], self.recordtype.__name__, exc))
+        # the records between the n-th and the (n+1)-th deleted record
+        # move back by n + 1 positions
+        for n, (rowid, stop) in enumerate(
+                zip(rowids, rowids[1:] + [self._len + 1])):
+            self.conn.execute(
+                'UPDATE %s SET rowid = -(rowid - ?) WHERE rowid > ? AND '
+                'rowid < ?' % self.sqlname, (n + 1, rowid, stop))
+        self.conn.execute('UPDATE %s SET rowid = -rowid WHERE rowid < 0' %
+                          self.sqlname)
+        self.conn.execute('RELEASE delete_items')
+        self._len -= len(rowids)
+
+    def insert(self, position, rec):
+        """
+        Append a record; inserting in the middle is not supported, since
+        it would renumber all the following records. Raise a KeyError or
+        a ForeignKeyError if the constraints are violated.
+        """
+        if position < self._len:
+            raise NotImplementedError(
+                'Cannot insert at position %d of table %s: the records '
+                'can only be appended' % (position, self.recordtype.__name__))
+        try:
+            self.conn.execute(self._insert_sql, tuple(rec))
+        except sqlite3.IntegrityError as exc:
+            self._raise(exc, rec, self._len)
+        self._len += 1
+
+    def _raise(self, exc, rec, position, rowid=None):
+        """
+        Convert a sqlite3.IntegrityError on the given record into a
+        KeyError or a ForeignKeyError
+        """
+        rt = self.recordtype
+        for unique in rt.get_descriptors(Unique):
+            key = unique.getkey(tuple(rec))
+            found = self.conn.execute(
+                'SELECT rowid FROM %s WHERE %s' % (
+                    self.sqlname, where(unique.names)), key).fetchone()
+            if found and found[0] != rowid:
+                raise duplicated(rt, position, unique.names, key)
+        for fkey in rt.get_descriptors(ForeignKey):
+            key = fkey.getkey(tuple(rec))
+            target = fkey.unique
+            if not self.conn.execute('SELECT 1 FROM %s WHERE %s' % (
+                    quote(target.recordtype.__name__), where(target.names)),
+                    key).fetchone():
+                raise missing(fkey, key)
+        # for instance an update of a record referenced by other records
+        raise record.ForeignKeyError(str(exc))
+
+    def extend(self, records):
+        """
+        Append many records at once. If the constraints are violated no
+        record is appended and an IntegrityError listing all the
+        violations is raised.
+        """
+        errors = self._insert_rows(list(records))
+        if errors:
+            raise IntegrityError(errors)
+
+    def _insert_rows(self, records, keep_valid=False):
+        """
+        Insert the records in a single transaction; if some constraint
+        is violated, the transaction is rolled back and the list of the
+        violations is returned. If `keep_valid` is true, the valid records
+        are inserted anyway, so that the records of the dependent tables
+        can be checked against them.
+        """
+        self.conn.execute('SAVEPOINT insert_rows')
+        try:
+            self.conn.executemany(self._insert_sql,
+                                  (tuple(rec) for rec in records))
+        except sqlite3.IntegrityError:
+            self.conn.execute('ROLLBACK TO insert_rows')
+            self.conn.execute('RELEASE insert_rows')
+            errors = self._violations(records)
+            if keep_valid:
+                for rec in records:
+                    try:
+                        self.conn.execute(self._insert_sql, tuple(rec))
+                    except sqlite3.IntegrityError:
+                        continue
+                    self._len += 1
+            return errors
+        self.conn.execute('RELEASE insert_rows')
+        self._len += len(records)
+        return []
+
+    def _violations(self, records):
+        """
+        Return the list of the violations of the Unique and ForeignKey
+        constraints for the given records, in the same format used by
+        :meth:`openquake.commonlib.record.TableSet.insert_all`. The
+        check is performed by SQLite, by storing the records in a
+        temporary table.
+        """
+        rt = self.recordtype
+        names = rt.fieldnames
+        batch = quote('batch_' + rt.__name__)
+        cur = self.conn.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS %s (seq INTEGER, %s)'
+                    % (batch, columns(names)))
+        cur.execute('DELETE FROM %s' % batch)
+        cur.executemany('INSERT INTO %s VALUES (?, %s)' % (
+            batch, ', '.join('?' * len(names))),
+            ((i,) + tuple(rec) for i, rec in enumerate(records)))
+        errors = []
+        for fkey in rt.get_descriptors(ForeignKey):
+            target = fkey.unique
+            cur.execute(
+                'SELECT %s, MIN(seq) FROM %s AS b WHERE NOT EXISTS '
+                '(SELECT 1 FROM %s AS p WHERE %s) GROUP BY %s ORDER BY 2' % (
+                    columns(fkey.names, 'b.'), batch,
+                    quote(target.recordtype.__name__),
+                    equal(target.names, fkey.names, 'p.', 'b.'),
+                    columns(fkey.names, 'b.')))
+            for row in cur.fetchall():
+                errors.append(missing(fkey, tuple(row[:-1])).args[0])
+        for unique in sorted(rt.get_descriptors(Unique),
+                             key=lambda u: u.name):
+            cur.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                quote('batch_%s_%s' % (rt.__name__, unique.name)), batch,
+                columns(unique.names)))
+            cur.execute(
+                'SELECT seq, %s FROM %s AS b WHERE EXISTS '
+                '(SELECT 1 FROM %s AS t WHERE %s) OR EXISTS '
+                '(SELECT 1 FROM %s AS b2 WHERE %s AND b2.seq < b.seq) '
+                'ORDER BY seq' % (
+                    columns(unique.names, 'b.'), batch, self.sqlname,
+                    equal(unique.names, unique.names, 't.', 'b.'), batch,
+                    equal(unique.names, unique.names, 'b2.', 'b.')))
+            for row in cur.fetchall():
+                errors.append(duplicated(rt, self._len + row[0],
+                                         unique.names, row[1:]).args[0])
+        cur.execute('DELETE FROM %s' % batch)
+        return errors
+
+    def getrecord(self, *pkey):
+        """
+        Extract the record specified by the given primary key.
+        Raise a KeyError if the record is missing from the table.
+        """
+        for rec in self._select(where(self.recordtype.pkey.names), pkey):
+            return rec
+        raise KeyError(pkey)
+
+    def _index(self, indexname):
+        """Return the Index descriptor with the given name"""
+        for index in self.recordtype.get_descriptors(Index):
+            if index.name == indexname:
+                return index
+        raise KeyError(indexname)
+
+    def lookup(self, indexname, *key):
+        """
+        Return the list of records with the given key (UTF8-encoded
+        strings) in the given index.
+        """
+        return list(self._select(where(self._index(indexname).names), key))
+
+    def _sortedkeys(self, index):
+        """Return the sorted list of pairs (sortkey, key) of the index"""
+        cur = self.conn.execute('SELECT DISTINCT %s FROM %s' % (
+            columns(index.names), self.sqlname))
+        return sorted((index.sortkey(key), key) for key in cur)
+
+    def range(self, indexname, low=None, high=None):
+        """
+        Return the list of records with low <= key < high in the given
+        sorted index, in key order. `low` and `high` are tuples of
+        casted values (or single values for indexes on a single field);
+        None means unbounded.
+        """
+        index = self._index(indexname)
+        if not index.sorted:
+            raise TypeError('%s is not sorted' % index)
+        if low is not None and not isinstance(low, tuple):
+            low = (low,)
+        if high is not None and not isinstance(high, tuple):
+            high = (high,)
+        keys = self._sortedkeys(index)
+        start = 0 if low is None else bisect.bisect_left(keys, (low,))
+        stop = len(keys) if high is None else bisect.bisect_left(
+            keys, (high,))
+        recs = []
+        for _sortkey, key in keys[start:stop]:
+            recs.extend(self.lookup(indexname, *key))
+        return recs
+
+    def groupby(self, indexname):
+        """
+        Yield pairs (key, records) for each key in the given index, in
+        key order for sorted indexes and in order of insertion otherwise.
+        The records are read from the database one group at the time.
+        """
+        index = self._index(indexname)
+        if index.sorted:
+            for _sortkey, key in self._sortedkeys(index):
+                yield key, self.lookup(indexname, *key)
+            return
+        recs = self._select(
+            order='(SELECT MIN(rowid) FROM %s AS g WHERE %s), rowid' % (
+                self.sqlname, equal(index.names, index.names, 'g.',
+                                    self.sqlname + '.')))
+        for key, group in itertools.groupby(
+                recs, lambda rec: index.getkey(rec.row)):
+            yield key, list(group)
+
+    def __len__(self):
+        """The number of records stored in the table"""
+        return self._len
+
+
+class SqlTableSet(TableSet):
+    """
+    A TableSet stored in a SQLite database. The connection is in autocommit
+    mode: outside a transaction each modification is committed at once,
+    which for a database on disk means a sync per record. Many records
+    must be stored with :meth:`insert_all` or inside a
+    :meth:`transaction`.
+
+    :param convertertype: the converter class
+    :param tables: a list of SqlTables sharing the same connection, or None
+    :param dbname: the database file; ':memory:' for an in-memory database
+    """
+    batchsize = 10000  # number of records inserted in a single statement
+
+    def __init__(self, convertertype, tables=None, dbname=':memory:'):
+        if tables:
+            self.conn = tables[0].conn
+        else:
+            self.conn = sqlite3.connect(dbname, isolation_level=None)
+            self.conn.text_factory = str
+            self.conn.execute('PRAGMA foreign_keys = ON')
+            tables = [SqlTable(rt, self.conn, ordinal) for ordinal, rt in
+                      enumerate(convertertype.recordtypes())]
+        TableSet.__init__(self, convertertype, tables, SqlTable)
+
+    def __getitem__(self, sliceobj):
+        return self.__class__(self.convertertype, self.tables[sliceobj])
+
+    def insert(self, rec):
+        """
+        Insert a record in the correct table; the ForeignKey
+        constraints are checked by SQLite. Outside a transaction the
+        record is committed immediately: use :meth:`insert_all` to
+        insert many records.
+        """
+        getattr(self, 'table' + rec.__class__.__name__).append(rec)
+
+    def insert_all(self, recs):
+        """
+        Insert a set of records in the right tables, in batches of
+        `batchsize` records; in each batch the records are grouped by
+        type and inserted in the order of definition of the record types.
+        If there are violations no record is inserted and an
+        IntegrityError listing all of them is raised.
+        """
+        errors = []
+        recs = iter(recs)
+        self.conn.execute('SAVEPOINT insert_all')
+        try:
+            while True:
+                batch = list(itertools.islice(recs, self.batchsize))
+                if not batch:
+                    break
+                groups = collections.defaultdict(list)
+                for rec in batch:
+                    groups[rec.__class__].append(rec)
+                for rectype in sorted(groups, key=lambda rt: rt._ordinal):
+                    tbl = getattr(self, 'table' + rectype.__name__)
+                    errors.extend(tbl._insert_rows(groups[rectype], True))
+            if errors:
+                raise IntegrityError(errors)
+        except:
+            self.conn.execute('ROLLBACK TO insert_all')
+            self.conn.execute('RELEASE insert_all')
+            self._recount()
+            raise
+        self.conn.execute('RELEASE insert_all')
+
+    def _recount(self):
+        """Recompute the lengths of the tables, after a rollback"""
+        for tbl in self.tables:
+            tbl._len = self.conn.execute(
+                'SELECT COUNT(*) FROM %s' % tbl.sqlname).fetchone()[0]
+
+    def begin(self):
+        """
+        Start a transaction, as a SQLite savepoint; transactions can be
+        nested
+        """
+        self.conn.execute('SAVEPOINT tableset')
+
+    def commit(self):
+        """End the current transaction, keeping its modifications"""
+        try:
+            self.conn.execute('RELEASE tableset')
+        except sqlite3.OperationalError:  # no such savepoint
+            raise RuntimeError('There is no transaction to commit')
+
+    def rollback(self):
+        """End the current transaction, by reverting its modifications"""
+        try:
+            self.conn.execute('ROLLBACK TO tableset')
+        except sqlite3.OperationalError:  # no such savepoint
+            raise RuntimeError('There is no transaction to roll back')
+        self.conn.execute('RELEASE tableset')
+        self._recount()
+
+    @contextlib.contextmanager
+    def _deferred_foreign_keys(self):
+        """
+        Check the foreign keys at the end of the transaction, so that
+        the referred and the referring records can be modified in any
+        order; to be used inside a transaction
+        """
+        self.conn.execute('PRAGMA defer_foreign_keys = ON')
+        try:
+            yield
+        finally:
+            self.conn.execute('PRAGMA defer_foreign_keys = OFF')
+
+    def delete(self, rec):
+        """
+        Delete a record by cascading on the ForeignKeys, as
+        :meth:`openquake.commonlib.record.TableSet.delete`: the referring
+        records are found with the SQL indexes on the foreign keys.
+        Raise a KeyError if the record is not in the table set.
+        """
+        with self.transaction(), self._deferred_foreign_keys():
+            TableSet.delete(self, rec)
+
+    def update(self, rec, new_rec):
+        """
+        Replace a record with a new one, by cascading on the ForeignKeys,
+        as :meth:`openquake.commonlib.record.TableSet.update`. If a
+        constraint is violated no change is performed.
+        """
+        with self.transaction(), self._deferred_foreign_keys():
+            self._update(rec, new_rec)
+
+    def close(self):
+        """Close the underlying database connection"""
+        self.conn.close()
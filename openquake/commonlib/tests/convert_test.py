@@ -16,12 +16,16 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import shutil
 import unittest
+import zipfile
 import tempfile
+import mock
 from openquake.nrmllib import InvalidFile
-from openquake.commonlib import record, records
+from openquake.commonlib import record, records, snapshot
 from openquake.commonlib.csvmanager import (
-    MemArchive, CSVManager, NotInArchive, mkarchive)
+    MemArchive, ZipArchive, CSVManager, NotInArchive, mkarchive, CODECS,
+    CONVERTED, read_converted)
 
 DATADIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -55,15 +59,16 @@ class ConvertGoodFilesTestCase(unittest.TestCase):
     archive of flat files and the convert back the archive to the
     original .xml file.
     """
-    def check_round_trip(self, model_xml):
+    def check_round_trip(self, model_xml, streaming=False, compression=None):
         # from nrml -> csv and back, all in memory
         name = model_xml[:-4]  # strips the .xml extension
         fname = os.path.join(DATADIR, model_xml)
         archive = MemArchive([])
-        manager = CSVManager(archive, name)
+        manager = CSVManager(archive, name, compression=compression)
         manager.convert_from_nrml(fname)
         outdir = tempfile.gettempdir()
-        [outname] = manager.convert_to_nrml(mkarchive(outdir, 'w'))
+        [outname] = manager.convert_to_nrml(mkarchive(outdir, 'w'),
+                                            streaming=streaming)
         if open(fname).read() != open(outname).read():
             raise ValueError('Files %s and %s are different' %
                              (fname, outname))
@@ -89,6 +94,140 @@ class ConvertGoodFilesTestCase(unittest.TestCase):
     def test_gmf_event_based(self):
         self.check_round_trip('gmf-event-based.xml')
 
+    def test_streaming(self):
+        for model_xml in ('vulnerability-model-discrete.xml',
+                          'exposure-population.xml',
+                          'exposure-buildings.xml',
+                          'gmf-scenario.xml',
+                          'gmf-event-based.xml'):
+            self.check_round_trip(model_xml, streaming=True)
+
+    def test_compressed(self):
+        for codec in CODECS:
+            self.check_round_trip('exposure-buildings.xml',
+                                  compression=codec)
+            self.check_round_trip('gmf-event-based.xml', streaming=True,
+                                  compression=codec)
+
+    def test_parallel(self):
+        # all the models in a single archive, converted in parallel
+        models = ['vulnerability-model-discrete.xml',
+                  'fragility-model-discrete.xml',
+                  'fragility-model-continuous.xml',
+                  'exposure-population.xml',
+                  'exposure-buildings.xml',
+                  'gmf-scenario.xml',
+                  'gmf-event-based.xml']
+        archive = MemArchive([])
+        for model_xml in models:
+            CSVManager(archive).convert_from_nrml(
+                os.path.join(DATADIR, model_xml))
+        outdir = tempfile.mkdtemp()
+        try:
+            outnames = CSVManager(archive).convert_to_nrml(
+                mkarchive(outdir, 'w'), parallel=True)
+            self.assertEqual(sorted(map(os.path.basename, outnames)),
+                             sorted(models))
+            for outname in outnames:
+                fname = os.path.join(DATADIR, os.path.basename(outname))
+                self.assertEqual(open(outname).read(), open(fname).read())
+            # the output is stored in the input archive
+            outnames = CSVManager(archive).convert_to_nrml(parallel=True)
+            self.assertEqual(sorted(outnames), sorted(models))
+            for outname in outnames:
+                fname = os.path.join(DATADIR, outname)
+                self.assertEqual(archive.open(outname).read(),
+                                 open(fname).read())
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_incremental(self):
+        archive = MemArchive([])
+        for model_xml in ('vulnerability-model-discrete.xml',
+                          'exposure-population.xml'):
+            CSVManager(archive).convert_from_nrml(
+                os.path.join(DATADIR, model_xml))
+        vuln, expo = 'vulnerability-model-discrete', 'exposure-population'
+
+        def convert(verify=False):
+            # return the set of the prefixes actually converted
+            old = dict((p, archive.dic.get(p + '.xml')) for p in (vuln, expo))
+            outnames = CSVManager(archive).convert_to_nrml(
+                incremental=True, verify=verify)
+            self.assertEqual(sorted(outnames), [expo + '.xml', vuln + '.xml'])
+            return set(p for p in old if archive.dic[p + '.xml'] is not old[p])
+        self.assertEqual(convert(), set([vuln, expo]))
+        self.assertIn(CONVERTED, archive)
+        self.assertEqual(convert(), set())
+        # a file rewritten with the same content is not converted again
+        fname = expo + '__Exposure.csv'
+        data = archive.open(fname).read()
+        archive.add(fname, data)
+        self.assertEqual(convert(), set())
+        archive.add(fname, data.replace('\n', '\r\n'))
+        # only the changed prefixes are validated, and the files are
+        # hashed once
+        man = CSVManager(archive)
+        changes = man.find_changed()
+        self.assertEqual(changes[1], [expo])
+        self.assertEqual(man.find_invalid(prefixes=changes[1]), [])
+        with mock.patch.object(snapshot, 'file_hash',
+                               side_effect=snapshot.file_hash) as file_hash:
+            man.convert_to_nrml(incremental=True, changes=changes)
+        self.assertEqual([args[1] for args, _ in file_hash.call_args_list],
+                         [expo + '.xml'])
+        self.assertEqual(man.find_changed()[1], [])
+        # a modified output with the same size is found only when verifying
+        xml = archive.open(vuln + '.xml').read()
+        archive.add(vuln + '.xml', xml.replace('PAGER', 'pager'))
+        self.assertEqual(convert(), set())
+        self.assertEqual(convert(verify=True), set([vuln]))
+        self.assertEqual(archive.open(vuln + '.xml').read(), xml)
+
+    def test_incremental_zip(self):
+        # the files written again replace the old entries of the zip
+        tmpdir = tempfile.mkdtemp()
+        try:
+            zipname = os.path.join(tmpdir, 'expo.zip')
+            archive = ZipArchive(zipname, 'w')
+            CSVManager(archive).convert_from_nrml(
+                os.path.join(DATADIR, 'exposure-population.xml'))
+            for _ in range(2):
+                CSVManager(archive).convert_to_nrml(incremental=True)
+            fname = 'exposure-population__Exposure.csv'
+            with archive.open(fname) as f:
+                data = f.read()
+            with archive.open(fname, 'w') as f:
+                f.write(data.replace('\n', '\r\n'))
+            for _ in range(2):
+                CSVManager(archive).convert_to_nrml(incremental=True)
+            archive.zip.close()
+            names = [info.filename
+                     for info in zipfile.ZipFile(zipname).infolist()]
+            self.assertEqual(len(names), len(set(names)))
+            self.assertIn(CONVERTED, names)
+            self.assertEqual(read_converted(mkarchive(zipname, 'r'))[
+                'exposure-population']['outname'], 'exposure-population.xml')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_streaming_from_nrml(self):
+        # the incremental parser must produce the same CSV files
+        for model_xml in ('vulnerability-model-discrete.xml',
+                          'exposure-population.xml',
+                          'exposure-buildings.xml',
+                          'gmf-scenario.xml',
+                          'gmf-event-based.xml'):
+            fname = os.path.join(DATADIR, model_xml)
+            archives = MemArchive([]), MemArchive([])
+            for archive, streaming in zip(archives, (False, True)):
+                CSVManager(archive).convert_from_nrml(fname, streaming)
+            expected, got = [
+                dict((name, f.fileobj.getvalue())
+                     for name, f in archive.dic.iteritems())
+                for archive in archives]
+            self.assertEqual(got, expected)
+
 
 class ConvertBadFilesTestCase(unittest.TestCase):
 
@@ -102,6 +241,39 @@ class ConvertBadFilesTestCase(unittest.TestCase):
         node = CSVManager(archive, 'test').convert_to_node()
         self.assertEqual(node.to_str(), 'vulnerabilityModel\n')
 
+    def test_streaming_unordered(self):
+        archive = MemArchive([
+            ('gmf__GmfCollection.csv',
+             'sourceModelTreePath,gsimTreePath\nb1,b2\n'),
+            ('gmf__GmfSet.csv',
+             'stochasticEventSetId,investigationTime\n1,50.0\n2,50.0\n'),
+            ('gmf__GmfData.csv',
+             'stochasticEventSetId,imtStr,ruptureId,lon,lat,gmv\n'
+             '2,PGA,r2,0.0,0.0,0.2\n1,PGA,r1,0.0,0.0,0.2\n')])
+        tset = CSVManager(archive, 'gmf').get_stream_tableset()
+        self.assertIsInstance(tset.tableGmfData, record.StreamTable)
+        with self.assertRaises(ValueError):
+            tset.to_node().to_str()
+
+    def test_streaming_once(self):
+        archive = MemArchive([
+            ('gmf__GmfCollection.csv',
+             'sourceModelTreePath,gsimTreePath\nb1,b2\n'),
+            ('gmf__GmfSet.csv',
+             'stochasticEventSetId,investigationTime\n1,50.0\n'),
+            ('gmf__GmfData.csv',
+             'stochasticEventSetId,imtStr,ruptureId,lon,lat,gmv\n'
+             '1,PGA,r1,0.0,0.0,0.2\n1,PGA,r2,0.0,0.0,0.2\n')])
+        tset = CSVManager(archive, 'gmf').get_stream_tableset()
+        self.assertIsInstance(tset.tableGmfData, record.StreamTable)
+        # the streamed records are checked by the tableset
+        self.assertEqual(tset.tableGmfData.check_fk, tset.check_fk)
+        tset.to_node().to_str()
+        # the gmf nodes are lazy: without the check a second conversion
+        # would silently produce empty sets
+        with self.assertRaises(TypeError):
+            tset.to_node()
+
     def test_no_header(self):
         archive = fake_archive(dvd='5.00,0.00,0.30')
         man = CSVManager(archive, 'test')
@@ -163,3 +335,172 @@ PAGER,IR,6.00,0.00,0.30''')
 
         with self.assertRaises(record.ForeignKeyError):
             tset.insert(rec)
+
+    def test_insert_all(self):
+        tset = CSVManager(fake_archive(), 'test').get_tableset()
+        recs = [records.DiscreteVulnerabilityData(
+                'PAGR', 'IR', '5.00', '0.00', '0.30'),
+                records.DiscreteVulnerability('PAGER', 'XX', 'LN'),
+                records.DiscreteVulnerabilityData(
+                'PAGER', 'XX', '5.00', '0.00', '0.30'),
+                records.DiscreteVulnerability('PAGER', 'IR', 'LN')]
+        with self.assertRaises(record.IntegrityError) as ctxt:
+            tset.insert_all(recs)
+        self.assertEqual(str(ctxt.exception), """\
+DiscreteVulnerability:5:Duplicated record:\
+vulnerabilitySetID=PAGER,vulnerabilityFunctionID=IR
+Missing record in table DiscreteVulnerability corresponding to the keys \
+('PAGR', 'IR')""")
+        # nothing has been inserted
+        self.assertEqual(len(tset.tableDiscreteVulnerability), 4)
+        self.assertEqual(len(tset.tableDiscreteVulnerabilityData), 0)
+
+        # the records are inserted in the order of the record types
+        tset.insert_all(recs[1:3])
+        self.assertEqual(len(tset.tableDiscreteVulnerability), 5)
+        self.assertEqual(len(tset.tableDiscreteVulnerabilityData), 1)
+
+
+DVData = '''\
+vulnerabilitySetID,vulnerabilityFunctionID,IML,lossRatio,coefficientsVariation
+PAGER,IR,5.00,0.00,0.30
+NPAGER,AA,5.00,0.00,0.30
+PAGER,IR,5.50,0.00,0.30
+PAGER,PK,5.00,0.10,0.30'''
+
+
+class TableSetEditTestCase(unittest.TestCase):
+    tabletype = record.Table
+
+    def setUp(self):
+        man = CSVManager(fake_archive(dvd=DVData), 'test')
+        self.tset = man.get_tableset(self.tabletype)
+
+    def test_delete(self):
+        tset = self.tset
+        tset.delete(tset.tableDiscreteVulnerability.getrecord('PAGER', 'IR'))
+        self.assertEqual(len(tset.tableDiscreteVulnerability), 3)
+        self.assertEqual([rec['IML'] for rec in
+                          tset.tableDiscreteVulnerabilityData], ['5.00'] * 2)
+        # cascade on two levels
+        tset.delete(records.DiscreteVulnerabilitySet(
+            'PAGER', 'population', 'fatalities', 'MMI'))
+        self.assertEqual(len(tset.tableDiscreteVulnerabilitySet), 1)
+        self.assertEqual(len(tset.tableDiscreteVulnerability), 2)
+        self.assertEqual(list(tset.tableDiscreteVulnerabilityData),
+                         [records.DiscreteVulnerabilityData(
+                          'NPAGER', 'AA', '5.00', '0.00', '0.30')])
+        with self.assertRaises(KeyError):
+            tset.tableDiscreteVulnerability.getrecord('PAGER', 'PK')
+        with self.assertRaises(KeyError):
+            tset.delete(records.DiscreteVulnerability('PAGER', 'PK', 'LN'))
+        # the deleted keys can be inserted again
+        tset.insert(records.DiscreteVulnerabilitySet(
+            'PAGER', 'population', 'fatalities', 'MMI'))
+        tset.insert(records.DiscreteVulnerability('PAGER', 'PK', 'LN'))
+
+    def test_update(self):
+        tset = self.tset
+        old = tset.tableDiscreteVulnerabilitySet.getrecord('PAGER')
+        new = records.DiscreteVulnerabilitySet(
+            'XPAGER', 'population', 'fatalities', 'MMI')
+        tset.update(old, new)
+        # the referring records have been updated, recursively
+        dvtable = tset.tableDiscreteVulnerability
+        self.assertEqual(dvtable.getrecord('XPAGER', 'IR')[2], 'LN')
+        self.assertEqual(
+            [rec['IML'] for rec in tset.tableDiscreteVulnerabilityData.lookup(
+             'function', 'XPAGER', 'IR')], ['5.00', '5.50'])
+        self.assertEqual(
+            tset.tableDiscreteVulnerabilityData.lookup(
+                'function', 'PAGER', 'IR'), [])
+        with self.assertRaises(KeyError):
+            dvtable.getrecord('PAGER', 'IR')
+        # a change not affecting the referred key
+        tset.update(dvtable.getrecord('XPAGER', 'PK'),
+                    records.DiscreteVulnerability('XPAGER', 'PK', 'BT'))
+        self.assertEqual(dvtable.getrecord('XPAGER', 'PK')[2], 'BT')
+
+    def test_invalid_update(self):
+        tset = self.tset
+        dvtable = tset.tableDiscreteVulnerability
+        with self.assertRaises(KeyError):  # duplicated
+            tset.update(dvtable.getrecord('PAGER', 'IR'),
+                        records.DiscreteVulnerability('PAGER', 'PK', 'LN'))
+        with self.assertRaises(record.ForeignKeyError):
+            tset.update(dvtable.getrecord('PAGER', 'IR'),
+                        records.DiscreteVulnerability('ZZ', 'IR', 'LN'))
+        # nothing changed
+        self.assertEqual(dvtable.getrecord('PAGER', 'IR')[2], 'LN')
+        self.assertEqual(len(dvtable), 4)
+
+    def test_rollback(self):
+        tset = self.tset
+        dvtable = tset.tableDiscreteVulnerability
+        dvdtable = tset.tableDiscreteVulnerabilityData
+        before = [list(tbl) for tbl in tset.tables]
+        tset.begin()
+        tset.delete(dvtable.getrecord('PAGER', 'IR'))
+        dvtable[0]  # compact the table
+        tset.update(tset.tableDiscreteVulnerabilitySet.getrecord('PAGER'),
+                    records.DiscreteVulnerabilitySet(
+                        'XPAGER', 'population', 'fatalities', 'MMI'))
+        tset.insert(records.DiscreteVulnerability('NPAGER', 'CC', 'LN'))
+        del dvtable[-1]
+        dvtable.insert(0, records.DiscreteVulnerability('NPAGER', 'DD', 'LN'))
+        tset.rollback()
+        self.assertEqual([list(tbl) for tbl in tset.tables], before)
+        # the unique constraints and the indexes have been restored too
+        self.assertEqual(
+            len(dvdtable.lookup('function', 'PAGER', 'IR')), 2)
+        self.assertEqual(dvdtable.lookup('function', 'XPAGER', 'IR'), [])
+        self.assertEqual(dvtable.getrecord('PAGER', 'IR')[2], 'LN')
+        tset.insert(records.DiscreteVulnerability('NPAGER', 'CC', 'LN'))
+        self.assertEqual(len(dvtable), 5)
+        with self.assertRaises(RuntimeError):
+            tset.rollback()
+
+    def test_transaction(self):
+        tset = self.tset
+        dvtable = tset.tableDiscreteVulnerability
+        with tset.transaction():
+            tset.delete(dvtable.getrecord('PAGER', 'PK'))
+            with self.assertRaises(KeyError):
+                with tset.transaction():  # a savepoint
+                    tset.delete(dvtable.getrecord('PAGER', 'IR'))
+                    dvtable.getrecord('PAGER', 'XX')
+            self.assertEqual(len(dvtable), 3)
+        self.assertEqual(len(dvtable), 3)
+        self.assertEqual(len(tset.tableDiscreteVulnerabilityData), 3)
+        self.assertIsNone(dvtable._journal)
+        with self.assertRaises(RuntimeError):
+            tset.commit()
+
+
+class ColumnTableSetEditTestCase(TableSetEditTestCase):
+    tabletype = record.ColumnTable
+
+    def test_invalid_commit(self):
+        tset = self.tset
+        dvtable = tset.tableDiscreteVulnerability
+        tset.begin()
+        for _ in range(2):  # the duplicate is buffered
+            dvtable.append(records.DiscreteVulnerability('NPAGER', 'CC', 'LN'))
+        with self.assertRaises(KeyError):
+            tset.commit()
+        self.assertEqual(len(dvtable), 4)
+        self.assertIsNone(dvtable._journal)
+
+    def test_insert_all_lookups(self):
+        # the foreign keys are checked without iterating on the keys
+        # of the referenced table
+        recs = [records.DiscreteVulnerabilityData(
+                'PAGER', 'PK', '5.50', '0.10', '0.30'),
+                records.DiscreteVulnerabilityData(
+                'PAGR', 'IR', '5.00', '0.00', '0.30')]
+        with mock.patch.object(record.RowMapping, '__iter__',
+                               side_effect=AssertionError):
+            with self.assertRaises(record.IntegrityError):
+                self.tset.insert_all(recs)
+            self.tset.insert_all(recs[:1])
+        self.assertEqual(len(self.tset.tableDiscreteVulnerabilityData), 5)
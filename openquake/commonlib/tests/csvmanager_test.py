@@ -18,11 +18,14 @@
 
 import os
 import unittest
+import shutil
+import zipfile
 import tempfile
-from openquake.commonlib import records
+import mock
+from openquake.commonlib import record, records
 from openquake.commonlib.csvmanager import (
-    create_table, ZipArchive, MemArchive, CSVManager,
-    MultipleManagerError)
+    create_table, ZipArchive, MemArchive, DirArchive, CSVManager,
+    MultipleManagerError, NotInArchive, CompressedFile, CODECS)
 
 
 def cast(rec):
@@ -66,6 +69,59 @@ class TableTestCase(unittest.TestCase):
         finally:
             os.remove(archive.name)
 
+    def test_zip_interleaved(self):
+        # two compressed files written at the same time
+        with tempfile.NamedTemporaryFile() as f:
+            name = f.name
+        archive = ZipArchive(name, 'w', compresslevel=1)
+        try:
+            a = archive.open('a', 'w')
+            b = archive.open('b', 'w')
+            for i in range(1000):
+                a.write('%d,1.0\n' % i)
+                b.write('%d,2.0\n' % i)
+            b.close()
+            a.close()
+            archive.zip.close()
+            zipf = zipfile.ZipFile(name)
+            self.assertIsNone(zipf.testzip())
+            self.assertEqual(zipf.read('a').splitlines()[-1], '999,1.0')
+            self.assertEqual(zipf.read('b').splitlines()[-1], '999,2.0')
+            info = zipf.getinfo('a')
+            self.assertLess(info.compress_size, info.file_size)
+        finally:
+            os.remove(name)
+
+    def check_index(self, archive):
+        with archive.open('a', 'w') as f:
+            f.write('1,2')
+        self.assertIn('a', archive)
+        self.assertNotIn('b', archive)
+        self.assertEqual(archive.getsize('a'), 3)
+        self.assertGreater(archive.getmtime('a'), 0)
+        # the index is updated when a file is written
+        with archive.open('b', 'w') as f:
+            f.write('3,4,5')
+        self.assertIn('b', archive)
+        self.assertEqual(archive.getsize('b'), 5)
+        self.assertEqual(archive.extract_filenames(), set('ab'))
+        with self.assertRaises(NotInArchive):
+            archive.getsize('c')
+
+    def test_index(self):
+        self.check_index(MemArchive([]))
+        dname = tempfile.mkdtemp()
+        try:
+            self.check_index(DirArchive(dname))
+        finally:
+            shutil.rmtree(dname)
+        with tempfile.NamedTemporaryFile() as f:
+            name = f.name
+        try:
+            self.check_index(ZipArchive(name, 'w'))
+        finally:
+            os.remove(name)
+
     def test_bad_prefix(self):
         archive = MemArchive([
             ('test__DiscreteVulnerabilitySet.csv', ''),
@@ -83,3 +139,123 @@ class TableTestCase(unittest.TestCase):
         self.assertEqual(
             str(exc),
             'Location[lon]: 0,1: longitude 190.0 > 180')
+
+
+def locations(n):
+    # every 7th record has an invalid longitude
+    lines = ['id,lon,lat']
+    for i in range(1, n + 1):
+        lon = 200 if i % 7 == 0 else i % 180
+        lines.append('%d,%s,%s' % (i, lon, i * .01))
+    return '\n'.join(lines) + '\n'
+
+
+class FindInvalidTestCase(unittest.TestCase):
+    def check(self, archive):
+        man = CSVManager(archive)
+        expected = map(str, man.find_invalid())
+        self.assertEqual(len(expected), 14)
+        for chunksize in (1, 64, 1000):
+            invalid = man.find_invalid(parallel=True, chunksize=chunksize)
+            self.assertEqual(map(str, invalid), expected)
+            invalid = man.find_invalid(3, parallel=True, chunksize=chunksize)
+            self.assertEqual(map(str, invalid), expected[:3])
+
+    def test_mem_archive(self):
+        self.check(MemArchive([('test__Location.csv', locations(100))]))
+
+    def test_dir_archive(self):
+        dname = tempfile.mkdtemp()
+        fname = os.path.join(dname, 'test__Location.csv')
+        try:
+            with open(fname, 'w') as f:
+                f.write(locations(100))
+            self.check(DirArchive(dname))
+        finally:
+            os.remove(fname)
+            os.rmdir(dname)
+
+    def test_compressed(self):
+        for codec, (compress, _) in CODECS.iteritems():
+            self.check(MemArchive([('test__Location.csv.' + codec,
+                                    compress(locations(100)))]))
+
+
+class ReadColumnsTestCase(unittest.TestCase):
+    def check(self, data):
+        man = CSVManager(
+            MemArchive([('test__Location.csv', data)]), 'test')
+        tbl = man.readtable(records.Location, record.Table)
+        ctbl = man.readtable(records.Location, record.ColumnTable)
+        self.assertEqual(map(list, ctbl), map(list, tbl))
+        self.assertEqual(list(ctbl.column('lat')),
+                         [cast(rec)[2] for rec in tbl])
+        return ctbl
+
+    def test_plain(self):
+        self.check(locations(6))
+
+    def test_quoted(self):
+        # parsed with csv.reader
+        ctbl = self.check('id,lon,lat\n1,"1.0",2.0\r\n2,1.0,2.1\n')
+        self.assertEqual(list(ctbl.column('lon')), [1.0, 1.0])
+
+    def test_invalid(self):
+        man = CSVManager(
+            MemArchive([('test__Location.csv', locations(10))]), 'test')
+        with self.assertRaises(record.InvalidRecord) as ctxt:
+            man.readtable(records.Location, record.ColumnTable)
+        [exc] = man.find_invalid(1)
+        exc.fname = None
+        self.assertEqual(str(ctxt.exception), str(exc))
+
+    def test_duplicated(self):
+        man = CSVManager(MemArchive([('test__Location.csv', '''\
+id,lon,lat
+1,1.0,2.0
+2,1.0,2.0
+''')]), 'test')
+        with self.assertRaises(KeyError) as ctxt:
+            man.get_tableset(record.ColumnTable)
+        self.assertEqual(str(ctxt.exception),
+                         "'Location:1:Duplicated record:lon=1.0,lat=2.0'")
+
+
+class CodecTestCase(unittest.TestCase):
+    @mock.patch.object(CompressedFile, 'blocksize', 100)
+    @mock.patch.object(CompressedFile, 'threads', 4)
+    def test_write_read(self):
+        # many small blocks compressed in threads, read line by line
+        data = MemArchive([('test__Location.csv', locations(1000))])
+        for codec in CODECS:
+            archive = MemArchive([])
+            with CSVManager(archive, 'test', compression=codec) as man:
+                for rec in CSVManager(data, 'test').read(records.Location):
+                    man.write(rec)
+            self.assertEqual(archive.extract_filenames(),
+                             set(['test__Location.csv.' + codec]))
+            with CSVManager(archive, 'test') as man:
+                fname = man.csvname(records.Location)
+                self.assertEqual(fname, 'test__Location.csv.' + codec)
+                f = man.open_csv(fname)
+                self.assertEqual(f.readline(), 'id,lon,lat\r\n')
+                self.assertEqual(f.read(10), '1,1,0.01\r\n')
+                self.assertEqual(len(list(f)), 999)
+
+    def test_compresslevel(self):
+        data = MemArchive([('test__Location.csv', locations(1000))])
+        sizes = {}
+        for level in (1, 9):
+            archive = MemArchive([])
+            with CSVManager(archive, 'test', compression='gz',
+                            compresslevel=level) as man:
+                for rec in CSVManager(data, 'test').read(records.Location):
+                    man.write(rec)
+                self.assertEqual(man.rt2file[records.Location].args,
+                                 (level,))
+            [fname] = archive.extract_filenames()
+            sizes[level] = len(archive.open(fname).read())
+            with CSVManager(archive, 'test') as man:
+                self.assertEqual(len(list(man.read(records.Location))),
+                                 1000)
+        self.assertLess(sizes[9], sizes[1])
@@ -91,6 +91,12 @@ class BlockSplitterTestCase(unittest.TestCase):
         blocks = list(block_splitter('abcdefghi', 50, weigths.get))
         self.assertEqual(repr(blocks), "[<WeightedSequence ['a', 'b'], weight=21>, <WeightedSequence ['c'], weight=100>, <WeightedSequence ['d', 'e', 'f'], weight=40>, <WeightedSequence ['g', 'h'], weight=47>, <WeightedSequence ['i'], weight=25>]")
 
+    def test_split_with_variable_max_weight(self):
+        # the max_weight is read at the beginning of each block
+        max_weights = iter([2, 3, 4, 4])
+        blocks = list(block_splitter(self.DATA, max_weights.next))
+        self.assertEqual(blocks, [[0, 1], [2, 3, 4], [5, 6, 7, 8], [9]])
+
     def test_split_in_blocks(self):
         weigths = dict([('a', 11), ('b', 10), ('c', 100), ('d', 15), ('e', 20),
                         ('f', 5), ('g', 30), ('h', 17), ('i', 25)])
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2010-2014, GEM Foundation.
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import operator
+import unittest
+import mock
+
+from openquake.commonlib.general import block_splitter
+from openquake.commonlib import parallel
+from openquake.commonlib.parallel import (
+    ProgressReport, GranularityTuner, TaskManager, TaskTimeout, map_reduce,
+    imap_unordered, no_distribute, get_cpu_sets, init_executor)
+
+
+def sum_all(*numbers):
+    return sum(numbers)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def sleep_block(block):
+    time.sleep(0.01 * len(block))
+    return [len(block)]
+
+
+class ProgressReportTestCase(unittest.TestCase):
+    def test_weights(self):
+        messages = []
+        report = ProgressReport(
+            'test', 10, lambda msg, *args: messages.append(msg % args))
+        self.assertIsNone(report.eta)
+        report.update(5)
+        self.assertEqual(report.percent, 50)
+        report.update(5)
+        self.assertEqual(report.num_done, 2)
+        self.assertEqual(report.percent, 100)
+        self.assertEqual(report.eta, 0)
+        self.assertEqual(len(messages), 2)
+        self.assertTrue(messages[-1].startswith('test 100%'))
+
+
+class GranularityTunerTestCase(unittest.TestCase):
+    def test_tuning(self):
+        tuner = GranularityTuner(100, min_duration=30, max_duration=120,
+                                 num_samples=2)
+        tuner.add(100, 1)
+        self.assertEqual(tuner(), 100)  # not enough samples
+        tuner.add(100, 1)
+        # 0.01 seconds per unit of weight, the target duration is 75s
+        self.assertEqual(tuner(), 7500)
+        tuner.add(7500, 80)  # within the range, nothing changes
+        self.assertEqual(tuner(), 7500)
+
+    def test_block_splitter(self):
+        tuner = GranularityTuner(2, min_duration=1, max_duration=1,
+                                 num_samples=1)
+        blocks = block_splitter(range(10), tuner)
+        self.assertEqual(blocks.next(), [0, 1])
+        tuner.add(2, 0.5)  # the next blocks will have weight 4
+        self.assertEqual(list(blocks), [[2, 3, 4, 5], [6, 7, 8, 9]])
+
+
+class TaskManagerTestCase(unittest.TestCase):
+    def test_map_reduce(self):
+        res = map_reduce(sum_all, [(1, 2, 3), (4, 5), (6,)], operator.add, 0)
+        self.assertEqual(res, 21)
+
+    def test_imap_unordered(self):
+        args = [(i,) for i in range(20)]
+        self.assertEqual(sorted(imap_unordered(sum_all, args, 3)), range(20))
+        # the arguments are consumed lazily
+        it = iter(args)
+        res = imap_unordered(sum_all, it, 3)
+        res.next()
+        res.close()
+        self.assertGreaterEqual(len(list(it)), 17)
+
+    def test_weighted_progress(self):
+        tm = TaskManager(len, lambda msg, *args: None)
+        for block in block_splitter(range(10), 4):
+            tm.submit(block)
+        self.assertEqual(tm.weights, [4, 4, 2])
+        self.assertEqual(tm.aggregate_results(operator.add, 0), 10)
+        self.assertEqual(tm.report.done, 10)
+        self.assertEqual(tm.report.num_done, 3)
+
+    def test_tuner(self):
+        tuner = GranularityTuner(4, num_samples=3)
+        tm = TaskManager(len, lambda msg, *args: None, tuner=tuner)
+        for block in block_splitter(range(10), tuner):
+            tm.submit(block)
+        tm.wait()
+        self.assertEqual(tuner.num_tasks, 3)
+        self.assertEqual(tuner.tot_weight, 10)
+
+    def test_tuner_resizes_blocks(self):
+        # the blocks are generated while the tasks complete, so the
+        # later blocks are bigger than the initial one
+        tuner = GranularityTuner(2, min_duration=0.1, max_duration=0.1,
+                                 num_samples=1)
+        blocks = block_splitter(range(40), tuner)
+        sizes = map_reduce(sleep_block, ((block,) for block in blocks),
+                           operator.add, [], tuner=tuner)
+        self.assertEqual(sum(sizes), 40)
+        self.assertEqual(sizes[0], 2)
+        self.assertGreater(max(sizes), 2)
+
+    @unittest.skipIf(no_distribute(), 'timeouts require a process pool')
+    def test_task_timeout(self):
+        with self.assertRaises(TaskTimeout) as ctx:
+            map_reduce(sleep, [(0,), (60,)], operator.add, 0,
+                       task_timeout=0.5)
+        self.assertEqual(ctx.exception.tasks, [(60,)])
+        # the pool has been replaced and can be used again
+        self.assertEqual(map_reduce(sleep, [(0,)], operator.add, 0), 0)
+
+    @unittest.skipIf(no_distribute(), 'timeouts require a process pool')
+    @mock.patch.object(TaskManager, 'poll_time', 0.1)
+    def test_task_timeout_excludes_queue(self):
+        # with a single worker the second task waits for the first one,
+        # but its deadline is counted from its start
+        init_executor(1)
+        try:
+            self.assertEqual(map_reduce(sleep, [(1.5,), (1.5,)],
+                                        operator.add, 0, task_timeout=2), 3)
+        finally:
+            init_executor()
+
+    @unittest.skipIf(no_distribute(), 'timeouts require a process pool')
+    def test_job_timeout(self):
+        tm = TaskManager(sleep, lambda msg, *args: None, job_timeout=0.5)
+        tm.submit(60)
+        tm.submit(60)
+        with self.assertRaises(TaskTimeout) as ctx:
+            tm.aggregate_results(operator.add, 0)
+        self.assertEqual(sorted(ctx.exception.tasks), [(60,), (60,)])
+        self.assertEqual(tm.results, [])
+
+    def test_pool_internals(self):
+        # terminate_executor relies on private attributes of the pool:
+        # this fails if a new version of `futures` removes them
+        for name in parallel.POOL_INTERNALS:
+            self.assertTrue(hasattr(parallel.executor, name), name)
+        with self.assertRaises(RuntimeError):
+            parallel._kill_workers(object())
+
+
+class AffinityTestCase(unittest.TestCase):
+    NODES = [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    def test_cpu_sets(self):
+        self.assertIsNone(get_cpu_sets('none', 4, self.NODES))
+        self.assertEqual(get_cpu_sets('core', 3, self.NODES),
+                         [[0], [4], [1]])
+        self.assertEqual(get_cpu_sets('numa', 3, self.NODES),
+                         [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]])
+
+    @unittest.skipIf(no_distribute(), 'affinity requires a process pool')
+    def test_pinned_pool(self):
+        init_executor(2, 'core')
+        try:
+            self.assertEqual(map_reduce(sum_all, [(1, 2), (3,)],
+                                        operator.add, 0), 6)
+            self.assertEqual(len(parallel.executor.pinned), 2)
+        finally:
+            init_executor()
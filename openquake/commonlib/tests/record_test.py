@@ -16,7 +16,10 @@
 #  You should have received a copy of the GNU Affero General Public License
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
+import pickle
 import unittest
+import collections
+import numpy
 from openquake.commonlib import record, records
 
 class RecordTest(unittest.TestCase):
@@ -51,3 +54,32 @@ class RecordTest(unittest.TestCase):
         self.assertEqual(self.r.to_tuple(), ('1', 'population', '', 'test',
                                              'per_asset', None, None, None))
         self.assertFalse(self.r.is_valid())
+
+    def test_slots(self):
+        loc = records.Location('1', '10.0', '45.0')
+        self.assertFalse(hasattr(loc, '__dict__'))
+        self.assertIsInstance(loc, collections.Sequence)
+        self.assertEqual(list(reversed(loc)), ['45.0', '10.0', '1'])
+        loc['lon'] = '11.0'
+        self.assertEqual(loc.row, ('1', '11.0', '45.0'))
+        self.assertEqual(pickle.loads(pickle.dumps(loc)), loc)
+
+    def test_cast(self):
+        loc = records.Location('1', '10.0', '45.0')
+        self.assertEqual(loc.cast(), ((1, 10.0, 45.0), None))
+        # all the errors are collected
+        tup, exc = records.Location('x', '190.0', '45.0').cast()
+        self.assertIsNone(tup)
+        self.assertEqual(exc.errorlist,
+                         [('id', "invalid literal for int() with base 10: "
+                           "'x'"), ('lon', 'longitude 190.0 > 180')])
+
+    def test_cast_column(self):
+        [sesid, imt, rupid, lon, lat, gmv] = records.GmfData.fields
+        arr = lon.cast_column(['10.0', '10.5', '11'])
+        self.assertEqual(arr.dtype, numpy.float64)
+        self.assertEqual(list(arr), [10.0, 10.5, 11.0])
+        self.assertEqual(sesid.cast_column(['1', '2']).dtype, numpy.int64)
+        self.assertIsNone(imt.cast_column(['PGA', 'PGV']))
+        with self.assertRaises(ValueError):
+            gmv.cast_column(['0.1', 'x'])
@@ -0,0 +1,113 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import unittest
+import tempfile
+
+import mock
+import numpy
+
+from openquake.commonlib import record, snapshot
+from openquake.commonlib.csvmanager import CSVManager, DirArchive
+from openquake.commonlib.tests.convert_test import DVSet, DVFun
+
+DVData = '''\
+vulnerabilitySetID,vulnerabilityFunctionID,IML,lossRatio,coefficientsVariation
+PAGER,IR,5.00,0.00,0.30
+PAGER,IR,5.50,0.00,0.30
+PAGER,PK,5.00,0.10,0.30
+'''
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        for name, data in [('DiscreteVulnerabilitySet', DVSet),
+                           ('DiscreteVulnerability', DVFun),
+                           ('DiscreteVulnerabilityData', DVData)]:
+            self.write('test__%s.csv' % name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write(self, fname, data):
+        with open(os.path.join(self.dirname, fname), 'w') as f:
+            f.write(data)
+
+    def manager(self):
+        return CSVManager(DirArchive(self.dirname), 'test')
+
+    def test_round_trip(self):
+        expected = self.manager().get_tableset()
+        dirname = self.manager().save_snapshot()
+        self.assertEqual(snapshot.read_manifest(dirname)['converter'],
+                         'Vulnerability')
+        for tabletype in (record.Table, record.ColumnTable):
+            tset = snapshot.load(expected.convertertype, dirname, tabletype)
+            self.assertEqual([list(tbl) for tbl in tset.tables],
+                             [list(tbl) for tbl in expected.tables])
+            tset.check_fk(tset.tableDiscreteVulnerabilityData[2])
+
+    def test_transparent_use(self):
+        self.manager().save_snapshot()
+        tset = self.manager().get_tableset(record.ColumnTable)
+        data = tset.tableDiscreteVulnerabilityData
+        # the typed columns come from the memory-mapped snapshot
+        self.assertIsInstance(data.column('IML'), numpy.memmap)
+        self.assertEqual(list(data.column('IML')), [5.0, 5.5, 5.0])
+        self.assertEqual(len(data.lookup('function', 'PAGER', 'IR')), 2)
+        # the copy-on-write arrays can be modified in memory
+        data[2] = data[2].__class__('PAGER', 'PK', '6.00', '0.10', '0.30')
+        self.assertEqual(list(data.column('IML')), [5.0, 5.5, 6.0])
+        self.assertEqual(list(self.manager().get_tableset(
+            record.ColumnTable).tableDiscreteVulnerabilityData.column(
+                'IML')), [5.0, 5.5, 5.0])
+
+    def test_outdated(self):
+        dirname = self.manager().save_snapshot()
+        self.write('test__DiscreteVulnerabilityData.csv',
+                   DVData + 'PAGER,PK,5.50,0.10,0.30\n')
+        man = self.manager()
+        self.assertIsNone(man._load_snapshot(record.Table))
+        tset = man.get_tableset()
+        self.assertEqual(len(tset.tableDiscreteVulnerabilityData), 4)
+        # an interrupted save does not leave a valid snapshot
+        os.remove(os.path.join(dirname, snapshot.MANIFEST))
+        self.assertIsNone(snapshot.read_manifest(dirname))
+
+    def test_unchanged_files_not_hashed(self):
+        self.manager().save_snapshot()
+        with mock.patch.object(snapshot, 'file_hash') as file_hash:
+            tset = self.manager().get_tableset(record.ColumnTable)
+        self.assertEqual(file_hash.call_count, 0)
+        self.assertIsInstance(
+            tset.tableDiscreteVulnerabilityData.column('IML'), numpy.memmap)
+
+    def test_schema_mismatch(self):
+        dirname = self.manager().save_snapshot()
+        man = self.manager()
+        convertertype = man._getconverter()
+        schema = snapshot.schema(convertertype)
+        schema['DiscreteVulnerabilityData'][2][1] = 'int'
+        with mock.patch.object(snapshot, 'schema', return_value=schema):
+            self.assertIsNone(man._load_snapshot(record.Table))
+            self.assertRaises(ValueError, snapshot.load,
+                              convertertype, dirname)
+        self.assertEqual(
+            len(man.get_tableset().tableDiscreteVulnerabilityData), 3)
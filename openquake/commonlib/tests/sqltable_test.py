@@ -0,0 +1,205 @@
+#  -*- coding: utf-8 -*-
+#  vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#  Copyright (c) 2014, GEM Foundation
+
+#  OpenQuake is free software: you can redistribute it and/or modify it
+#  under the terms of the GNU Affero General Public License as published
+#  by the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+
+#  OpenQuake is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU Affero General Public License
+#  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import unittest
+import tempfile
+from openquake.commonlib import record, records, converter
+from openquake.commonlib.csvmanager import CSVManager
+from openquake.commonlib.sqltable import SqlTableSet
+from openquake.commonlib.tests import convert_test
+from openquake.commonlib.tests.convert_test import fake_archive
+
+DVData = '''\
+vulnerabilitySetID,vulnerabilityFunctionID,IML,lossRatio,coefficientsVariation
+PAGER,IR,5.00,0.00,0.30
+PAGER,PK,5.00,0.10,0.30
+PAGER,IR,5.50,0.00,0.30
+PAGER,IR,6.00,0.00,0.30'''
+
+
+def manager():
+    # the files in a MemArchive can be read only once
+    return CSVManager(fake_archive(dvd=DVData), 'test')
+
+
+class SqlTableSetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tset = manager().get_tableset(dbname=':memory:')
+
+    def tearDown(self):
+        self.tset.close()
+
+    def test_same_records(self):
+        tset = manager().get_tableset()
+        self.assertIsInstance(self.tset, SqlTableSet)
+        for tbl, sqltbl in zip(tset, self.tset):
+            self.assertEqual(len(sqltbl), len(tbl))
+            self.assertEqual(list(sqltbl), list(tbl))
+            self.assertEqual(sqltbl[1:3], tbl[1:3])
+            self.assertEqual(sqltbl[-1], tbl[-1])
+
+    def test_foreign_key(self):
+        rec = records.DiscreteVulnerabilityData(
+            'PAGR', 'IR', '5.00', '0.00', '0.30')
+        with self.assertRaises(record.ForeignKeyError):
+            self.tset.insert(rec)
+        self.assertEqual(len(self.tset.tableDiscreteVulnerabilityData), 4)
+
+    def test_duplicated(self):
+        rec = records.DiscreteVulnerability('PAGER', 'IR', 'LN')
+        with self.assertRaises(KeyError) as ctxt:
+            self.tset.insert(rec)
+        self.assertEqual(str(ctxt.exception), """\
+'DiscreteVulnerability:4:Duplicated record:\
+vulnerabilitySetID=PAGER,vulnerabilityFunctionID=IR'""")
+
+    def test_insert_all(self):
+        recs = [records.DiscreteVulnerabilityData(
+                'PAGR', 'IR', '7.00', '0.00', '0.30'),
+                records.DiscreteVulnerability('PAGER', 'XX', 'LN'),
+                records.DiscreteVulnerabilityData(
+                'PAGER', 'XX', '5.00', '0.00', '0.30'),
+                records.DiscreteVulnerability('PAGER', 'IR', 'LN')]
+        with self.assertRaises(record.IntegrityError) as ctxt:
+            self.tset.insert_all(recs)
+        self.assertEqual(str(ctxt.exception), """\
+DiscreteVulnerability:5:Duplicated record:\
+vulnerabilitySetID=PAGER,vulnerabilityFunctionID=IR
+Missing record in table DiscreteVulnerability corresponding to the keys \
+('PAGR', 'IR')""")
+        # nothing has been inserted
+        self.assertEqual(len(self.tset.tableDiscreteVulnerability), 4)
+        self.assertEqual(len(self.tset.tableDiscreteVulnerabilityData), 4)
+
+        self.tset.insert_all(recs[1:3])
+        self.assertEqual(len(self.tset.tableDiscreteVulnerability), 5)
+        self.assertEqual(len(self.tset.tableDiscreteVulnerabilityData), 5)
+
+    def test_getrecord(self):
+        tbl = self.tset.tableDiscreteVulnerability
+        self.assertEqual(tbl.getrecord('PAGER', 'PK'),
+                         records.DiscreteVulnerability('PAGER', 'PK', 'LN'))
+        with self.assertRaises(KeyError):
+            tbl.getrecord('PAGER', 'XX')
+
+    def test_groupby(self):
+        tbl = self.tset.tableDiscreteVulnerabilityData
+        groups = [(key, [rec['IML'] for rec in recs])
+                  for key, recs in tbl.groupby('function')]
+        self.assertEqual(groups, [(('PAGER', 'IR'), ['5.00', '5.50', '6.00']),
+                                  (('PAGER', 'PK'), ['5.00'])])
+        self.assertEqual(len(tbl.lookup('function', 'PAGER', 'PK')), 1)
+        self.assertEqual(tbl.lookup('function', 'PAGER', 'XX'), [])
+
+    def test_update_delete(self):
+        tbl = self.tset.tableDiscreteVulnerabilityData
+        tbl[1] = records.DiscreteVulnerabilityData(
+            'PAGER', 'PK', '5.00', '0.20', '0.30')
+        self.assertEqual(tbl[1]['lossRatio'], '0.20')
+        del tbl[1]
+        self.assertEqual(len(tbl), 3)
+        self.assertEqual(tbl.lookup('function', 'PAGER', 'PK'), [])
+        # a referenced record cannot be deleted
+        with self.assertRaises(record.ForeignKeyError):
+            del self.tset.tableDiscreteVulnerability[0]
+
+    def test_insert_middle(self):
+        tbl = self.tset.tableDiscreteVulnerabilityData
+        rec = records.DiscreteVulnerabilityData(
+            'PAGER', 'IR', '7.00', '0.00', '0.30')
+        # the records can only be appended
+        for position in (1, -1):
+            with self.assertRaises(NotImplementedError):
+                tbl.insert(position, rec)
+        tbl.insert(len(tbl), rec)
+        self.assertEqual([r['IML'] for r in tbl],
+                         ['5.00', '5.00', '5.50', '6.00', '7.00'])
+        # deleting renumbers the following records
+        del tbl[0]
+        self.assertEqual(tbl[-1], rec)
+        self.assertEqual([r['IML'] for r in tbl[1:3]], ['5.50', '6.00'])
+        # a duplicated record is not inserted
+        with self.assertRaises(KeyError):
+            tbl.append(rec)
+        self.assertEqual(len(tbl), 4)
+        self.assertEqual(tbl[3], rec)
+
+    def test_check_fk(self):
+        # the methods of TableSet using the unique data work
+        rec = records.DiscreteVulnerabilityData(
+            'PAGR', 'IR', '5.00', '0.00', '0.30')
+        with self.assertRaises(record.ForeignKeyError):
+            self.tset.check_fk(rec)
+        self.tset.check_fk(self.tset.tableDiscreteVulnerabilityData[0])
+
+    def test_transaction(self):
+        tbl = self.tset.tableDiscreteVulnerabilityData
+        with self.tset.transaction():
+            del tbl[1]
+            with self.assertRaises(KeyError):
+                with self.tset.transaction():  # a savepoint
+                    del tbl[0]
+                    tbl.append(tbl[0])
+        self.assertEqual(len(tbl), 3)
+        self.assertEqual(len(list(tbl)), 3)
+        with self.assertRaises(RuntimeError):
+            self.tset.rollback()
+
+    def test_to_node(self):
+        self.assertEqual(self.tset.to_node().to_str(),
+                         manager().get_tableset().to_node().to_str())
+
+    def test_on_disk(self):
+        fd, dbname = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            manager().get_tableset(dbname=dbname).close()
+            # the records are persisted and can be read again
+            tset = SqlTableSet(converter.Vulnerability, dbname=dbname)
+            self.assertEqual(len(tset.tableDiscreteVulnerabilityData), 4)
+            tset.close()
+        finally:
+            os.remove(dbname)
+
+
+class SqlTableSetEditTestCase(convert_test.TableSetEditTestCase):
+    # the cascading deletes and updates of TableSet
+    def setUp(self):
+        man = CSVManager(fake_archive(dvd=convert_test.DVData), 'test')
+        self.tset = man.get_tableset(dbname=':memory:')
+
+    def tearDown(self):
+        self.tset.close()
+
+    def test_rollback(self):
+        # as for a Table, but the records can only be appended
+        tset = self.tset
+        dvtable = tset.tableDiscreteVulnerability
+        before = [list(tbl) for tbl in tset.tables]
+        tset.begin()
+        tset.delete(dvtable.getrecord('PAGER', 'IR'))
+        tset.update(tset.tableDiscreteVulnerabilitySet.getrecord('PAGER'),
+                    records.DiscreteVulnerabilitySet(
+                        'XPAGER', 'population', 'fatalities', 'MMI'))
+        tset.insert(records.DiscreteVulnerability('NPAGER', 'CC', 'LN'))
+        del dvtable[-1]
+        dvtable.append(records.DiscreteVulnerability('NPAGER', 'DD', 'LN'))
+        tset.rollback()
+        self.assertEqual([list(tbl) for tbl in tset.tables], before)
+        self.assertEqual(len(tset.tableDiscreteVulnerabilityData.lookup(
+            'function', 'PAGER', 'IR')), 2)
@@ -17,7 +17,8 @@
 #  along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
-from openquake.commonlib import record, records
+import numpy
+from openquake.commonlib import record, records, valid
 
 class TableTest(unittest.TestCase):
 
@@ -32,4 +33,312 @@ class TableTest(unittest.TestCase):
 
     def test_insert_update(self):
         self.t[0] = records.FFLimitStateContinuous('moderate')
-        self.t.insert(0, records.FFLimitStateContinuous('severe'))
\ No newline at end of file
+        self.t.insert(0, records.FFLimitStateContinuous('severe'))
+
+    def test_extend(self):
+        self.t.extend([records.FFLimitStateContinuous('moderate'),
+                       records.FFLimitStateContinuous('slight')])
+        self.assertEqual(len(self.t), 3)
+        with self.assertRaises(KeyError) as ctxt:
+            self.t.extend([records.FFLimitStateContinuous('complete'),
+                           records.FFLimitStateContinuous('slight'),
+                           records.FFLimitStateContinuous('complete')])
+        self.assertEqual(
+            str(ctxt.exception),
+            'FFLimitStateContinuous:4:Duplicated record:limitState=slight\n'
+            'FFLimitStateContinuous:5:Duplicated record:limitState=complete')
+        # no record has been appended
+        self.assertEqual(len(self.t), 3)
+
+    def test_update_unique(self):
+        self.t.append(records.FFLimitStateContinuous('moderate'))
+        with self.assertRaises(KeyError) as ctxt:
+            self.t[0] = records.FFLimitStateContinuous('moderate')
+        self.assertEqual(
+            str(ctxt.exception),
+            "'FFLimitStateContinuous:0:Duplicated record:limitState=moderate'")
+        self.t[0] = records.FFLimitStateContinuous('severe')
+        self.t[0] = records.FFLimitStateContinuous('slight')
+        self.assertEqual(self.t.getrecord('slight'), ['slight'])
+
+
+class ColumnTableTest(unittest.TestCase):
+
+    def setUp(self):
+        reclist = [records.Location('1', '1.0', '2.0'),
+                   records.Location('2', '1.0', '2.1')]
+        self.t = record.ColumnTable(records.Location, reclist)
+
+    def test_columns(self):
+        self.assertEqual(self.t.column('id').dtype, numpy.int64)
+        self.assertEqual(list(self.t.column('id')), [1, 2])
+        self.assertEqual(list(self.t.column('lat')), [2.0, 2.1])
+        self.assertEqual(self.t[1], ['2', '1.0', '2.1'])
+        self.assertEqual(self.t.getrecord('2'), ['2', '1.0', '2.1'])
+
+    def test_insert_update_delete(self):
+        self.t.insert(0, records.Location('3', '0.0', '0.0'))
+        self.t[1] = records.Location('4', '1.0', '2.0')
+        self.assertEqual(list(self.t.column('id')), [3, 4, 2])
+        self.assertEqual(self.t.getrecord('4'), ['4', '1.0', '2.0'])
+        del self.t[0]
+        self.assertEqual(list(self.t.column('id')), [4, 2])
+        with self.assertRaises(KeyError):
+            self.t.getrecord('3')
+
+    def test_unique_constraint(self):
+        self.t.append(records.Location('3', '1.0', '2.0'))
+        with self.assertRaises(KeyError) as ctxt:
+            self.t.flush()
+        self.assertEqual(str(ctxt.exception),
+                         "'Location:2:Duplicated record:lon=1.0,lat=2.0'")
+        # the duplicated record has been discarded
+        self.assertEqual(len(self.t), 2)
+
+    def test_unique_data(self):
+        # as for a Table, the keys are mapped to the records
+        udata = self.t._unique_data['pkey']
+        self.assertEqual(udata.dict[('2',)], ['2', '1.0', '2.1'])
+        positions = udata.positions
+        self.t.extend([records.Location('3', '5.0', '5.0'),
+                       records.Location('4', '1.0', '2.0')])
+        with self.assertRaises(KeyError):
+            self.t.flush()
+        # the keys of the discarded records have been removed
+        self.assertEqual(sorted(udata.dict), [('1',), ('2',)])
+        self.t.append(records.Location('3', '5.0', '5.0'))
+        self.assertEqual(udata.dict[('3',)], ['3', '5.0', '5.0'])
+        # the positions are updated, not rebuilt
+        self.assertIs(udata.positions, positions)
+
+    def test_sorted_keys(self):
+        # the keys of the loaded rows are checked on a sorted array,
+        # without building a dictionary with an entry per row
+        udata = self.t._unique_data['pkey']
+        self.assertIsNone(udata._positions)
+        self.assertEqual(udata._sorted.tolist(), [('1',), ('2',)])
+        with self.assertRaises(KeyError) as ctxt:
+            self.t.extend_columns(
+                [['3', '2'], ['0.0', '5.0'], ['0.0', '5.0']])
+        self.assertEqual(str(ctxt.exception),
+                         "'Location:3:Duplicated record:id=2'")
+        self.t.extend_columns([['3'], ['0.0'], ['0.0']])
+        self.t._discard(2)  # revert the append
+        self.assertEqual(udata._sorted.tolist(), [('1',), ('2',)])
+        # the dictionary is built at the first lookup
+        self.assertEqual(self.t.getrecord('2'), ['2', '1.0', '2.1'])
+        self.assertIsNone(udata._sorted)
+        self.assertEqual(sorted(udata.positions), [('1',), ('2',)])
+
+    def test_delete_items(self):
+        # the deleted rows are removed from the unique data in place and
+        # from the columns at the next access by position
+        udata = self.t._unique_data['pkey']
+        positions = udata.positions
+        self.t._delete_items([0])
+        self.assertIs(udata.positions, positions)
+        self.assertEqual(sorted(udata.dict), [('2',)])
+        self.assertEqual(len(self.t), 1)
+        self.assertEqual(self.t._deleted, set([0]))
+        self.t.append(records.Location('3', '1.0', '2.0'))
+        self.assertEqual(list(self.t.column('id')), [2, 3])
+        self.assertEqual(self.t._deleted, set())
+        self.assertEqual(self.t.getrecord('3'), ['3', '1.0', '2.0'])
+
+    def test_invalid(self):
+        with self.assertRaises(record.InvalidRecord) as ctxt:
+            record.ColumnTable(records.Location,
+                               [records.Location('1', '190.0', '2.0')])
+        self.assertEqual(str(ctxt.exception),
+                         'Location[lon]: 0,1: longitude 190.0 > 180')
+
+    def test_extend_columns(self):
+        self.t.extend_columns([['3', '4'], ['0.0', '1.5'], ['0.0', '2.5']])
+        self.assertEqual(list(self.t.column('id')), [1, 2, 3, 4])
+        self.assertEqual(list(self.t.column('lon')), [1.0, 1.0, 0.0, 1.5])
+        self.assertEqual(self.t.getrecord('4'), ['4', '1.5', '2.5'])
+        # the first invalid row is reported, with all its invalid fields
+        with self.assertRaises(record.InvalidRecord) as ctxt:
+            self.t.extend_columns([['5', '6'], ['0.0', '190.0'],
+                                   ['100.0', '100.0']])
+        self.assertEqual(str(ctxt.exception),
+                         'Location[lat]: 4,2: latitude 100.0 > 90')
+        with self.assertRaises(record.InvalidRecord) as ctxt:
+            self.t.extend_columns([['5', '6'], ['0.0', '190.0'],
+                                   ['0.0', '100.0']])
+        self.assertEqual(str(ctxt.exception),
+                         'Location[lon]: 5,1: longitude 190.0 > 180\n'
+                         'Location[lat]: 5,2: latitude 100.0 > 90')
+        # the rows with duplicated keys are discarded
+        with self.assertRaises(KeyError):
+            self.t.extend_columns([['5', '6'], ['5.0', '1.0'], ['5.0', '2.0']])
+        self.assertEqual(len(self.t), 4)
+
+
+class Point(record.Record):
+    id = record.Field(int)
+    label = record.Field(str)
+    value = record.Field(float)
+
+    pkey = record.Unique('id')
+    by_label = record.Index('label')
+    by_value = record.Index('value', sorted=True)
+
+
+class IndexTest(unittest.TestCase):
+    tabletype = record.Table
+
+    def setUp(self):
+        self.t = self.tabletype(Point, [
+            Point('1', 'a', '10.0'), Point('2', 'b', '9.5'),
+            Point('3', 'a', '2'), Point('4', 'c', '9.5')])
+
+    def ids(self, recs):
+        return [rec['id'] for rec in recs]
+
+    def test_lookup(self):
+        self.assertEqual(self.ids(self.t.lookup('by_label', 'a')), ['1', '3'])
+        self.assertEqual(self.t.lookup('by_label', 'd'), [])
+        self.assertEqual(self.ids(self.t.lookup('by_value', '9.5')),
+                         ['2', '4'])
+        self.assertEqual(self.ids(self.t.lookup('by_value', '9.50')), [])
+        self.assertEqual(self.ids(self.t.lookup('by_value', '10.0')), ['1'])
+
+    def test_range(self):
+        self.assertEqual(self.ids(self.t.range('by_value', 3, 10)),
+                         ['2', '4'])
+        self.assertEqual(self.ids(self.t.range('by_value', high=9.5)), ['3'])
+        self.assertEqual(self.ids(self.t.range('by_value', 9.5)),
+                         ['2', '4', '1'])
+        with self.assertRaises(TypeError):
+            self.t.range('by_label', 'a', 'b')
+
+    def test_sorted_lazily(self):
+        # the new keys are sorted at the first query in key order
+        self.t.append(Point('5', 'd', '0.5'))
+        idata = self.t._get_index('by_value')
+        self.assertEqual(len(idata.newkeys), 4)
+        self.assertEqual(self.ids(self.t.range('by_value', high=3)),
+                         ['5', '3'])
+        self.assertEqual(idata.newkeys, [])
+
+    def test_groupby(self):
+        groups = [(key, self.ids(recs))
+                  for key, recs in self.t.groupby('by_label')]
+        self.assertEqual(groups, [(('a',), ['1', '3']), (('b',), ['2']),
+                                  (('c',), ['4'])])
+        groups = [(key, self.ids(recs))
+                  for key, recs in self.t.groupby('by_value')]
+        self.assertEqual(groups, [(('2',), ['3']), (('9.5',), ['2', '4']),
+                                  (('10.0',), ['1'])])
+
+    def test_modifications(self):
+        self.t.append(Point('5', 'c', '1'))
+        self.t[0] = Point('1', 'c', '10.0')
+        del self.t[1]
+        self.assertEqual(sorted(self.ids(self.t.lookup('by_label', 'c'))),
+                         ['1', '4', '5'])
+        self.assertEqual(self.ids(self.t.range('by_value', 9)), ['4', '1'])
+        self.assertEqual(self.ids(self.t.range('by_value', high=5)),
+                         ['5', '3'])
+
+    def test_delete_items(self):
+        # the indexes are updated, not rebuilt
+        idata = self.t._get_index('by_label')
+        self.t._delete_items([self.t._item(self.t[0])])
+        self.assertIs(self.t._get_index('by_label'), idata)
+        self.assertEqual(self.ids(self.t.lookup('by_label', 'a')), ['3'])
+        self.assertEqual(len(self.t), 3)
+
+
+class ColumnIndexTest(IndexTest):
+    tabletype = record.ColumnTable
+
+
+class StreamTableTest(unittest.TestCase):
+    points = [Point('1', 'a', '10.0'), Point('2', 'a', '9.5'),
+              Point('3', 'b', '2'), Point('4', 'c', '9.5')]
+
+    def test_iter(self):
+        tbl = record.StreamTable(Point, iter(self.points))
+        self.assertEqual(list(tbl), self.points)
+        with self.assertRaises(TypeError):  # it can be read only once
+            list(tbl)
+        tbl = record.StreamTable(Point, self.points + [Point('2', 'd', '1')])
+        with self.assertRaises(KeyError) as ctxt:
+            list(tbl)
+        self.assertEqual(str(ctxt.exception),
+                         "'Point:4:Duplicated record:id=2'")
+
+    def test_groupby(self):
+        tbl = record.StreamTable(Point, self.points)
+        self.assertEqual([(key, [rec['id'] for rec in recs])
+                          for key, recs in tbl.groupby('by_label')],
+                         [(('a',), ['1', '2']), (('b',), ['3']),
+                          (('c',), ['4'])])
+        # the groups are in order of reading, also for sorted indexes
+        tbl = record.StreamTable(Point, self.points[2:])
+        self.assertEqual([key for key, _ in tbl.groupby('by_value')],
+                         [('2',), ('9.5',)])
+        tbl = record.StreamTable(Point, self.points + [Point('5', 'a', '1')])
+        with self.assertRaises(ValueError) as ctxt:
+            list(tbl.groupby('by_label'))
+        self.assertEqual(str(ctxt.exception), 'The records of Point with '
+                         'label=a are not consecutive')
+
+    def test_check_fk(self):
+        def check_fk(rec):
+            if rec['label'] == 'c':
+                raise record.ForeignKeyError(rec['label'])
+        tbl = record.StreamTable(Point, self.points, check_fk=check_fk)
+        with self.assertRaises(record.ForeignKeyError):
+            list(tbl)
+
+
+class Measure(record.Record):
+    id = record.Field(valid.positiveint)
+    site = record.Field(str)
+    value = record.Field(valid.NoneOr(valid.positivefloat))
+    flag = record.Field(valid.boolean)
+
+    pkey = record.Unique('id')
+
+
+class ArrayTest(unittest.TestCase):
+    tabletype = record.Table
+
+    def setUp(self):
+        self.t = self.tabletype(Measure, [
+            Measure('1', 'a', '0.5', 'true'), Measure('2', 'b', '', 'false'),
+            Measure('3', 'a', '2.0', 'true')])
+
+    def test_to_array(self):
+        arr = self.t.to_array()
+        self.assertEqual([arr.dtype[name].kind for name in arr.dtype.names],
+                         ['i', 'S', 'f', 'b'])
+        self.assertEqual(list(arr['id']), [1, 2, 3])
+        self.assertEqual(list(arr['site']), ['a', 'b', 'a'])
+        self.assertTrue(numpy.isnan(arr['value'][1]))
+        self.assertEqual(list(arr['flag']), [True, False, True])
+        self.assertEqual(len(self.tabletype(Measure, []).to_array()), 0)
+
+    def test_from_array(self):
+        arr = self.t.to_array()
+        tbl = self.tabletype.from_array(Measure, arr)
+        self.assertEqual(list(tbl), list(self.t))
+        self.assertEqual(tbl.getrecord('2')['value'], '')
+        arr['id'][2] = 1
+        with self.assertRaises(KeyError):
+            self.tabletype.from_array(Measure, arr)
+
+
+class ColumnArrayTest(ArrayTest):
+    tabletype = record.ColumnTable
+
+    def test_invalid(self):
+        arr = self.t.to_array()
+        arr['value'][0] = -1
+        with self.assertRaises(record.InvalidRecord) as ctxt:
+            self.tabletype.from_array(Measure, arr)
+        self.assertEqual(str(ctxt.exception),
+                         'Measure[value]: 0,2: float -1 < 0')